@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for remaster4.py
+Builds scaled synthetic hybrid ISOs with the same layout as the Ubuntu live-server
+ISO (protective MBR, GPT with an appended ESP, El Torito BIOS + EFI entries,
+boot/grub/grub.cfg, casper/, md5sum.txt) and times every remaster stage on them.
+
+Usage:
+  python3 benchmark-remaster.py                         # default size matrix
+  python3 benchmark-remaster.py -sizes 32,128,512 -files 2000
+  python3 benchmark-remaster.py -generate synthetic.iso -size 256
+
+Needs xorriso (no sudo, no download). mkfs.vfat is used for the ESP when present.
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import remaster4
+
+DEFAULT_SIZES_MB = [32, 128, 512]
+DEFAULT_FILE_COUNT = 500
+ESP_SIZE_KB = 5632  # 11264 sectors, same as the stock fallback
+
+SYNTHETIC_GRUB_CFG = """set timeout=30
+
+loadfont unicode
+
+menuentry "Try or Install Ubuntu Server" {
+	set gfxpayload=keep
+	linux	/casper/vmlinuz  ---
+	initrd	/casper/initrd
+}
+"""
+
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 1024*1024)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+
+def make_esp_image(path, size_kb=ESP_SIZE_KB):
+    if os.path.exists(path):
+        os.remove(path)
+    if shutil.which("mkfs.vfat"):
+        if subprocess.run(["mkfs.vfat", "-C", path, str(size_kb)], capture_output=True).returncode == 0:
+            return
+    remaster4.make_fat_image(path, size_kb * 1024)
+
+def build_synthetic_tree(tree_dir, total_mb, file_count):
+    """Lay out a tree shaped like the live-server ISO, totalling about total_mb"""
+    os.makedirs(os.path.join(tree_dir, "boot", "grub", "i386-pc"), exist_ok=True)
+    os.makedirs(os.path.join(tree_dir, "EFI", "boot"), exist_ok=True)
+    os.makedirs(os.path.join(tree_dir, "casper"), exist_ok=True)
+
+    with open(os.path.join(tree_dir, "boot", "grub", "grub.cfg"), 'w') as f:
+        f.write(SYNTHETIC_GRUB_CFG)
+    write_random_file(os.path.join(tree_dir, "boot", "grub", "i386-pc", "eltorito.img"), 4 * 2048)
+    write_random_file(os.path.join(tree_dir, "EFI", "boot", "bootx64.efi"), 64 * 1024)
+    write_random_file(os.path.join(tree_dir, "casper", "vmlinuz"), 1024*1024)
+    write_random_file(os.path.join(tree_dir, "casper", "initrd"), 2*1024*1024)
+
+    # Half the payload in one big squashfs-like file, half spread over the pool
+    total = total_mb * 1024*1024
+    write_random_file(os.path.join(tree_dir, "casper", "ubuntu-server-minimal.squashfs"), total // 2)
+    per_file = max(1, (total // 2) // max(1, file_count))
+    for i in range(file_count):
+        pool_dir = os.path.join(tree_dir, "pool", "main", f"{i % 64:02x}")
+        os.makedirs(pool_dir, exist_ok=True)
+        write_random_file(os.path.join(pool_dir, f"package-{i}.deb"), per_file)
+
+    lines = []
+    for root, dirs, files in os.walk(tree_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, tree_dir)
+            with open(path, 'rb') as f:
+                lines.append(f"{hashlib.md5(f.read()).hexdigest()}  ./{rel}\n")
+    with open(os.path.join(tree_dir, "md5sum.txt"), 'w') as f:
+        f.writelines(sorted(lines))
+
+def generate_synthetic_iso(iso_path, total_mb=64, file_count=DEFAULT_FILE_COUNT):
+    """Create a hybrid ISO that remaster_ubuntu_2204's stages can process"""
+    iso_path = os.path.abspath(iso_path)
+    build_dir = tempfile.mkdtemp(prefix="synthetic-iso-")
+    try:
+        tree_dir = os.path.join(build_dir, "tree")
+        build_synthetic_tree(tree_dir, total_mb, file_count)
+        mbr = os.path.join(build_dir, "mbr.img")
+        with open(mbr, 'wb') as f:
+            f.write(b"\0" * 432)
+        esp = os.path.join(build_dir, "esp.img")
+        make_esp_image(esp)
+        cmd = [
+            "xorriso", "-as", "mkisofs", "-r", "-V", "Ubuntu-Server synthetic", "-o", iso_path,
+            "--grub2-mbr", mbr,
+            "-partition_offset", "16",
+            "--mbr-force-bootable",
+            "-append_partition", "2", "28732ac11ff8d211ba4b00a0c93ec93b", esp,
+            "-appended_part_as_gpt",
+            "-iso_mbr_part_type", "a2a0d0ebe5b9334487c068b6b72699c7",
+            "-c", "/boot.catalog",
+            "-b", "/boot/grub/i386-pc/eltorito.img",
+            "-no-emul-boot", "-boot-load-size", "4", "-boot-info-table", "--grub2-boot-info",
+            "-eltorito-alt-boot",
+            "-e", "--interval:appended_partition_2:::",
+            "-no-emul-boot",
+            tree_dir,
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr)
+            return False
+        print(f"✓ Synthetic ISO: {iso_path} ({os.path.getsize(iso_path) / (1024*1024):.1f} MB)")
+        return True
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+def tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def benchmark_size(total_mb, file_count, base_dir):
+    """Run every remaster stage against one synthetic ISO and return the spans"""
+    run_dir = os.path.join(base_dir, f"{total_mb}mb")
+    os.makedirs(run_dir, exist_ok=True)
+    old_cwd = os.getcwd()
+    os.chdir(run_dir)
+    remaster4.BUILD_SPANS.clear()
+    try:
+        iso_filename = "synthetic.iso"
+        if not generate_synthetic_iso(iso_filename, total_mb, file_count):
+            return None
+        iso_bytes = os.path.getsize(iso_filename)
+        work_dir = "working_dir"
+
+        with remaster4.stage("extract-boot-images"):
+            remaster4.extract_mbr_template(iso_filename)
+            remaster4.extract_efi_partition(iso_filename)
+        with remaster4.stage("extract-tree"):
+            remaster4.extract_iso_tree(iso_filename, work_dir)
+            extracted_stats = remaster4.snapshot_tree_stats(work_dir)
+        with remaster4.stage("inject"):
+            remaster4.run_injectors([("hello", remaster4.hello_injector()), ("autoinstall", remaster4.autoinstall_injector())],
+                                    work_dir, "efi.img", "boot_hybrid.img")
+        with remaster4.stage("md5sum"):
+            remaster4.update_md5sum_list(work_dir, extracted_stats)
+        with remaster4.stage("build-iso"):
+            built = remaster4.build_iso(work_dir, "out.iso")
+        if built:
+            with remaster4.stage("manifest"):
+                remaster4.write_build_manifest("out.iso", work_dir)
+
+        payload = {"extract-tree": iso_bytes, "md5sum": tree_size(work_dir),
+                   "build-iso": iso_bytes, "manifest": iso_bytes}
+        results = []
+        for span in remaster4.BUILD_SPANS:
+            if span["depth"] != 0 or "wall_s" not in span:
+                continue
+            entry = dict(span)
+            if span["name"] in payload and span["wall_s"] > 0:
+                entry["mb_per_s"] = round(payload[span["name"]] / (1024*1024) / span["wall_s"], 1)
+            results.append(entry)
+        return {"size_mb": total_mb, "iso_bytes": iso_bytes, "files": file_count, "stages": results}
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+def print_results(runs):
+    print("\n==================================================")
+    print("Benchmark results:")
+    print(f"{'Size':>6} {'Stage':<22} {'Wall':>8} {'CPU':>8} {'MB/s':>8}")
+    for run in runs:
+        for span in run["stages"]:
+            rate = f"{span['mb_per_s']:.1f}" if "mb_per_s" in span else "-"
+            print(f"{run['size_mb']:>4}MB {span['name']:<22} {span['wall_s']:>7.2f}s {span['cpu_s']:>7.2f}s {rate:>8}")
+
+def main():
+    print("Remaster Offline Benchmark")
+    print("==================================================")
+    if not shutil.which("xorriso"):
+        print("✗ FAIL: xorriso not found (sudo apt-get install -y xorriso)")
+        return 1
+
+    file_count = int(remaster4.get_arg_value("-files", DEFAULT_FILE_COUNT))
+    generate_path = remaster4.get_arg_value("-generate")
+    if generate_path:
+        return 0 if generate_synthetic_iso(generate_path, int(remaster4.get_arg_value("-size", 64)), file_count) else 1
+
+    sizes = [int(s) for s in remaster4.get_arg_value("-sizes", ",".join(str(s) for s in DEFAULT_SIZES_MB)).split(",")]
+    base_dir = tempfile.mkdtemp(prefix="remaster-bench-", dir=remaster4.get_arg_value("-workdir"))
+    runs = []
+    try:
+        for total_mb in sizes:
+            print(f"\n--- Benchmarking {total_mb} MB synthetic ISO ({file_count} pool files) ---")
+            run = benchmark_size(total_mb, file_count, base_dir)
+            if run is None:
+                print(f"✗ FAIL: could not build {total_mb} MB synthetic ISO")
+                return 1
+            runs.append(run)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    print_results(runs)
+    output = remaster4.get_arg_value("-o", "benchmark-results.json")
+    with open(output, 'w') as f:
+        json.dump({"host": os.uname().nodename, "cpus": os.cpu_count(), "runs": runs}, f, indent=2)
+        f.write("\n")
+    print(f"\nResults written: {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Boot-to-installer smoke test and boot latency benchmark
+Boots a remastered ISO in QEMU (TCG, no KVM needed) with SeaBIOS and with OVMF,
+watches the serial console and checks that the GRUB menu, the kernel and the
+subiquity installer come up. Records time-to-GRUB, time-to-kernel and
+time-to-subiquity for each firmware in boot-benchmark.json.
+
+Usage:
+  python3 boot-smoke-test.py NosanaAOS-0.24.04.2.iso
+  python3 boot-smoke-test.py NosanaAOS-0.24.04.2.iso -firmware uefi -timeout 1800 -memory 4096
+
+Needs qemu-system-x86_64 and, for UEFI, the ovmf package.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import remaster4
+
+BOOT_BENCHMARK_FILE = "boot-benchmark.json"
+DEFAULT_TIMEOUT = 1200
+DEFAULT_MEMORY_MB = 4096
+
+# Milestones in the order they appear on ttyS0
+MILESTONES = [
+    ("grub", re.compile(r"GNU GRUB|Install Ubuntu Server \(Semi-Automated\)")),
+    ("kernel", re.compile(r"Linux version \d")),
+    ("subiquity", remaster4.SUBIQUITY_STARTED_RE),
+]
+
+# Combined images go in -bios; split CODE/VARS images go in pflash
+OVMF_COMBINED = ["/usr/share/ovmf/OVMF.fd", "/usr/share/qemu/OVMF.fd"]
+OVMF_SPLIT = [
+    ("/usr/share/OVMF/OVMF_CODE_4M.fd", "/usr/share/OVMF/OVMF_VARS_4M.fd"),
+    ("/usr/share/OVMF/OVMF_CODE.fd", "/usr/share/OVMF/OVMF_VARS.fd"),
+    ("/usr/share/edk2/ovmf/OVMF_CODE.fd", "/usr/share/edk2/ovmf/OVMF_VARS.fd"),
+]
+
+def firmware_args(firmware, scratch_dir):
+    if firmware == "bios":
+        return []
+    for path in OVMF_COMBINED:
+        if os.path.exists(path):
+            return ["-bios", path]
+    for code, vars_template in OVMF_SPLIT:
+        if os.path.exists(code) and os.path.exists(vars_template):
+            vars_copy = os.path.join(scratch_dir, "OVMF_VARS.fd")
+            shutil.copyfile(vars_template, vars_copy)
+            return ["-drive", f"if=pflash,format=raw,readonly=on,file={code}",
+                    "-drive", f"if=pflash,format=raw,file={vars_copy}"]
+    return None
+
+def boot_iso(iso, firmware, timeout, memory_mb, log_path):
+    """Boot iso once and return a result record with milestone timings"""
+    scratch_dir = tempfile.mkdtemp(prefix="boot-smoke-")
+    record = {"firmware": firmware, "iso": os.path.basename(iso), "passed": False}
+    try:
+        fw = firmware_args(firmware, scratch_dir)
+        if fw is None:
+            record["error"] = "OVMF firmware not found (sudo apt-get install -y ovmf)"
+            return record
+        argv = ["qemu-system-x86_64", "-accel", "tcg", "-m", str(memory_mb), "-smp", str(min(4, os.cpu_count() or 1)),
+                "-display", "none", "-monitor", "none", "-serial", "stdio", "-no-reboot",
+                "-cdrom", iso, "-boot", "d"] + fw
+        print(f"Booting {os.path.basename(iso)} with {firmware.upper()}...")
+        start = time.monotonic()
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        reached = {}
+        buffer = bytearray()
+        lock = threading.Lock()
+
+        def pump():
+            with open(log_path, 'wb') as log:
+                while True:
+                    chunk = proc.stdout.read1(4096)
+                    if not chunk:
+                        break
+                    log.write(chunk)
+                    with lock:
+                        buffer.extend(chunk)
+
+        reader = threading.Thread(target=pump, daemon=True)
+        reader.start()
+
+        scanned = 0
+        pending = list(MILESTONES)
+        while pending and time.monotonic() - start < timeout and proc.poll() is None:
+            time.sleep(0.5)
+            with lock:
+                # Keep some overlap so a marker split across reads is still found
+                text = remaster4.SERIAL_ANSI_ESCAPE.sub(b"", bytes(buffer[max(0, scanned - 256):])).decode("utf-8", "replace")
+                scanned = len(buffer)
+            while pending and pending[0][1].search(text):
+                name = pending.pop(0)[0]
+                reached[name] = round(time.monotonic() - start, 2)
+                print(f"  ✓ {name} after {reached[name]:.1f}s")
+                if name == "grub":
+                    # Don't sit through the menu timeout: boot the default entry now
+                    try:
+                        proc.stdin.write(b"\r")
+                        proc.stdin.flush()
+                    except BrokenPipeError:
+                        # QEMU already exited; its status is reported below
+                        pass
+
+        for name, _ in pending:
+            print(f"  ✗ {name} not reached")
+        record.update({"time_to_" + name: seconds for name, seconds in reached.items()})
+        record["passed"] = not pending
+        if not record["passed"]:
+            record["error"] = "timeout" if proc.poll() is None else f"qemu exited with status {proc.returncode}"
+        record["serial_log"] = log_path
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        reader.join(timeout=5)
+        return record
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def save_records(records, path=BOOT_BENCHMARK_FILE):
+    history = []
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            history = []
+    stamp = int(time.time())
+    for record in records:
+        record["timestamp"] = stamp
+    history.extend(records)
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=2)
+        f.write("\n")
+    print(f"Results appended to {path}")
+
+def main():
+    print("NosanaAOS Boot Smoke Test")
+    print("=" * 50)
+    args = [a for a in sys.argv[1:] if a.endswith(".iso")]
+    if not args:
+        print(__doc__)
+        return 1
+    iso = os.path.abspath(args[0])
+    if not os.path.exists(iso):
+        print(f"✗ FAIL: {iso} not found")
+        return 1
+    if not shutil.which("qemu-system-x86_64"):
+        print("✗ FAIL: qemu-system-x86_64 not found (sudo apt-get install -y qemu-system-x86)")
+        return 1
+
+    firmwares = remaster4.get_arg_value("-firmware", "bios,uefi").split(",")
+    timeout = int(remaster4.get_arg_value("-timeout", DEFAULT_TIMEOUT))
+    memory_mb = int(remaster4.get_arg_value("-memory", DEFAULT_MEMORY_MB))
+
+    records = []
+    for firmware in firmwares:
+        record = boot_iso(iso, firmware, timeout, memory_mb, f"boot-smoke-{firmware}.log")
+        records.append(record)
+
+    print("\n" + "=" * 50)
+    print(f"{'Firmware':<10} {'GRUB':>8} {'Kernel':>8} {'Subiquity':>10}  Result")
+    for r in records:
+        cells = [f"{r['time_to_' + m]:.1f}s" if "time_to_" + m in r else "-" for m in ("grub", "kernel", "subiquity")]
+        print(f"{r['firmware']:<10} {cells[0]:>8} {cells[1]:>8} {cells[2]:>10}  {'PASS' if r['passed'] else 'FAIL: ' + r.get('error', '')}")
+    save_records(records)
+
+    if all(r["passed"] for r in records):
+        print("✓ ALL BOOT TESTS PASSED")
+        return 0
+    print("✗ SOME BOOT TESTS FAILED - Check the serial logs")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
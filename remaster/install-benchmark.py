@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Unattended install phase-timing benchmark
+Runs a full semi-automated install of a remastered ISO in QEMU, answering the
+interactive sections from a scripted answers file, and times each installer
+phase (storage, source extract, package install, late-commands, reboot) from
+the subiquity/curtin output on the serial console. One record per ISO build is
+appended to install-benchmark.json and compared with the previous build.
+
+Usage:
+  python3 install-benchmark.py NosanaAOS-0.24.04.2.iso
+  python3 install-benchmark.py NosanaAOS-0.24.04.2.iso -answers answers.yaml -mirror /srv/apt-mirror/ubuntu
+
+The seed and the apt stand-in are served from a local HTTP server that the guest
+reaches through QEMU user networking. Without -mirror the stand-in has no
+archive, so the installer falls back to an offline install from the ISO pool and
+the timings do not depend on the internet. Needs qemu-system-x86_64 and PyYAML.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import http.server
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import remaster4
+
+INSTALL_BENCHMARK_FILE = "install-benchmark.json"
+DEFAULT_TIMEOUT = 3 * 3600
+DEFAULT_MEMORY_MB = 4096
+DEFAULT_DISK_GB = 25
+GUEST_HOST_ADDR = "10.0.2.2"  # the host as seen from QEMU user networking
+
+# Fill in everything AUTOINSTALL_USER_DATA leaves interactive (password: nosana)
+DEFAULT_ANSWERS = {
+    "locale": "en_US.UTF-8",
+    "keyboard": {"layout": "us"},
+    "network": {"version": 2, "ethernets": {"any": {"match": {"name": "en*"}, "dhcp4": True}}},
+    "storage": {"layout": {"name": "direct"}},
+    "identity": {
+        "hostname": "nosana-bench",
+        "username": "nosana",
+        "password": "$6$nosanabench$xr9C7ujj7pv851tYg/6lyv/.xt3upaK9fdu7RxtQ0NQ2XC1ncMTE.B5Aj24WCGVK5lsNv3td.8KxAV5pIhx2m0",
+    },
+    "drivers": {"install": False},
+}
+
+# Phases run back to back: each ends where the next one starts, the last at QEMU exit
+INSTALL_PHASES = [
+    ("storage", ("curtin command block-meta", "running 'curtin partitioning'")),
+    ("source-extract", ("curtin command extract", "running 'curtin extract'")),
+    ("package-install", ("curtin command curthooks", "running 'curtin curthooks'")),
+    ("late-commands", ("executing late commands", "subiquity/Late/run")),
+    ("reboot", ("subiquity/Reboot", "reboot: Restarting system", "reboot: Power down")),
+]
+INSTALLER_STARTED = remaster4.SUBIQUITY_STARTED_RE
+
+def deep_merge(base, overrides):
+    merged = dict(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def build_seed(seed_dir, answers, mirror_url):
+    """Write a NoCloud seed: the shipped user-data with the interactive sections answered"""
+    user_data = yaml.safe_load(remaster4.AUTOINSTALL_USER_DATA)
+    autoinstall = deep_merge(user_data["autoinstall"], answers)
+    autoinstall.pop("interactive-sections", None)
+    autoinstall["apt"] = deep_merge({
+        "geoip": False,
+        "fallback": "offline-install",
+        "primary": [{"arches": ["default"], "uri": mirror_url}],
+    }, autoinstall.get("apt", {}))
+    # -no-reboot turns the final reboot into a QEMU exit, which closes the last phase
+    autoinstall["shutdown"] = "reboot"
+    user_data["autoinstall"] = autoinstall
+
+    os.makedirs(seed_dir, exist_ok=True)
+    with open(os.path.join(seed_dir, "user-data"), 'w') as f:
+        f.write("#cloud-config\n")
+        yaml.safe_dump(user_data, f, sort_keys=False)
+    with open(os.path.join(seed_dir, "meta-data"), 'w') as f:
+        f.write(remaster4.AUTOINSTALL_META_DATA)
+    with open(os.path.join(seed_dir, "vendor-data"), 'w') as f:
+        f.write("")
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def start_stand_in_server(serve_dir):
+    """Serve the seed and the apt stand-in on an ephemeral port"""
+    handler = lambda *args, **kwargs: QuietHandler(*args, directory=serve_dir, **kwargs)
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def extract_boot_files(iso, scratch_dir):
+    """Pull the installer kernel and initrd out of the ISO for a direct kernel boot"""
+    paths = []
+    try:
+        with remaster4.BaseImage(iso) as image:
+            for name in ("/casper/vmlinuz", "/casper/initrd"):
+                path = os.path.join(scratch_dir, os.path.basename(name))
+                with open(path, 'wb') as f:
+                    f.write(image.read(name))
+                paths.append(path)
+    except remaster4.IsoError:
+        return None
+    return paths
+
+def match_phase(line, markers):
+    return any(marker in line for marker in markers)
+
+def phase_durations(events, end_time):
+    """Turn [(seconds, phase)] start events into per-phase durations"""
+    durations = {}
+    for i, (start, phase) in enumerate(events):
+        end = events[i + 1][0] if i + 1 < len(events) else end_time
+        durations[phase] = round(end - start, 2)
+    return durations
+
+def run_install(iso, answers, mirror_dir, timeout, memory_mb, disk_gb, log_path):
+    """Install iso onto a scratch disk and return the phase timings"""
+    scratch_dir = tempfile.mkdtemp(prefix="install-bench-")
+    server = None
+    try:
+        boot_files = extract_boot_files(iso, scratch_dir)
+        if not boot_files:
+            return {"passed": False, "error": "could not read /casper/vmlinuz and /casper/initrd from the ISO"}
+
+        serve_dir = os.path.join(scratch_dir, "www")
+        os.makedirs(serve_dir)
+        if mirror_dir:
+            os.symlink(os.path.abspath(mirror_dir), os.path.join(serve_dir, "ubuntu"))
+        server = start_stand_in_server(serve_dir)
+        base_url = f"http://{GUEST_HOST_ADDR}:{server.server_address[1]}"
+        build_seed(os.path.join(serve_dir, "seed"), answers, f"{base_url}/ubuntu")
+
+        disk = os.path.join(scratch_dir, "target.img")
+        with open(disk, 'wb') as f:
+            f.truncate(disk_gb * 1024**3)
+
+        cmdline = f"autoinstall ds=nocloud-net;s={base_url}/seed/ console=ttyS0,115200n8 ---"
+        argv = ["qemu-system-x86_64", "-accel", "kvm:tcg", "-cpu", "max", "-m", str(memory_mb),
+                "-smp", str(min(4, os.cpu_count() or 1)),
+                "-display", "none", "-monitor", "none", "-serial", "stdio", "-no-reboot",
+                "-kernel", boot_files[0], "-initrd", boot_files[1], "-append", cmdline,
+                "-cdrom", iso,
+                "-drive", f"file={disk},format=raw,if=virtio,cache=unsafe",
+                "-netdev", "user,id=net0", "-device", "virtio-net-pci,netdev=net0"]
+
+        print(f"Installing {os.path.basename(iso)} (seed: {base_url}/seed/)...")
+        start = time.monotonic()
+        proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        events = []
+        installer_started = []
+        pending = list(INSTALL_PHASES)
+
+        def pump():
+            with open(log_path, 'wb') as log:
+                for raw in proc.stdout:
+                    log.write(raw)
+                    now = time.monotonic() - start
+                    line = raw.decode("utf-8", "replace")
+                    if not installer_started and INSTALLER_STARTED.search(
+                            remaster4.SERIAL_ANSI_ESCAPE.sub(b"", raw).decode("utf-8", "replace")):
+                        installer_started.append(now)
+                    # A later phase marker closes any phase whose marker never showed up
+                    for index, (phase, markers) in enumerate(pending):
+                        if match_phase(line, markers):
+                            events.append((now, phase))
+                            print(f"  [{remaster4.format_duration(now)}] {phase}")
+                            del pending[:index + 1]
+                            break
+
+        reader = threading.Thread(target=pump, daemon=True)
+        reader.start()
+        try:
+            proc.wait(timeout=timeout)
+            error = None if proc.returncode == 0 else f"qemu exited with status {proc.returncode}"
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            error = "timeout"
+        end_time = time.monotonic() - start
+        reader.join(timeout=5)
+
+        record = {
+            "total_s": round(end_time, 2),
+            "phases": phase_durations(events, end_time),
+            "serial_log": log_path,
+        }
+        if installer_started:
+            record["time_to_installer_s"] = round(installer_started[0], 2)
+        missing = [phase for phase, _ in INSTALL_PHASES if phase not in record["phases"]]
+        if missing and not error:
+            error = "phases not seen: " + ", ".join(missing)
+        record["passed"] = error is None
+        if error:
+            record["error"] = error
+        return record
+    finally:
+        if server:
+            server.shutdown()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def iso_identity(iso):
+    """Prefer the build manifest's digest so the record matches the build that made the ISO"""
+    manifest_path = iso + ".manifest.json"
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            for entry in manifest.get("artifacts", []):
+                if os.path.basename(entry["path"]) == os.path.basename(iso) and entry.get("size") == os.path.getsize(iso):
+                    return entry["sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+    return remaster4.digest_file(iso, ("sha256",))["sha256"]
+
+def load_history(path=INSTALL_BENCHMARK_FILE):
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def print_comparison(record, previous):
+    print("\n" + "=" * 50)
+    print(f"{'Phase':<18} {'This build':>12} {'Previous':>12} {'Change':>10}")
+    for phase, _ in INSTALL_PHASES:
+        now = record["phases"].get(phase)
+        before = (previous.get("phases") or {}).get(phase) if previous else None
+        change = f"{now - before:+.1f}s" if now is not None and before is not None else "-"
+        cells = [remaster4.format_duration(v) if v is not None else "-" for v in (now, before)]
+        print(f"{phase:<18} {cells[0]:>12} {cells[1]:>12} {change:>10}")
+    if previous:
+        print(f"(previous: {previous.get('iso', '?')} {(previous.get('sha256') or '?')[:12]})")
+
+def main():
+    print("NosanaAOS Install Phase Benchmark")
+    print("=" * 50)
+    args = [a for a in sys.argv[1:] if a.endswith(".iso")]
+    if not args:
+        print(__doc__)
+        return 1
+    iso = os.path.abspath(args[0])
+    if not os.path.exists(iso):
+        print(f"✗ FAIL: {iso} not found")
+        return 1
+    if not shutil.which("qemu-system-x86_64"):
+        print("✗ FAIL: qemu-system-x86_64 not found (sudo apt-get install -y qemu-system-x86)")
+        return 1
+
+    answers = DEFAULT_ANSWERS
+    answers_path = remaster4.get_arg_value("-answers")
+    if answers_path:
+        with open(answers_path, 'r') as f:
+            answers = deep_merge(DEFAULT_ANSWERS, yaml.safe_load(f) or {})
+    mirror_dir = remaster4.get_arg_value("-mirror")
+    if mirror_dir and not os.path.isdir(os.path.join(mirror_dir, "dists")):
+        print(f"✗ FAIL: {mirror_dir} does not look like an apt archive (no dists/)")
+        return 1
+
+    record = {"iso": os.path.basename(iso), "sha256": iso_identity(iso), "timestamp": int(time.time()),
+              "mirror": "local" if mirror_dir else "offline"}
+    record.update(run_install(
+        iso, answers, mirror_dir,
+        timeout=int(remaster4.get_arg_value("-timeout", DEFAULT_TIMEOUT)),
+        memory_mb=int(remaster4.get_arg_value("-memory", DEFAULT_MEMORY_MB)),
+        disk_gb=int(remaster4.get_arg_value("-disk-gb", DEFAULT_DISK_GB)),
+        log_path="install-benchmark-serial.log"))
+
+    history = load_history()
+    # Compare against the latest passing run of a different build under the same mirror mode
+    previous = next((r for r in reversed(history) if r.get("passed") and r.get("sha256") != record["sha256"]
+                     and r.get("mirror") == record["mirror"]), None)
+    print_comparison(record, previous)
+
+    history = [r for r in history if r.get("sha256") != record["sha256"] or r.get("mirror") != record["mirror"]]
+    history.append(record)
+    with open(INSTALL_BENCHMARK_FILE, 'w') as f:
+        json.dump(history, f, indent=2)
+        f.write("\n")
+    print(f"Record written to {INSTALL_BENCHMARK_FILE}")
+
+    if record["passed"]:
+        print(f"✓ INSTALL COMPLETED in {remaster4.format_duration(record['total_s'])}")
+        return 0
+    print(f"✗ INSTALL FAILED: {record['error']} - Check {record['serial_log']}")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+Remaster build daemon
+Long-running service that accepts remaster jobs over a local HTTP or Unix-socket
+API, builds them on a bounded pool of worker processes and serves the finished
+ISOs. Dependencies are checked once at startup. Identical jobs that are queued or
+running are merged, and finished artifacts are cached by job key, so repeating a
+request returns the existing ISO.
+
+Usage:
+  python3 remaster-daemon.py                           # http://127.0.0.1:8740
+  python3 remaster-daemon.py -listen 0.0.0.0:8740 -workers 2 -dir /srv/nosana-builds
+  python3 remaster-daemon.py -socket /run/nosana-remaster.sock
+  python3 remaster-daemon.py -disk-mb-s 900             # skip the startup disk bandwidth probe
+
+API:
+  POST /jobs                  {"release": "24.04.2", "options": {"autoinstall": true, "grub_profile": "fleet-unattended"},
+                               "seed": {"user-data": "...", "meta-data": "..."}}
+  GET  /jobs                  all jobs
+  GET  /jobs/ID               job status
+  GET  /jobs/ID/log?offset=N  build log from byte N
+  GET  /artifacts/ID/NAME     download a finished ISO or manifest (Range requests supported;
+                              with "seekable" only NAME.zst is stored and NAME is served from it)
+
+  curl -s -X POST localhost:8740/jobs -d '{"release": "22.04.5", "options": {"autoinstall": true}}'
+"""
+
+import os
+import sys
+import json
+import re
+import time
+import hashlib
+import threading
+import socketserver
+import multiprocessing
+import http.server
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import remaster4
+
+DEFAULT_LISTEN = "127.0.0.1:8740"
+DEFAULT_DAEMON_DIR = "remaster-daemon"
+BUILD_DISK_FACTOR = 3  # base ISO + extracted tree + rebuilt ISO exist at once
+# Disk throughput one build keeps busy while extracting the tree and writing the ISO
+# (compare the Read/Write MB columns of build-report.json against stage wall time)
+BUILD_IO_MB_S = 200
+BANDWIDTH_PROBE_BYTES = 256 * 1024 * 1024
+LOG_CHUNK_LIMIT = 1024 * 1024
+
+# Options a client may set, mapped to remaster_ubuntu_2204 keyword arguments.
+# Anything that names a path on the build host stays CLI-only.
+JOB_OPTIONS = {
+    "hello": ("inject_hello", bool),
+    "autoinstall": ("inject_autoinstall", bool),
+    "sign": ("sign_manifest", bool),
+    "reproducible": ("reproducible", bool),
+    "seekable": ("seekable", bool),
+    "squashfs_codec": ("squashfs_codec", str),
+    "initrd_codec": ("initrd_codec", str),
+    "layer": ("layer", str),
+    "layer_packages": ("layer_packages", list),
+    "grub_profile": ("grub_profile", str),
+}
+SEED_KEYS = ("user-data", "meta-data")
+# A casper layer name, e.g. "ubuntu-server-minimal"; never a path
+LAYER_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+class JobError(Exception):
+    pass
+
+def run_job(release, build_options, workspace, seed):
+    """Worker process entry point: apply the job's seed, then build in its workspace"""
+    defaults = remaster4.AUTOINSTALL_USER_DATA, remaster4.AUTOINSTALL_META_DATA
+    remaster4.AUTOINSTALL_USER_DATA = seed.get("user-data", defaults[0])
+    remaster4.AUTOINSTALL_META_DATA = seed.get("meta-data", defaults[1])
+    try:
+        return remaster4.build_release_isolated(release, build_options, workspace)
+    finally:
+        # Workers are reused; the next job must start from the shipped seed
+        remaster4.AUTOINSTALL_USER_DATA, remaster4.AUTOINSTALL_META_DATA = defaults
+
+def measure_disk_mb_s(path, probe_bytes=BANDWIDTH_PROBE_BYTES):
+    """Sequential write throughput (MB/s) of the filesystem holding path, or None"""
+    if remaster4.free_bytes(path) < probe_bytes * 4:
+        return None
+    probe = os.path.join(path, f".bandwidth-probe.{os.getpid()}")
+    block = os.urandom(4 * 1024 * 1024)
+    try:
+        start = time.perf_counter()
+        with open(probe, 'wb') as f:
+            for _ in range(probe_bytes // len(block)):
+                f.write(block)
+            f.flush()
+            # Time the data reaching the disk, not the page cache
+            os.fsync(f.fileno())
+        elapsed = time.perf_counter() - start
+    except OSError:
+        return None
+    finally:
+        if os.path.exists(probe):
+            os.remove(probe)
+    return probe_bytes / (1024 * 1024) / max(elapsed, 1e-6)
+
+def default_worker_count(base_dir, iso_bytes=3 * 1024**3, disk_mb_s=None):
+    """Builds to run at once: bounded by cores, disk bandwidth and free disk space.
+
+    Builds are mostly I/O: one per four cores, one per BUILD_IO_MB_S of disk
+    bandwidth, and never more than the free space can hold side by side.
+    """
+    by_cpu = max(1, (os.cpu_count() or 1) // 4)
+    by_bandwidth = max(1, int(disk_mb_s // BUILD_IO_MB_S)) if disk_mb_s else by_cpu
+    by_space = max(1, remaster4.free_bytes(base_dir) // (iso_bytes * BUILD_DISK_FACTOR))
+    return int(min(by_cpu, by_bandwidth, by_space))
+
+class BuildService:
+    def __init__(self, base_dir, workers):
+        self.base_dir = os.path.abspath(base_dir)
+        self.workers = workers
+        self.jobs = {}
+        self.releases = {}
+        self.lock = threading.Lock()
+        self.download_locks = {}
+        # Layer and initrd caches are shared by every job; md5 caches stay per workspace
+        self.cache_dir = os.path.join(self.base_dir, "cache")
+        for sub in ("base", "jobs", "artifacts", "cache"):
+            os.makedirs(os.path.join(self.base_dir, sub), exist_ok=True)
+        # fork keeps parsed module state and works for scripts piped in through curl.
+        # Start every worker now, while this is still the only thread: forking later
+        # from a job thread would copy locks held by the HTTP and job threads.
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+        for future in [self.pool.submit(os.getpid) for _ in range(workers)]:
+            future.result()
+        self.load_cached_artifacts()
+
+    def load_cached_artifacts(self):
+        artifacts_dir = os.path.join(self.base_dir, "artifacts")
+        for key in os.listdir(artifacts_dir):
+            try:
+                with open(os.path.join(artifacts_dir, key, "job.json"), 'r') as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if all(os.path.exists(artifact) or os.path.exists(artifact + ".zst")
+                   for artifact in (os.path.join(artifacts_dir, key, name) for name in job.get("artifacts", []))):
+                self.jobs[key] = job
+        if self.jobs:
+            print(f"✓ {len(self.jobs)} cached artifact(s) available")
+
+    def resolve(self, version):
+        with self.lock:
+            if version not in self.releases:
+                release = remaster4.resolve_release(version) if version else remaster4.default_release()
+                if not release:
+                    raise JobError(f"unknown release {version}")
+                self.releases[version] = release
+            return dict(self.releases[version])
+
+    def normalize(self, request):
+        """Validate a job request and return (key, release, build_options, seed)"""
+        if not isinstance(request, dict):
+            raise JobError("request must be a JSON object")
+        if not isinstance(request.get("release") or "", str):
+            raise JobError("release must be a string")
+        options = request.get("options") or {}
+        seed = request.get("seed") or {}
+        if not isinstance(options, dict):
+            raise JobError("options must be a JSON object")
+        if not isinstance(seed, dict):
+            raise JobError(f"seed must be a JSON object with string {' and '.join(SEED_KEYS)}")
+        release = self.resolve(request.get("release"))
+        build_options = dict(dc_disable_cleanup=False, inject_hello=False, inject_autoinstall=False, sign_manifest=False,
+                             use_tmpfs=self.workers == 1, plan_only=False)
+        for name, value in options.items():
+            if name not in JOB_OPTIONS:
+                raise JobError(f"unsupported option {name} (supported: {', '.join(JOB_OPTIONS)})")
+            argument, kind = JOB_OPTIONS[name]
+            if not isinstance(value, kind):
+                raise JobError(f"option {name} must be a {kind.__name__}")
+            if argument == "grub_profile":
+                if value not in remaster4.GRUB_PROFILES:
+                    raise JobError(f"unknown grub_profile {value} (available: {', '.join(remaster4.GRUB_PROFILES)})")
+            elif argument == "layer":
+                if not LAYER_NAME_RE.match(value):
+                    raise JobError(f"invalid layer name {value!r}")
+            elif argument == "layer_packages":
+                # These end up as apt-get arguments inside a root chroot
+                rejected = remaster4.invalid_packages(value)
+                if rejected:
+                    raise JobError(f"not a Debian package name: {', '.join(map(repr, rejected))}")
+            elif kind is str:
+                try:
+                    remaster4.parse_codec(value)
+                except ValueError as e:
+                    raise JobError(str(e))
+            build_options[argument] = value
+        if build_options.get("layer_packages") and not build_options.get("layer"):
+            raise JobError("layer_packages needs layer (the casper squashfs to install into)")
+        if set(seed) - set(SEED_KEYS) or not all(isinstance(v, str) for v in seed.values()):
+            raise JobError(f"seed may only contain string {' and '.join(SEED_KEYS)}")
+        if build_options["inject_autoinstall"]:
+            # Reject a broken seed at submission rather than after a full build
+            errors, _ = remaster4.validate_autoinstall_config(user_data=seed.get("user-data"), meta_data=seed.get("meta-data"))
+            if errors:
+                raise JobError("invalid autoinstall configuration: " + "; ".join(errors))
+        canonical = json.dumps({"release": release["version"], "sha256": release["sha256"],
+                                "options": build_options, "seed": seed}, sort_keys=True)
+        return hashlib.sha256(canonical.encode()).hexdigest()[:16], release, build_options, seed
+
+    def submit(self, request):
+        key, release, build_options, seed = self.normalize(request)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job and job["state"] != "failed":
+                # Same key: either merge with the build in flight or hand back the cached artifact
+                return dict(job, merged=True)
+            job = {"id": key, "release": release["version"], "options": request.get("options") or {},
+                   "state": "queued", "submitted": time.time(), "artifacts": []}
+            self.jobs[key] = job
+        threading.Thread(target=self.run, args=(job, release, build_options, seed), daemon=True).start()
+        return dict(job, merged=False)
+
+    def download_lock(self, filename):
+        with self.lock:
+            return self.download_locks.setdefault(filename, threading.Lock())
+
+    def run(self, job, release, build_options, seed):
+        key = job["id"]
+        workspace = os.path.join(self.base_dir, "jobs", key)
+        artifact_dir = os.path.join(self.base_dir, "artifacts", key)
+        os.makedirs(workspace, exist_ok=True)
+        os.makedirs(artifact_dir, exist_ok=True)
+        release["filename"] = os.path.join(self.base_dir, "base", release["filename"])
+        release["output"] = os.path.join(artifact_dir, release["output"])
+        job["log"] = os.path.join(workspace, "build.log")
+        try:
+            job["state"] = "downloading"
+            # Jobs for the same base share one download
+            with self.download_lock(release["filename"]):
+                if not remaster4.fetch_release(release):
+                    raise JobError(f"could not download {release['url']}")
+            job["state"] = "building"
+            job["started"] = time.time()
+            if not self.pool.submit(run_job, release, dict(build_options, cache_dir=self.cache_dir), workspace, seed).result():
+                raise JobError("build failed, see log")
+            names = [os.path.basename(release["output"])]
+            for suffix in (".zst", ".manifest.json"):
+                if os.path.exists(release["output"] + suffix):
+                    names.append(names[0] + suffix)
+            if build_options.get("seekable"):
+                # Keep only the compressed form; the ISO is served out of it
+                os.remove(release["output"])
+            job.update(state="done", finished=time.time(), artifacts=names)
+            with open(os.path.join(artifact_dir, "job.json"), 'w') as f:
+                json.dump(job, f, indent=2)
+            print(f"✓ Job {key} ({job['release']}) done in {remaster4.format_duration(job['finished'] - job['started'])}")
+        except Exception as e:
+            job.update(state="failed", finished=time.time(), error=str(e))
+            print(f"✗ Job {key} ({job['release']}) failed: {e}")
+
+    def artifact_path(self, key, name):
+        job = self.jobs.get(key)
+        if not job or job["state"] != "done" or name not in job["artifacts"]:
+            return None
+        return os.path.join(self.base_dir, "artifacts", key, name)
+
+class ApiHandler(http.server.BaseHTTPRequestHandler):
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = (json.dumps(payload, indent=2) + "\n").encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = self.service.submit(json.loads(self.rfile.read(length) or b"{}"))
+        except ValueError as e:
+            return self.send_json(400, {"error": f"invalid JSON: {e}"})
+        except JobError as e:
+            return self.send_json(400, {"error": str(e)})
+        self.send_json(200 if job["merged"] else 202, job)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["jobs"]:
+            return self.send_json(200, list(self.service.jobs.values()))
+        if len(parts) >= 2 and parts[0] == "jobs":
+            job = self.service.jobs.get(parts[1])
+            if not job:
+                return self.send_json(404, {"error": "no such job"})
+            if len(parts) == 2:
+                return self.send_json(200, job)
+            if parts[2:] == ["log"]:
+                try:
+                    offset = int(parse_qs(url.query).get("offset", ["0"])[0])
+                except ValueError:
+                    offset = -1
+                if offset < 0:
+                    return self.send_json(400, {"error": "offset must be a non-negative integer"})
+                return self.send_log(job, offset)
+        if len(parts) == 3 and parts[0] == "artifacts":
+            path = self.service.artifact_path(parts[1], parts[2])
+            if path:
+                return self.send_file(path)
+        self.send_json(404, {"error": "not found"})
+
+    def send_log(self, job, offset):
+        data = b""
+        if job.get("log") and os.path.exists(job["log"]):
+            with open(job["log"], 'rb') as f:
+                f.seek(offset)
+                data = f.read(LOG_CHUNK_LIMIT)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        # Clients poll with offset=X-Log-Offset to follow the log
+        self.send_header("X-Log-Offset", str(offset + len(data)))
+        self.send_header("X-Job-State", job["state"])
+        self.end_headers()
+        self.wfile.write(data)
+
+    def byte_range(self, size):
+        """(start, end) of a single-range Range header, None without one, False when unsatisfiable"""
+        header = self.headers.get("Range", "")
+        if not header.startswith("bytes=") or "," in header:
+            return None
+        first, _, last = header[len("bytes="):].partition("-")
+        try:
+            if first:
+                start, end = int(first), min(size - 1, int(last)) if last else size - 1
+            else:
+                start, end = max(0, size - int(last)), size - 1
+        except ValueError:
+            return None
+        return (start, end) if start <= end else False
+
+    def send_file(self, path):
+        # QEMU's curl driver, netboot loaders and resumed downloads all read by range,
+        # so a seekable container is served as if it were the plain ISO
+        if os.path.exists(path):
+            source = open(path, 'rb')
+            size = os.path.getsize(path)
+        else:
+            source = remaster4.SeekableReader(path + ".zst")
+            size = source.size
+        with source:
+            span = self.byte_range(size)
+            if span is False:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            start, end = span or (0, size - 1)
+            self.send_response(206 if span else 200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            if span:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            source.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = source.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def do_HEAD(self):
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        path = self.service.artifact_path(parts[1], parts[2]) if len(parts) == 3 and parts[0] == "artifacts" else None
+        if not path:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+        else:
+            with remaster4.SeekableReader(path + ".zst") as reader:
+                size = reader.size
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+class UnixApiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class UnixApiHandler(ApiHandler):
+    def address_string(self):
+        return "unix"
+
+def main():
+    print("Remaster Build Daemon")
+    print("==================================================")
+    base_dir = remaster4.get_arg_value("-dir", DEFAULT_DAEMON_DIR)
+    os.makedirs(base_dir, exist_ok=True)
+    workers = remaster4.get_arg_value("-workers")
+    if workers is None:
+        disk_mb_s = remaster4.get_arg_value("-disk-mb-s")
+        if disk_mb_s is None:
+            disk_mb_s = measure_disk_mb_s(base_dir)
+            if disk_mb_s:
+                print(f"Disk write bandwidth: {disk_mb_s:.0f} MB/s")
+        workers = default_worker_count(base_dir, disk_mb_s=float(disk_mb_s) if disk_mb_s else None)
+    workers = int(workers)
+
+    # Pay for dependency checks once, not per build: probe for everything a job may ask for
+    if not remaster4.check_and_install_dependencies(seekable=True, autoinstall=True, squashfs=True, sign=True,
+                                                   codecs=list(remaster4.CODECS)):
+        return 1
+
+    service = BuildService(base_dir, workers)
+    ApiHandler.service = service
+    socket_path = remaster4.get_arg_value("-socket")
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixApiServer(socket_path, UnixApiHandler)
+        where = f"unix:{socket_path}"
+    else:
+        host, port = remaster4.get_arg_value("-listen", DEFAULT_LISTEN).rsplit(":", 1)
+        server = http.server.ThreadingHTTPServer((host, int(port)), ApiHandler)
+        where = f"http://{host}:{port}"
+    print(f"✓ Listening on {where} with {workers} worker(s), workspace {os.path.abspath(base_dir)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down")
+    finally:
+        server.server_close()
+        service.pool.shutdown(wait=False, cancel_futures=True)
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
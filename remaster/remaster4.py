@@ -5,14 +5,27 @@
 Ubuntu ISO Remastering Tool - Standalone Version (remaster4.py)
 Version: 0.04.0-late-commands
 
-Purpose: Downloads and remasters Ubuntu ISOs (22.04.2+, hybrid MBR+EFI, and more in future). All temp files are in the current directory. Use -dc to disable cleanup. Use -hello to inject and verify test files. Use -autoinstall to inject semi-automated installer configuration.
+Purpose: Downloads and remasters Ubuntu ISOs (22.04.2+, hybrid MBR+EFI, and more in future). All temp files are in the current directory. Use -dc to disable cleanup. Use -hello to inject and verify test files. Use -autoinstall to inject semi-automated installer configuration. Use -sign to GPG-sign the build manifest. Use -no-tmpfs to keep the workspace on disk even when it fits in RAM. Use -plan to print the pre-flight space and time estimate and exit. Use -esp-add LOCAL:/ESP/PATH (repeatable) to add files to the EFI System Partition. Use -layer NAME with -layer-overlay DIR and/or -layer-packages a,b to customize a casper squashfs layer. Use -squashfs-codec / -initrd-codec CODEC[:LEVEL] (zstd, xz, lz4, gzip) to recompress, and -codec-bench zstd:19,lz4,xz to compare codecs. Use -initrd-add LOCAL:/PATH and -initrd-remove GLOB (repeatable) to edit the initrd. Use -release 22.04.5,24.04.2 to build other point releases (resolved and checksummed from SHA256SUMS); several releases build in parallel, each in matrix/VERSION/, with -jobs N workers. As a library, open_base_image(path) returns a parsed BaseImage whose build(new_iso, inject_autoinstall=True, injectors=[(name, ops)], ...) can be called repeatedly; all injected writes, removals and grub.cfg edits are merged into one change set whose key is recorded in the build manifest. Set SOURCE_DATE_EPOCH (and optionally NOSANA_BUILD_SEED), or use -reproducible to date the build from the base ISO, for byte-identical output. Use -delta-from PREVIOUS.iso to also write NEW.iso.delta, and -apply-delta NEW.iso.delta -base PREVIOUS.iso [-o NEW.iso] to rebuild and verify it. Use -seekable to also write NEW.iso.zst (zstd seekable format) and -unpack-seekable NEW.iso.zst [-o FILE_OR_DEVICE] to stream it back out. Use -fleet nodes.csv [-fleet-out DIR] [-fleet-template USER_DATA] to render per-node user-data, meta-data and network-config (columns: hostname, instance_id, interface, address, gateway, dns, ssh_keys, gpu_driver; lists are ;-separated). -autoinstall builds validate the seed documents, GRUB menu and seed layout before downloading; -validate runs only that check. The autoinstall entries are merged into the stock grub.cfg (duplicates removed, one timeout and default); -grub-profile interactive (default) or fleet-unattended (timeout 0, serial console) picks the boot behaviour.
 
 This version properly enables proxy mirror testing by removing ALL apt/proxy/updates configuration from autoinstall.
 """
 
 import os
+import io
 import sys
+import re
+import json
+import shlex
+import shutil
+import threading
+import mmap
+import time
+import resource
+import hashlib
 import subprocess
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # Inline autoinstall configuration files - MINIMAL VERSION FOR PROXY TESTING
 AUTOINSTALL_USER_DATA = """#cloud-config
@@ -56,13 +69,19 @@ AUTOINSTALL_META_DATA = """instance-id: ubuntu-autoinstall
 local-hostname: ubuntu-server
 """
 
-# Fixed GRUB configuration with proper console parameters for UI rendering
+# Fixed GRUB configuration with proper console parameters for UI rendering.
+# The ds= argument is quoted: an unquoted ';' ends the linux command in GRUB.
 GRUB_AUTOINSTALL_CFG = """set timeout=30
 set default=0
 
+# Mirror the menu on the first serial port, matching console=ttyS0 below
+serial --unit=0 --speed=115200
+terminal_input console serial
+terminal_output console serial
+
 menuentry "Install Ubuntu Server (Semi-Automated)" {
     set gfxpayload=keep
-    linux /casper/vmlinuz autoinstall ds=nocloud;s=file:///cdrom/server/ console=tty0 console=ttyS0,115200n8
+    linux /casper/vmlinuz autoinstall 'ds=nocloud;s=file:///cdrom/server/' console=tty0 console=ttyS0,115200n8
     initrd /casper/initrd
 }
 
@@ -79,48 +98,346 @@ menuentry "Try Ubuntu Server without installing" {
 }
 """
 
-def run_command(cmd, description="", check=True):
+BUILD_REPORT_FILE = "build-report.json"
+BUILD_SPANS = []
+_span_depth = [0]
+
+def read_proc_io():
+    counters = {}
+    try:
+        with open("/proc/self/io", 'r') as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                counters[key.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+def resource_snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = read_proc_io()
+    if io:
+        # The kernel folds reaped children's I/O into /proc/self/io
+        read_bytes, written_bytes = io.get("read_bytes", 0), io.get("write_bytes", 0)
+    else:
+        # No /proc: fall back to rusage block counts (512-byte blocks)
+        read_bytes = (own.ru_inblock + children.ru_inblock) * 512
+        written_bytes = (own.ru_oublock + children.ru_oublock) * 512
+    return {
+        "wall": time.perf_counter(),
+        "cpu": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        "read": read_bytes,
+        "written": written_bytes,
+        "rss_kb": max(own.ru_maxrss, children.ru_maxrss),
+    }
+
+@contextmanager
+def stage(name):
+    """Time a build stage or subprocess and record it in BUILD_SPANS"""
+    span = {"name": name, "depth": _span_depth[0]}
+    BUILD_SPANS.append(span)
+    before = resource_snapshot()
+    _span_depth[0] += 1
+    try:
+        yield span
+    finally:
+        _span_depth[0] -= 1
+        after = resource_snapshot()
+        span["wall_s"] = round(after["wall"] - before["wall"], 3)
+        span["cpu_s"] = round(after["cpu"] - before["cpu"], 3)
+        span["bytes_read"] = after["read"] - before["read"]
+        span["bytes_written"] = after["written"] - before["written"]
+        span["peak_rss_kb"] = after["rss_kb"]
+
+def print_build_summary():
+    if not BUILD_SPANS:
+        return
+    print("\n==================================================")
+    print("Build stage summary:")
+    print(f"{'Stage':<40} {'Wall':>8} {'CPU':>8} {'Read MB':>9} {'Write MB':>9} {'MB/s':>7}")
+    for span in BUILD_SPANS:
+        if "wall_s" not in span:
+            continue
+        name = ("  " * span["depth"] + span["name"])[:40]
+        moved_mb = (span["bytes_read"] + span["bytes_written"]) / (1024*1024)
+        rate = moved_mb / span["wall_s"] if span["wall_s"] > 0 else 0
+        print(f"{name:<40} {span['wall_s']:>7.1f}s {span['cpu_s']:>7.1f}s "
+              f"{span['bytes_read']/(1024*1024):>9.1f} {span['bytes_written']/(1024*1024):>9.1f} {rate:>7.1f}")
+    peak = max(span.get("peak_rss_kb", 0) for span in BUILD_SPANS)
+    print(f"Peak RSS: {peak/1024:.1f} MB")
+
+def write_build_report(path=BUILD_REPORT_FILE, **extra):
+    report = {"created": int(time.time()), "host": os.uname().nodename, "cpus": os.cpu_count(), "stages": BUILD_SPANS}
+    report.update(extra)
+    try:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Build report written: {path}")
+    except OSError as e:
+        print(f"Warning: Could not write build report: {e}")
+
+BUILD_LOG_FILE = "remaster-build.log"
+LOG_TAIL_LINES = 200
+
+# xorriso pacifier lines, e.g.
+#   xorriso : UPDATE :  43.21% done, estimate finish Mon Oct 19 06:40:12 2026
+#   xorriso : UPDATE : Writing:     123456s   43.2%   fifo 100%  buf  50%   35.2xD
+#   xorriso : UPDATE : 1234 files restored ( 567.8m) in 10 s = 56.7xD
+XORRISO_PERCENT_RE = re.compile(r"UPDATE :.*?(\d+(?:\.\d+)?)%")
+XORRISO_RESTORED_RE = re.compile(r"UPDATE :\s*\d+ files restored \(\s*([\d.]+)([kmgt]?)\)")
+SIZE_SUFFIXES = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+class ProgressBar:
+    """Single-line progress display with ETA and throughput"""
+    def __init__(self, description, total_bytes=0, width=30):
+        self.description = description
+        self.total_bytes = total_bytes
+        self.width = width
+        self.start = time.time()
+        self.shown = False
+
+    def update(self, fraction):
+        fraction = min(max(fraction, 0.0), 1.0)
+        elapsed = time.time() - self.start
+        filled = int(self.width * fraction)
+        line = f"\r{self.description}: [{'#' * filled}{'-' * (self.width - filled)}] {fraction * 100:5.1f}%"
+        if self.total_bytes and elapsed > 0:
+            line += f"  {self.total_bytes * fraction / elapsed / (1024*1024):7.1f} MB/s"
+        if 0 < fraction < 1 and elapsed > 0:
+            line += f"  ETA {format_duration(elapsed / fraction - elapsed)}"
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        self.shown = True
+
+    def finish(self):
+        if self.shown:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+
+def parse_progress(line, total_bytes=0):
+    """Return completed fraction from a xorriso pacifier line, or None"""
+    match = XORRISO_RESTORED_RE.search(line)
+    if match:
+        if not total_bytes:
+            return None
+        done = float(match.group(1)) * SIZE_SUFFIXES[match.group(2)]
+        return done / total_bytes
+    match = XORRISO_PERCENT_RE.search(line)
+    if match:
+        return float(match.group(1)) / 100
+    return None
+
+def run_command(cmd, description="", check=True, total_bytes=0, log_path=BUILD_LOG_FILE):
+    """Run an argv list (strings are split, never passed to a shell) and stream its output.
+
+    stdout and stderr are read line by line: every line goes to log_path, the last
+    LOG_TAIL_LINES are kept in memory for error reports, and xorriso pacifier lines
+    drive a progress bar. total_bytes lets restore progress be shown as a percentage.
+    """
     print(f"{description}...")
+    argv = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+    tail = deque(maxlen=LOG_TAIL_LINES)
+    lock = threading.Lock()
+    bar = ProgressBar(description or argv[0], total_bytes)
+
     try:
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, check=check)
-        if result.returncode != 0:
-            print(result.stderr)
-        return result.returncode == 0
+        with stage(f"$ {description or argv[0]}"), open(log_path, 'a') as log:
+            log.write(f"\n### {time.strftime('%Y-%m-%d %H:%M:%S')} {shlex.join(argv)}\n")
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    stdin=subprocess.DEVNULL, text=True, errors="replace", bufsize=1)
+
+            def pump(stream, tag):
+                for line in stream:
+                    line = line.rstrip("\n")
+                    with lock:
+                        tail.append(line)
+                        log.write(f"{tag} {line}\n")
+                        fraction = parse_progress(line, total_bytes)
+                        if fraction is not None:
+                            bar.update(fraction)
+                stream.close()
+
+            readers = [threading.Thread(target=pump, args=(proc.stdout, "O"), daemon=True),
+                       threading.Thread(target=pump, args=(proc.stderr, "E"), daemon=True)]
+            for reader in readers:
+                reader.start()
+            returncode = proc.wait()
+            for reader in readers:
+                reader.join()
+            log.write(f"### exit status {returncode}\n")
+        bar.finish()
+
+        if returncode != 0:
+            print("\n".join(tail))
+            if check:
+                print(f"✗ Failed: {shlex.join(argv)} exited with status {returncode} (full log: {log_path})")
+        return returncode == 0
     except Exception as e:
+        bar.finish()
         print(f"✗ Failed: {e}")
         return False
 
-def install_system_dependencies():
-    print("Installing system dependencies...")
-    run_command("sudo apt-get update", "Updating package list")
-    run_command("sudo apt-get install -y python3-pip xorriso coreutils binwalk", "Installing python3-pip, xorriso, coreutils (dd), binwalk")
-    print("✓ System dependencies installed")
+CAPABILITY_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "nosana-remaster", "capabilities.json")
+# tool -> (apt package, version argument)
+SYSTEM_TOOLS = {
+    "xorriso": ("xorriso", "-version"),
+    "dd": ("coreutils", "--version"),
+    "fdisk": ("fdisk", "--version"),
+    "gpg": ("gnupg", "--version"),
+    "unsquashfs": ("squashfs-tools", "-version"),
+    "mksquashfs": ("squashfs-tools", "-version"),
+    "zstd": ("zstd", "--version"),
+    "xz": ("xz-utils", "--version"),
+    "lz4": ("lz4", "--version"),
+    "gzip": ("gzip", "--version"),
+}
+# pip package for each module whose import name differs
+PYTHON_PACKAGES = {"yaml": "pyyaml"}
+
+def required_capabilities(need_download=True, sign=False, squashfs=False, seekable=False, config_only=False, autoinstall=False,
+                          codecs=()):
+    tools = ["xorriso", "dd", "fdisk"]
+    if sign:
+        tools.append("gpg")
+    if squashfs:
+        tools += ["unsquashfs", "mksquashfs"]
+    # initrd codecs run as external compressors
+    tools += [name for name in codecs if name not in tools]
+    modules = ["requests", "tqdm"] if need_download else []
+    if seekable:
+        modules.append("zstandard")
+    if autoinstall or config_only:
+        # The autoinstall validator parses the seed documents
+        modules.append("yaml")
+    if config_only:
+        # Rendering or validating seeds needs no ISO tools
+        tools = []
+    return tools, modules
+
+def capability_fingerprint(tools, modules):
+    """Cheap stand-in for tool versions: the path, size and mtime of each binary"""
+    import importlib.util
+    parts = [sys.version]
+    for tool in tools:
+        path = shutil.which(tool)
+        if path:
+            st = os.stat(path)
+            parts.append(f"{tool}={path}:{st.st_size}:{st.st_mtime_ns}")
+        else:
+            parts.append(f"{tool}=missing")
+    for module in modules:
+        spec = importlib.util.find_spec(module)
+        parts.append(f"{module}={spec.origin if spec else 'missing'}")
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+def probe_capabilities(tools, modules):
+    """Check which tools and modules are present, reusing the cached probe when nothing changed"""
+    fingerprint = capability_fingerprint(tools, modules)
+    try:
+        with open(CAPABILITY_CACHE_FILE, 'r') as f:
+            cached = json.load(f)
+        if cached.get("fingerprint") == fingerprint:
+            return cached
+    except (OSError, ValueError):
+        pass
+
+    import importlib.util
+    result = {"fingerprint": fingerprint, "tools": {}, "modules": {}}
+    for tool in tools:
+        path = shutil.which(tool)
+        version = None
+        if path:
+            try:
+                out = subprocess.run([path, SYSTEM_TOOLS[tool][1]], capture_output=True, text=True, timeout=10)
+                lines = (out.stdout or out.stderr).splitlines()
+                version = lines[0].strip() if lines else ""
+            except (OSError, subprocess.TimeoutExpired):
+                path = None
+        result["tools"][tool] = {"path": path, "version": version}
+    for module in modules:
+        result["modules"][module] = importlib.util.find_spec(module) is not None
 
-def install_python_dependency(package_name):
+    missing_tools = [t for t, info in result["tools"].items() if not info["path"]]
+    missing_modules = [m for m, present in result["modules"].items() if not present]
+    if not missing_tools and not missing_modules:
+        try:
+            os.makedirs(os.path.dirname(CAPABILITY_CACHE_FILE), exist_ok=True)
+            with open(CAPABILITY_CACHE_FILE, 'w') as f:
+                json.dump(result, f, indent=2)
+        except OSError:
+            pass
+    return result
+
+def install_system_dependencies(packages):
+    print(f"Installing system packages: {', '.join(packages)}")
+    if run_command(["sudo", "apt-get", "install", "-y"] + packages, "Installing system packages", check=False):
+        return True
+    # Package lists may be stale on a fresh host; refresh once and retry
+    run_command(["sudo", "apt-get", "update"], "Updating package list", check=False)
+    return run_command(["sudo", "apt-get", "install", "-y"] + packages, "Installing system packages")
+
+def install_python_dependency(package_names):
+    if isinstance(package_names, str):
+        package_names = [package_names]
+    names = " ".join(package_names)
     for cmd in [
-        f"pip3 install {package_name}",
-        f"pip install {package_name}",
-        f"pip3 install --user {package_name}",
-        f"sudo pip3 install {package_name}",
-        f"python3 -m pip install {package_name}",
-        f"python3 -m pip install --user {package_name}"
+        f"{sys.executable} -m pip install --user {names}",
+        f"{sys.executable} -m pip install {names}",
+        f"pip3 install --user {names}",
+        f"sudo pip3 install {names}",
     ]:
-        if run_command(cmd, f"Installing {package_name}"):
+        if run_command(cmd, f"Installing {names}", check=False):
             return True
     return False
 
-def check_and_install_dependencies():
+def check_and_install_dependencies(need_download=True, sign=False, squashfs=False, seekable=False, config_only=False, autoinstall=False,
+                                   codecs=()):
     print("Checking dependencies...")
-    install_system_dependencies()
-    for module in ["requests", "tqdm"]:
-        try:
-            __import__(module)
-            print(f"✓ {module} already installed")
-        except ImportError:
-            print(f"Installing {module}...")
-            if not install_python_dependency(module):
-                print(f"✗ Failed to install {module}")
-                return False
+    tools, modules = required_capabilities(need_download, sign, squashfs, seekable, config_only, autoinstall, codecs)
+    caps = probe_capabilities(tools, modules)
+    missing_tools = [t for t, info in caps["tools"].items() if not info["path"]]
+    missing_modules = [m for m, present in caps["modules"].items() if not present]
+
+    if not missing_tools and not missing_modules:
+        print("✓ All dependencies present: " + ", ".join(
+            f"{tool} ({info['version']})" if tool == "xorriso" else tool for tool, info in caps["tools"].items()))
+        return True
+
+    packages = sorted({SYSTEM_TOOLS[tool][0] for tool in missing_tools})
+    if missing_modules and not shutil.which("pip3") and not subprocess.run(
+            [sys.executable, "-m", "pip", "--version"], capture_output=True).returncode == 0:
+        packages.append("python3-pip")
+        # pip has to land before the module installs can start
+        if not install_system_dependencies(packages):
+            print(f"✗ Failed to install {', '.join(packages)}")
+            return False
+        packages = []
+
+    # apt and pip don't share locks, so run them side by side
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        apt_job = pool.submit(install_system_dependencies, packages) if packages else None
+        pip_job = pool.submit(install_python_dependency, [PYTHON_PACKAGES.get(m, m) for m in missing_modules]) if missing_modules else None
+        if apt_job and not apt_job.result():
+            print(f"✗ Failed to install {', '.join(packages)}")
+            return False
+        if pip_job and not pip_job.result():
+            print(f"✗ Failed to install {', '.join(missing_modules)}")
+            return False
+
+    caps = probe_capabilities(tools, modules)
+    still_missing = [t for t, info in caps["tools"].items() if not info["path"]]
+    still_missing += [m for m, present in caps["modules"].items() if not present]
+    if still_missing:
+        print(f"✗ Still missing after install: {', '.join(still_missing)}")
+        return False
     print("All dependencies ready!")
     return True
 
@@ -132,16 +449,47 @@ def check_file_exists(filename, min_size_mb=100):
     return False
 
 def force_unmount(path):
-    if os.path.exists(path):
-        for cmd in [
-            f"sudo umount -l {path}",
-            f"sudo umount -f {path}",
-            f"sudo umount {path}",
-            f"umount -l {path}",
-            f"umount -f {path}",
-            f"umount {path}"
-        ]:
-            subprocess.run(cmd, shell=True, capture_output=True)
+    """Lazily unmount a mount left behind by an older run, if there is one"""
+    if not os.path.exists(path) or find_mount(path)[0] != os.path.realpath(path):
+        return True
+    return subprocess.run(["sudo", "umount", "-l", path], capture_output=True).returncode == 0
+
+# Mount, then stream the requested files out as a tar; the namespace (and with it
+# the mount and its autoclear loop device) disappears when the shell exits.
+NAMESPACE_READ_SCRIPT = 'image="$0"; target="$1"; shift; mount -o loop,ro "$image" "$target" && cd "$target" && tar -cf - --ignore-failed-read -- "$@" 2>/dev/null; true'
+
+def namespace_commands():
+    unshare = ["unshare", "--mount", "--propagation", "private"]
+    if os.geteuid() == 0:
+        return [unshare]
+    # Unprivileged first; most kernels refuse loop mounts in a user namespace, so fall back to sudo
+    return [["unshare", "--user", "--map-root-user", "--mount", "--propagation", "private"],
+            ["sudo"] + unshare]
+
+def read_files_from_image(image, paths):
+    """Loop-mount image in a private mount namespace and return {path: bytes} for the files found"""
+    import tarfile
+    import tempfile
+    import io
+    mount_point = tempfile.mkdtemp(prefix="nosana-mnt-")
+    try:
+        for prefix in namespace_commands():
+            argv = prefix + ["sh", "-c", NAMESPACE_READ_SCRIPT, os.path.abspath(image), mount_point] + [p.lstrip("/") for p in paths]
+            try:
+                result = subprocess.run(argv, capture_output=True, stdin=subprocess.DEVNULL)
+            except OSError:
+                continue
+            if not result.stdout:
+                continue
+            found = {}
+            with tarfile.open(fileobj=io.BytesIO(result.stdout)) as tar:
+                for member in tar.getmembers():
+                    if member.isfile():
+                        found["/" + member.name] = tar.extractfile(member).read()
+            return found
+        return {}
+    finally:
+        os.rmdir(mount_point)
 
 def cleanup(temp_paths):
     print("Cleaning up temporary files...")
@@ -168,74 +516,1185 @@ def ensure_clean_dir(path):
         subprocess.run(f"rm -rf {path}", shell=True)
     os.makedirs(path, exist_ok=True)
 
-def inject_autoinstall_files(work_dir):
-    print("Injecting autoinstall configuration...")
-    
-    # Create server directory for autoinstall files
-    server_dir = os.path.join(work_dir, "server")
-    os.makedirs(server_dir, exist_ok=True)
-    
-    # Create user-data file
-    user_data_dst = os.path.join(server_dir, "user-data")
-    with open(user_data_dst, 'w') as f:
-        f.write(AUTOINSTALL_USER_DATA)
-    print(f"Created: {user_data_dst}")
-    
-    # Create meta-data file
-    meta_data_dst = os.path.join(server_dir, "meta-data")
-    with open(meta_data_dst, 'w') as f:
-        f.write(AUTOINSTALL_META_DATA)
-    print(f"Created: {meta_data_dst}")
-    
-    # Create vendor-data file (sometimes required)
-    vendor_data_dst = os.path.join(server_dir, "vendor-data")
-    with open(vendor_data_dst, 'w') as f:
-        f.write("{}\n")
-    print(f"Created: {vendor_data_dst}")
-    
-    # Create network-data file (sometimes required for cloud-init)
-    network_data_dst = os.path.join(server_dir, "network-data")
-    with open(network_data_dst, 'w') as f:
-        f.write("version: 2\n")
-    print(f"Created: {network_data_dst}")
-    
-    # Also create autoinstall files in the root directory (alternative location)
-    root_user_data = os.path.join(work_dir, "user-data")
-    with open(root_user_data, 'w') as f:
-        f.write(AUTOINSTALL_USER_DATA)
-    print(f"Created: {root_user_data}")
-    
-    root_meta_data = os.path.join(work_dir, "meta-data")
-    with open(root_meta_data, 'w') as f:
-        f.write(AUTOINSTALL_META_DATA)
-    print(f"Created: {root_meta_data}")
-    
-    # Create additional files in root for maximum compatibility
-    root_vendor_data = os.path.join(work_dir, "vendor-data")
-    with open(root_vendor_data, 'w') as f:
-        f.write("{}\n")
-    print(f"Created: {root_vendor_data}")
-    
-    root_network_data = os.path.join(work_dir, "network-data")
-    with open(root_network_data, 'w') as f:
-        f.write("version: 2\n")
-    print(f"Created: {root_network_data}")
-    
-    # Create autoinstall.yaml file (alternative format)
-    autoinstall_yaml = os.path.join(work_dir, "autoinstall.yaml")
-    with open(autoinstall_yaml, 'w') as f:
-        f.write(AUTOINSTALL_USER_DATA.replace("#cloud-config\n", ""))
-    print(f"Created: {autoinstall_yaml}")
-    
-    # Create autoinstall.yml file (another alternative)
-    autoinstall_yml = os.path.join(work_dir, "autoinstall.yml")
-    with open(autoinstall_yml, 'w') as f:
-        f.write(AUTOINSTALL_USER_DATA.replace("#cloud-config\n", ""))
-    print(f"Created: {autoinstall_yml}")
-    
-    # Create a post-install cleanup script for manual execution
-    cleanup_script = os.path.join(work_dir, "cleanup-minimal.sh")
-    cleanup_content = """#!/bin/bash
+def source_date_epoch():
+    """SOURCE_DATE_EPOCH as an int, or None when unset; fixes every timestamp a build writes"""
+    value = os.environ.get("SOURCE_DATE_EPOCH")
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Ignoring invalid SOURCE_DATE_EPOCH={value!r}")
+        return None
+
+class FatError(Exception):
+    pass
+
+FAT_ATTR_DIRECTORY = 0x10
+FAT_ATTR_VOLUME_ID = 0x08
+FAT_ATTR_ARCHIVE = 0x20
+FAT_ATTR_LFN = 0x0F
+FAT_SHORT_NAME_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+FAT_MAX_CLUSTERS = {12: 4084, 16: 65524, 32: 0x0FFFFFF5}
+FAT_EOC = {12: 0xFFF, 16: 0xFFFF, 32: 0x0FFFFFFF}
+
+def fat_timestamp(when=None):
+    """Return (time, date) words in FAT encoding"""
+    # Fixed timestamps are encoded in UTC so the image bytes don't depend on TZ
+    t = time.localtime() if when is None else time.gmtime(when)
+    year = min(max(t.tm_year, 1980), 2107)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def lfn_checksum(short_name):
+    total = 0
+    for byte in short_name:
+        total = (((total & 1) << 7) + (total >> 1) + byte) & 0xFF
+    return total
+
+class FatImage:
+    """FAT12/16/32 filesystem image edited in place through mmap.
+
+    Supports listing, reading, writing (add or replace), removing files and
+    creating directories, with long file names. When the image runs out of
+    clusters it is grown, enlarging the FATs and shifting the data area if needed.
+    """
+    def __init__(self, path, timestamp=None):
+        self.path = path
+        self.timestamp = timestamp if timestamp is not None else source_date_epoch()
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self._parse_geometry()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+
+    def _u16(self, offset):
+        return int.from_bytes(self.mm[offset:offset + 2], "little")
+
+    def _u32(self, offset):
+        return int.from_bytes(self.mm[offset:offset + 4], "little")
+
+    def _put(self, offset, value, size):
+        self.mm[offset:offset + size] = value.to_bytes(size, "little")
+
+    def _parse_geometry(self):
+        if len(self.mm) < 512 or self.mm[510:512] != b"\x55\xaa":
+            raise FatError(f"{self.path}: no FAT boot sector")
+        self.bytes_per_sector = self._u16(11)
+        self.sectors_per_cluster = self.mm[13]
+        self.reserved_sectors = self._u16(14)
+        self.fat_count = self.mm[16]
+        self.root_entry_count = self._u16(17)
+        self.fat_size = self._u16(22) or self._u32(36)
+        self.total_sectors = self._u16(19) or self._u32(32)
+        if not self.bytes_per_sector or not self.sectors_per_cluster or not self.fat_count or not self.fat_size:
+            raise FatError(f"{self.path}: invalid BIOS parameter block")
+        self.root_dir_sectors = (self.root_entry_count * 32 + self.bytes_per_sector - 1) // self.bytes_per_sector
+        self.first_data_sector = self.reserved_sectors + self.fat_count * self.fat_size + self.root_dir_sectors
+        self.cluster_count = (self.total_sectors - self.first_data_sector) // self.sectors_per_cluster
+        self.cluster_bytes = self.sectors_per_cluster * self.bytes_per_sector
+        if self.cluster_count <= FAT_MAX_CLUSTERS[12]:
+            self.fat_bits = 12
+        elif self.cluster_count <= FAT_MAX_CLUSTERS[16]:
+            self.fat_bits = 16
+        else:
+            self.fat_bits = 32
+        self.root_cluster = self._u32(44) if self.fat_bits == 32 else None
+
+    # --- allocation table -------------------------------------------------
+
+    def _fat_offset(self, copy=0):
+        return (self.reserved_sectors + copy * self.fat_size) * self.bytes_per_sector
+
+    def get_fat(self, cluster):
+        base = self._fat_offset()
+        if self.fat_bits == 12:
+            value = self._u16(base + cluster + cluster // 2)
+            return value >> 4 if cluster & 1 else value & 0xFFF
+        if self.fat_bits == 16:
+            return self._u16(base + cluster * 2)
+        return self._u32(base + cluster * 4) & 0x0FFFFFFF
+
+    def set_fat(self, cluster, value):
+        for copy in range(self.fat_count):
+            base = self._fat_offset(copy)
+            if self.fat_bits == 12:
+                offset = base + cluster + cluster // 2
+                old = self._u16(offset)
+                new = (old & 0x000F) | (value << 4) if cluster & 1 else (old & 0xF000) | value
+                self._put(offset, new, 2)
+            elif self.fat_bits == 16:
+                self._put(base + cluster * 2, value, 2)
+            else:
+                offset = base + cluster * 4
+                self._put(offset, (self._u32(offset) & 0xF0000000) | value, 4)
+
+    def is_eoc(self, value):
+        return value >= FAT_EOC[self.fat_bits] - 7
+
+    def chain(self, cluster):
+        clusters, seen = [], set()
+        while 2 <= cluster < self.cluster_count + 2 and cluster not in seen:
+            clusters.append(cluster)
+            seen.add(cluster)
+            cluster = self.get_fat(cluster)
+            if self.is_eoc(cluster):
+                break
+        return clusters
+
+    def free_chain(self, cluster):
+        for c in self.chain(cluster):
+            self.set_fat(c, 0)
+
+    def free_clusters(self):
+        return [c for c in range(2, self.cluster_count + 2) if self.get_fat(c) == 0]
+
+    def allocate(self, count):
+        """Allocate and link count zeroed clusters, growing the image if needed"""
+        if count <= 0:
+            return []
+        free = self.free_clusters()
+        if len(free) < count:
+            self.grow(count - len(free))
+            free = self.free_clusters()
+        clusters = free[:count]
+        for current, following in zip(clusters, clusters[1:] + [None]):
+            self.set_fat(current, following if following else FAT_EOC[self.fat_bits])
+        for c in clusters:
+            offset = self.cluster_offset(c)
+            self.mm[offset:offset + self.cluster_bytes] = bytes(self.cluster_bytes)
+        self._invalidate_fsinfo()
+        return clusters
+
+    def _invalidate_fsinfo(self):
+        if self.fat_bits == 32:
+            fsinfo = self._u16(48) * self.bytes_per_sector
+            if fsinfo and self.mm[fsinfo:fsinfo + 4] == b"RRaA":
+                self._put(fsinfo + 488, 0xFFFFFFFF, 4)
+                self._put(fsinfo + 492, 0xFFFFFFFF, 4)
+
+    def cluster_offset(self, cluster):
+        return (self.first_data_sector + (cluster - 2) * self.sectors_per_cluster) * self.bytes_per_sector
+
+    def grow(self, extra_clusters):
+        """Add at least extra_clusters to the filesystem, enlarging the FATs if they are full.
+
+        A FAT12 volume that outgrows 4084 clusters is converted to FAT16 in place;
+        cluster numbers and the fixed root directory stay where they are.
+        """
+        new_bits = self.fat_bits
+        new_count = self.cluster_count + extra_clusters + max(16, self.cluster_count // 10)
+        if new_count > FAT_MAX_CLUSTERS[new_bits]:
+            if new_bits == 12:
+                new_bits = 16
+            else:
+                new_count = self.cluster_count + extra_clusters
+        if new_count > FAT_MAX_CLUSTERS[new_bits]:
+            raise FatError(f"{self.path}: FAT{new_bits} cannot hold {new_count} clusters")
+        bps = self.bytes_per_sector
+        needed_fat = ((new_count + 2) * new_bits + bps * 8 - 1) // (bps * 8)
+        new_fat_size = max(self.fat_size, needed_fat)
+        old_region = (self.reserved_sectors + self.fat_count * self.fat_size) * bps
+        new_region = (self.reserved_sectors + self.fat_count * new_fat_size) * bps
+        region_len = (self.root_dir_sectors + self.cluster_count * self.sectors_per_cluster) * bps
+        new_total = (new_region // bps) + self.root_dir_sectors + new_count * self.sectors_per_cluster
+        if new_bits != self.fat_bits:
+            # Re-encode every entry as 16 bits; reserved, bad and end-of-chain values keep their meaning
+            entries = (self.get_fat(c) for c in range(self.cluster_count + 2))
+            fat_bytes = b"".join((v | 0xF000 if v >= 0xFF7 else v).to_bytes(2, "little") for v in entries)
+            fat_bytes += bytes(-len(fat_bytes) % bps)
+            if self.mm[38] == 0x29:
+                self.mm[54:62] = b"FAT16   "
+        else:
+            fat_bytes = self.mm[self._fat_offset():self._fat_offset() + self.fat_size * bps]
+        old_fat_size = len(fat_bytes) // bps
+
+        self.mm.flush()
+        self.mm.close()
+        if new_total * bps > os.path.getsize(self.path):
+            self.file.truncate(new_total * bps)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        if new_region != old_region:
+            self.mm.move(new_region, old_region, region_len)
+        if new_region != old_region or new_bits != self.fat_bits:
+            for copy in range(self.fat_count):
+                start = (self.reserved_sectors + copy * new_fat_size) * bps
+                self.mm[start:start + new_fat_size * bps] = fat_bytes + bytes((new_fat_size - old_fat_size) * bps)
+        tail = new_region + region_len
+        self.mm[tail:new_total * bps] = bytes(new_total * bps - tail)
+
+        if self.fat_bits == 32:
+            self._put(36, new_fat_size, 4)
+        else:
+            self._put(22, new_fat_size, 2)
+        if new_total < 0x10000 and self._u16(19):
+            self._put(19, new_total, 2)
+        else:
+            self._put(19, 0, 2)
+            self._put(32, new_total, 4)
+        if self.fat_bits == 32 and self._u16(50):
+            backup = self._u16(50) * bps
+            self.mm[backup:backup + bps] = self.mm[0:bps]
+        self._parse_geometry()
+        self._invalidate_fsinfo()
+
+    # --- directories ------------------------------------------------------
+
+    def _dir_slots(self, dir_cluster):
+        """Absolute offsets of every 32-byte slot of a directory (None = fixed root)"""
+        if dir_cluster is None:
+            start = (self.reserved_sectors + self.fat_count * self.fat_size) * self.bytes_per_sector
+            return list(range(start, start + self.root_entry_count * 32, 32))
+        slots = []
+        for c in self.chain(dir_cluster):
+            offset = self.cluster_offset(c)
+            slots.extend(range(offset, offset + self.cluster_bytes, 32))
+        return slots
+
+    def _root(self):
+        return self.root_cluster if self.fat_bits == 32 else None
+
+    def _entries(self, dir_cluster):
+        entries = []
+        lfn_parts = []
+        slots = self._dir_slots(dir_cluster)
+        for index, offset in enumerate(slots):
+            raw = self.mm[offset:offset + 32]
+            if raw[0] == 0x00:
+                break
+            if raw[0] == 0xE5:
+                lfn_parts = []
+                continue
+            if raw[11] == FAT_ATTR_LFN:
+                chars = raw[1:11] + raw[14:26] + raw[28:32]
+                lfn_parts.append((index, chars.decode("utf-16-le", "replace")))
+                continue
+            if raw[11] & FAT_ATTR_VOLUME_ID:
+                lfn_parts = []
+                continue
+            base, ext = raw[0:8].decode("ascii", "replace").rstrip(), raw[8:11].decode("ascii", "replace").rstrip()
+            if raw[12] & 0x08:
+                base = base.lower()
+            if raw[12] & 0x10:
+                ext = ext.lower()
+            name = base + ("." + ext if ext else "")
+            if lfn_parts and lfn_checksum(raw[0:11]) == self.mm[slots[lfn_parts[-1][0]] + 13]:
+                name = "".join(part for _, part in reversed(lfn_parts)).split("\x00")[0]
+                first_slot = lfn_parts[0][0]
+            else:
+                first_slot = index
+            lfn_parts = []
+            if name in (".", ".."):
+                continue
+            entries.append({
+                "name": name,
+                "short": bytes(raw[0:11]),
+                "is_dir": bool(raw[11] & FAT_ATTR_DIRECTORY),
+                "cluster": (self._u16(offset + 20) << 16) | self._u16(offset + 26),
+                "size": self._u32(offset + 28),
+                "slots": [slots[i] for i in range(first_slot, index + 1)],
+            })
+        return entries
+
+    def _find(self, dir_cluster, name):
+        for entry in self._entries(dir_cluster):
+            if entry["name"].upper() == name.upper():
+                return entry
+        return None
+
+    def _resolve_dir(self, parts, create=False):
+        dir_cluster = self._root()
+        for part in parts:
+            entry = self._find(dir_cluster, part)
+            if entry is None:
+                if not create:
+                    raise FatError(f"{part}: no such directory")
+                entry = self._mkdir_in(dir_cluster, part)
+            elif not entry["is_dir"]:
+                raise FatError(f"{part}: not a directory")
+            dir_cluster = entry["cluster"] or self._root()
+        return dir_cluster
+
+    @staticmethod
+    def _split(path):
+        return [p for p in path.replace("\\", "/").split("/") if p]
+
+    def _short_name(self, dir_cluster, name):
+        """Return (11-byte short name, needs_lfn)"""
+        base, _, ext = name.rpartition(".") if "." in name.lstrip(".") else (name, "", "")
+        # Like Linux vfat (shortname=mixed), anything not already upper case gets a long name
+        if 0 < len(base) <= 8 and len(ext) <= 3 and all(c in FAT_SHORT_NAME_CHARS for c in base + ext):
+            return (base.ljust(8) + ext.ljust(3)).encode("ascii"), False
+        clean = lambda s: "".join(c for c in s.upper() if c in FAT_SHORT_NAME_CHARS)
+        base_clean, ext_clean = clean(base) or "FILE", clean(ext)[:3]
+        taken = {entry["short"] for entry in self._entries(dir_cluster)}
+        for n in range(1, 1000000):
+            tail = f"~{n}"
+            short = (base_clean[:8 - len(tail)] + tail).ljust(8) + ext_clean.ljust(3)
+            if short.encode("ascii") not in taken:
+                return short.encode("ascii"), True
+        raise FatError(f"{name}: no free short name")
+
+    def _free_run(self, dir_cluster, count):
+        """Find count consecutive free slots, extending the directory if necessary"""
+        while True:
+            slots = self._dir_slots(dir_cluster)
+            run = []
+            for offset in slots:
+                if self.mm[offset] in (0x00, 0xE5):
+                    run.append(offset)
+                    if len(run) == count:
+                        return run
+                else:
+                    run = []
+            if dir_cluster is None:
+                raise FatError("root directory is full")
+            last = self.chain(dir_cluster)[-1]
+            new = self.allocate(1)[0]
+            self.set_fat(last, new)
+
+    def _write_entry(self, dir_cluster, name, attr, cluster, size):
+        short, needs_lfn = self._short_name(dir_cluster, name)
+        lfn_entries = []
+        if needs_lfn:
+            encoded = name.encode("utf-16-le")
+            chunks = [encoded[i:i + 26] for i in range(0, len(encoded), 26)]
+            if len(chunks[-1]) < 26:
+                chunks[-1] = (chunks[-1] + b"\x00\x00").ljust(26, b"\xff")
+            checksum = lfn_checksum(short)
+            for seq, chunk in enumerate(chunks, 1):
+                entry = bytearray(32)
+                entry[0] = seq | (0x40 if seq == len(chunks) else 0)
+                entry[1:11], entry[14:26], entry[28:32] = chunk[0:10], chunk[10:22], chunk[22:26]
+                entry[11] = FAT_ATTR_LFN
+                entry[13] = checksum
+                lfn_entries.insert(0, bytes(entry))
+        stamp_time, stamp_date = fat_timestamp(self.timestamp)
+        entry = bytearray(32)
+        entry[0:11] = short
+        entry[11] = attr
+        for offset, value in ((14, stamp_time), (16, stamp_date), (18, stamp_date), (22, stamp_time), (24, stamp_date)):
+            entry[offset:offset + 2] = value.to_bytes(2, "little")
+        entry[20:22] = (cluster >> 16).to_bytes(2, "little")
+        entry[26:28] = (cluster & 0xFFFF).to_bytes(2, "little")
+        entry[28:32] = size.to_bytes(4, "little")
+        slots = self._free_run(dir_cluster, len(lfn_entries) + 1)
+        for offset, data in zip(slots, lfn_entries + [bytes(entry)]):
+            self.mm[offset:offset + 32] = data
+
+    def _mkdir_in(self, dir_cluster, name):
+        cluster = self.allocate(1)[0]
+        offset = self.cluster_offset(cluster)
+        stamp_time, stamp_date = fat_timestamp(self.timestamp)
+        parent = 0 if dir_cluster is None or dir_cluster == self.root_cluster else dir_cluster
+        for index, (dot_name, target) in enumerate(((b".          ", cluster), (b"..         ", parent))):
+            entry = bytearray(32)
+            entry[0:11] = dot_name
+            entry[11] = FAT_ATTR_DIRECTORY
+            entry[22:24], entry[24:26] = stamp_time.to_bytes(2, "little"), stamp_date.to_bytes(2, "little")
+            entry[20:22] = (target >> 16).to_bytes(2, "little")
+            entry[26:28] = (target & 0xFFFF).to_bytes(2, "little")
+            self.mm[offset + index * 32:offset + index * 32 + 32] = bytes(entry)
+        self._write_entry(dir_cluster, name, FAT_ATTR_DIRECTORY, cluster, 0)
+        return self._find(dir_cluster, name)
+
+    # --- public API -------------------------------------------------------
+
+    def list(self, path="/"):
+        """Return [(name, is_dir, size)] for a directory"""
+        dir_cluster = self._resolve_dir(self._split(path))
+        return [(e["name"], e["is_dir"], e["size"]) for e in self._entries(dir_cluster)]
+
+    def exists(self, path):
+        parts = self._split(path)
+        try:
+            return self._find(self._resolve_dir(parts[:-1]), parts[-1]) is not None
+        except FatError:
+            return False
+
+    def read(self, path):
+        parts = self._split(path)
+        entry = self._find(self._resolve_dir(parts[:-1]), parts[-1])
+        if entry is None or entry["is_dir"]:
+            raise FatError(f"{path}: no such file")
+        data = bytearray()
+        for c in self.chain(entry["cluster"]):
+            offset = self.cluster_offset(c)
+            data += self.mm[offset:offset + self.cluster_bytes]
+        return bytes(data[:entry["size"]])
+
+    def mkdir(self, path):
+        self._resolve_dir(self._split(path), create=True)
+
+    def remove(self, path):
+        parts = self._split(path)
+        entry = self._find(self._resolve_dir(parts[:-1]), parts[-1])
+        if entry is None:
+            return False
+        if entry["is_dir"] and self._entries(entry["cluster"]):
+            raise FatError(f"{path}: directory not empty")
+        if entry["cluster"]:
+            self.free_chain(entry["cluster"])
+        for offset in entry["slots"]:
+            self.mm[offset] = 0xE5
+        return True
+
+    def write(self, path, data):
+        """Add or replace a file, creating parent directories as needed"""
+        parts = self._split(path)
+        if not parts:
+            raise FatError("empty path")
+        dir_cluster = self._resolve_dir(parts[:-1], create=True)
+        existing = self._find(dir_cluster, parts[-1])
+        if existing is not None:
+            if existing["is_dir"]:
+                raise FatError(f"{path}: is a directory")
+            self.remove(path)
+        clusters = self.allocate((len(data) + self.cluster_bytes - 1) // self.cluster_bytes)
+        for index, c in enumerate(clusters):
+            chunk = data[index * self.cluster_bytes:(index + 1) * self.cluster_bytes]
+            offset = self.cluster_offset(c)
+            self.mm[offset:offset + len(chunk)] = chunk
+        # allocate() may have grown the image and moved the directories
+        dir_cluster = self._resolve_dir(parts[:-1])
+        self._write_entry(dir_cluster, parts[-1], FAT_ATTR_ARCHIVE, clusters[0] if clusters else 0, len(data))
+
+def make_fat_image(path, size_bytes, label="ESP", timestamp=None):
+    """Create an empty FAT12/16 image of size_bytes, the way mkfs.vfat would for an ESP"""
+    bps, reserved, fat_count, root_entries = 512, 1, 2, 512
+    total = size_bytes // bps
+    root_sectors = root_entries * 32 // bps
+    # Like mkfs.vfat: 2 KiB clusters, the smallest FAT type that can address them,
+    # and larger clusters only once FAT16 runs out
+    for spc in (4, 8, 16, 32, 64):
+        for bits in (12, 16):
+            estimate = (total - reserved - root_sectors) // spc
+            fat_size = ((estimate + 2) * bits + bps * 8 - 1) // (bps * 8)
+            clusters = (total - reserved - fat_count * fat_size - root_sectors) // spc
+            if 0 < clusters <= FAT_MAX_CLUSTERS[bits] and (bits == 12 or clusters > FAT_MAX_CLUSTERS[12]):
+                break
+        else:
+            continue
+        break
+    else:
+        raise FatError(f"{size_bytes} bytes is out of range for FAT12/16")
+
+    boot = bytearray(bps)
+    boot[0:3] = b"\xeb\x3c\x90"
+    boot[3:11] = b"NOSANAOS"
+    boot[11:13] = bps.to_bytes(2, "little")
+    boot[13] = spc
+    boot[14:16] = reserved.to_bytes(2, "little")
+    boot[16] = fat_count
+    boot[17:19] = root_entries.to_bytes(2, "little")
+    if total < 0x10000:
+        boot[19:21] = total.to_bytes(2, "little")
+    else:
+        boot[32:36] = total.to_bytes(4, "little")
+    boot[21] = 0xF8
+    boot[22:24] = fat_size.to_bytes(2, "little")
+    boot[24:26] = (32).to_bytes(2, "little")
+    boot[26:28] = (64).to_bytes(2, "little")
+    boot[36] = 0x80
+    boot[38] = 0x29
+    if timestamp is None:
+        timestamp = source_date_epoch()
+    seed = int(timestamp if timestamp is not None else time.time())
+    boot[39:43] = (seed & 0xFFFFFFFF).to_bytes(4, "little")
+    boot[43:54] = label.upper().encode("ascii")[:11].ljust(11)
+    boot[54:62] = f"FAT{bits}".encode("ascii").ljust(8)
+    boot[510:512] = b"\x55\xaa"
+
+    fat = bytearray(fat_size * bps)
+    if bits == 12:
+        fat[0:3] = b"\xf8\xff\xff"
+    else:
+        fat[0:4] = b"\xf8\xff\xff\xff"
+    with open(path, 'wb') as f:
+        f.write(boot)
+        f.write(bytes((reserved - 1) * bps))
+        for _ in range(fat_count):
+            f.write(fat)
+        f.truncate(total * bps)
+
+FLEET_INDEX_FILE = ".fleet-index.json"
+FLEET_CHUNK_ROWS = 256
+FLEET_DOCUMENTS = ("user-data", "meta-data", "network-config")
+HOSTNAME_RE = re.compile(r"^(?!-)[a-z0-9-]{1,63}(?<!-)$")
+SSH_KEY_PREFIXES = ("ssh-", "ecdsa-", "sk-ssh-", "sk-ecdsa-")
+INSTANCE_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,127}$")
+
+def load_fleet_manifest(path):
+    """Read fleet rows from CSV (header row) or a JSON list of objects"""
+    import csv
+    with open(path, 'r', newline='') as f:
+        if path.endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    return [{k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k} for row in rows]
+
+def validate_fleet_row(row, number):
+    """Check one manifest row and return (node, errors); node holds normalized values"""
+    import ipaddress
+    errors = []
+
+    def text(field, default=""):
+        # JSON manifests can carry numbers, lists or objects where a string belongs
+        value = row.get(field)
+        if value is not None and not isinstance(value, str):
+            errors.append(f"row {number}: {field} must be a string, not {type(value).__name__}")
+            return None
+        return value or default
+
+    hostname = text("hostname")
+    if hostname is not None:
+        hostname = hostname.lower()
+        if not HOSTNAME_RE.match(hostname):
+            errors.append(f"row {number}: invalid hostname {row.get('hostname')!r}")
+    gpu_driver = text("gpu_driver", "auto")
+    node = {"hostname": hostname or "", "instance_id": text("instance_id", f"nosana-{hostname}"),
+            "interface": text("interface") or "", "gpu_driver": gpu_driver.lower() if gpu_driver else "auto"}
+    if node["instance_id"] is not None and not INSTANCE_ID_RE.match(node["instance_id"]):
+        errors.append(f"row {number}: {hostname}: invalid instance_id {node['instance_id']!r}")
+
+    keys = row.get("ssh_keys") or []
+    if isinstance(keys, str):
+        keys = [k.strip() for k in keys.split(";") if k.strip()]
+    elif not isinstance(keys, list):
+        errors.append(f"row {number}: {hostname}: ssh_keys must be a ;-separated string or a list")
+        keys = []
+    for key in keys:
+        if not isinstance(key, str):
+            errors.append(f"row {number}: {hostname}: ssh_keys entries must be strings, not {type(key).__name__}")
+        elif not key.startswith(SSH_KEY_PREFIXES):
+            errors.append(f"row {number}: {hostname}: not an SSH public key: {key[:30]}...")
+    node["ssh_keys"] = keys
+
+    node["address"] = None
+    if row.get("address"):
+        try:
+            address = ipaddress.ip_interface(row["address"])
+            if address.network.prefixlen == address.max_prefixlen:
+                raise ValueError("address needs a prefix length, e.g. 10.0.0.5/24")
+            node["address"] = str(address)
+            gateway = ipaddress.ip_address(row.get("gateway") or "")
+            if gateway not in address.network:
+                errors.append(f"row {number}: {hostname}: gateway {gateway} is outside {address.network}")
+            node["gateway"] = str(gateway)
+            dns = row.get("dns") or []
+            dns = dns.split(";") if isinstance(dns, str) else dns
+            if not isinstance(dns, list) or not all(isinstance(d, str) for d in dns):
+                raise ValueError("dns must be a ;-separated string or a list of strings")
+            node["dns"] = [str(ipaddress.ip_address(d.strip())) for d in dns if d.strip()]
+        except ValueError as e:
+            errors.append(f"row {number}: {hostname}: {e}")
+    return node, errors
+
+def fleet_network_config(node):
+    if not node["address"]:
+        return {"version": 2, "ethernets": {"primary": {"match": {"name": node["interface"] or "en*"}, "dhcp4": True}}}
+    ethernet = {"addresses": [node["address"]], "routes": [{"to": "default", "via": node["gateway"]}]}
+    if node["dns"]:
+        ethernet["nameservers"] = {"addresses": node["dns"]}
+    if node["interface"]:
+        return {"version": 2, "ethernets": {node["interface"]: ethernet}}
+    return {"version": 2, "ethernets": {"primary": dict(ethernet, match={"name": "en*"})}}
+
+def render_fleet_node(base, node):
+    """Render one node's seed documents from the parsed base user-data.
+
+    Documents are written as JSON, which is valid YAML for cloud-init and
+    subiquity and much cheaper to emit than a YAML dump.
+    """
+    autoinstall = dict(base["autoinstall"])
+    network = fleet_network_config(node)
+    if node["address"]:
+        # A static address is decided by the manifest, not on the network screen
+        autoinstall["network"] = network
+        autoinstall["interactive-sections"] = [s for s in autoinstall.get("interactive-sections", []) if s != "network"]
+    if node["ssh_keys"]:
+        # Keys are only useful with a server to log in to; passwords stay off
+        autoinstall["ssh"] = {"install-server": True, "allow-pw": False, "authorized-keys": node["ssh_keys"]}
+    if node["gpu_driver"] != "auto":
+        # "none" or a pinned driver package: nothing left to ask on the drivers screen
+        autoinstall["drivers"] = {"install": False}
+        autoinstall["interactive-sections"] = [s for s in autoinstall.get("interactive-sections", []) if s != "drivers"]
+        if node["gpu_driver"] != "none":
+            autoinstall["packages"] = list(autoinstall.get("packages") or []) + [node["gpu_driver"]]
+    user_data = dict(base, autoinstall=autoinstall)
+    return {
+        "user-data": "#cloud-config\n" + json.dumps(user_data, indent=2) + "\n",
+        "meta-data": json.dumps({"instance-id": node["instance_id"], "local-hostname": node["hostname"]}, indent=2) + "\n",
+        "network-config": json.dumps(network, indent=2) + "\n",
+    }
+
+def render_fleet_chunk(base, nodes):
+    """Render a chunk of nodes; returns (rendered, errors) with the output checked against the seed schemas"""
+    rendered, errors = [], []
+    for node in nodes:
+        documents = render_fleet_node(base, node)
+        errors += [f"{node['hostname']}: {error}" for error in
+                   schema_errors("meta-data", json.loads(documents["meta-data"]))
+                   + schema_errors("autoinstall", json.loads(documents["user-data"].split("\n", 1)[1])["autoinstall"])]
+        rendered.append((node["hostname"], {name: (text, hashlib.sha256(text.encode()).hexdigest())
+                                            for name, text in documents.items()}))
+    return rendered, errors
+
+def render_fleet(manifest_path, out_dir, template_path=None):
+    """Render per-node NoCloud seeds into out_dir/HOSTNAME/, writing only files whose content changed"""
+    import yaml
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    start = time.time()
+    rows = load_fleet_manifest(manifest_path)
+    nodes, errors = [], []
+    for number, row in enumerate(rows, start=2 if not manifest_path.endswith(".json") else 1):
+        node, row_errors = validate_fleet_row(row, number)
+        nodes.append(node)
+        errors += row_errors
+    for field in ("hostname", "instance_id"):
+        seen = {}
+        for node in nodes:
+            if node[field] in seen:
+                errors.append(f"duplicate {field} {node[field]!r}")
+            seen[node[field]] = True
+    if errors:
+        print(f"✗ Fleet manifest {manifest_path} has {len(errors)} error(s):")
+        for error in errors[:20]:
+            print(f"  {error}")
+        return False
+
+    # Parse the template once; every node is a shallow edit of this structure
+    if template_path:
+        with open(template_path, 'r') as f:
+            base = yaml.safe_load(f)
+    else:
+        base = yaml.safe_load(AUTOINSTALL_USER_DATA)
+    if not isinstance(base, dict) or not isinstance(base.get("autoinstall"), dict):
+        print("✗ User-data template has no autoinstall section")
+        return False
+    template_errors = schema_errors("autoinstall", base["autoinstall"])
+    if template_errors:
+        print(f"✗ User-data template has {len(template_errors)} error(s):")
+        for error in template_errors[:20]:
+            print(f"  {error}")
+        return False
+
+    index_path = os.path.join(out_dir, FLEET_INDEX_FILE)
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    chunks = [nodes[i:i + FLEET_CHUNK_ROWS] for i in range(0, len(nodes), FLEET_CHUNK_ROWS)]
+    written = unchanged = 0
+    workers = min(len(chunks), os.cpu_count() or 1) or 1
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        results = list(pool.map(render_fleet_chunk, [base] * len(chunks), chunks))
+    # Nothing is written unless every rendered document passes
+    errors = [error for _, chunk_errors in results for error in chunk_errors]
+    if errors:
+        print(f"✗ Rendered seeds have {len(errors)} error(s):")
+        for error in errors[:20]:
+            print(f"  {error}")
+        return False
+    for rendered, _ in results:
+        for hostname, documents in rendered:
+            node_dir = os.path.join(out_dir, hostname)
+            for name, (text, digest) in documents.items():
+                rel = f"{hostname}/{name}"
+                path = os.path.join(node_dir, name)
+                if index.get(rel) == digest and os.path.exists(path):
+                    unchanged += 1
+                    continue
+                os.makedirs(node_dir, exist_ok=True)
+                with open(path + ".tmp", 'w') as f:
+                    f.write(text)
+                os.replace(path + ".tmp", path)
+                index[rel] = digest
+                written += 1
+
+    current = {node["hostname"] for node in nodes}
+    stale = sorted({rel.split("/")[0] for rel in index} - current)
+    index = {rel: digest for rel, digest in index.items() if rel.split("/")[0] in current}
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=0, sort_keys=True)
+
+    print(f"✓ Rendered {len(nodes)} node(s) into {out_dir}: {written} file(s) written, {unchanged} unchanged "
+          f"({time.time() - start:.2f}s, {workers} worker(s))")
+    if stale:
+        print(f"Warning: {len(stale)} node(s) no longer in the manifest were left in place: {', '.join(stale[:10])}")
+    return True
+
+# Top-level autoinstall keys subiquity understands; anything else is a typo it silently ignores
+AUTOINSTALL_KEYS = ("version", "interactive-sections", "early-commands", "locale", "refresh-installer", "keyboard",
+                    "source", "network", "proxy", "apt", "storage", "identity", "active-directory", "ubuntu-pro",
+                    "ubuntu-advantage", "ssh", "codecs", "drivers", "oem", "snaps", "debconf-selections", "packages",
+                    "kernel", "kernel-crash-dumps", "timezone", "updates", "shutdown", "late-commands",
+                    "error-commands", "reporting", "user-data", "zdevs")
+STRING_LIST = {"type": list, "items": {"type": str}}
+COMMAND_LIST = {"type": list, "items": {"type": (str, list)}}
+CONFIG_SCHEMAS = {
+    "autoinstall": {"type": dict, "required": ["version"], "additional": False, "properties": {
+        "version": {"type": int, "enum": [1]},
+        "interactive-sections": {"type": list, "items": {"type": str, "enum": AUTOINSTALL_KEYS + ("*",)}},
+        "early-commands": COMMAND_LIST, "late-commands": COMMAND_LIST, "error-commands": COMMAND_LIST,
+        "locale": {"type": str},
+        "timezone": {"type": str},
+        "refresh-installer": {"type": dict, "properties": {"update": {"type": bool}, "channel": {"type": str}}},
+        "keyboard": {"type": dict, "required": ["layout"], "properties": {
+            "layout": {"type": str}, "variant": {"type": str}, "toggle": {"type": (str, type(None))}}},
+        "source": {"type": dict, "properties": {"id": {"type": str}, "search_drivers": {"type": bool}}},
+        "network": {"type": dict},
+        "proxy": {"type": (str, type(None))},
+        "apt": {"type": dict},
+        "storage": {"type": dict},
+        "identity": {"type": dict, "required": ["username", "hostname", "password"], "properties": {
+            "realname": {"type": str}, "username": {"type": str}, "hostname": {"type": str}, "password": {"type": str}}},
+        "active-directory": {"type": dict},
+        "ubuntu-pro": {"type": dict, "properties": {"token": {"type": (str, type(None))}}},
+        "ubuntu-advantage": {"type": dict, "properties": {"token": {"type": (str, type(None))}}},
+        "ssh": {"type": dict, "properties": {
+            "install-server": {"type": bool}, "allow-pw": {"type": bool}, "authorized-keys": STRING_LIST}},
+        "codecs": {"type": dict, "properties": {"install": {"type": bool}}},
+        "drivers": {"type": dict, "properties": {"install": {"type": bool}}},
+        "oem": {"type": dict, "properties": {"install": {"type": (bool, str)}}},
+        "snaps": {"type": list, "items": {"type": dict, "required": ["name"], "properties": {
+            "name": {"type": str}, "channel": {"type": str}, "classic": {"type": bool}}}},
+        "debconf-selections": {"type": str},
+        "packages": STRING_LIST,
+        "kernel": {"type": dict, "properties": {"package": {"type": str}, "flavor": {"type": str}}},
+        "kernel-crash-dumps": {"type": dict},
+        "updates": {"type": str, "enum": ["security", "all"]},
+        "shutdown": {"type": str, "enum": ["reboot", "poweroff"]},
+        "reporting": {"type": dict},
+        "user-data": {"type": dict},
+        "zdevs": {"type": list},
+    }},
+    "meta-data": {"type": dict, "required": ["instance-id"], "properties": {
+        "instance-id": {"type": str}, "local-hostname": {"type": str}}},
+}
+COMPILED_SCHEMAS = {}
+SEED_DIR_PREFIX = "/cdrom/"
+
+def compile_schema(schema):
+    """Turn a schema dict into a checker(value, path) -> [errors], resolving everything up front"""
+    types = schema.get("type", object)
+    types = types if isinstance(types, tuple) else (types,)
+    # bool is an int subclass; "version: true" must not pass as a number
+    reject_bool = bool not in types and int in types
+    type_names = " or ".join("null" if t is type(None) else t.__name__ for t in types)
+    enum = schema.get("enum")
+    required = schema.get("required", ())
+    properties = {key: compile_schema(sub) for key, sub in schema.get("properties", {}).items()}
+    additional = schema.get("additional", True)
+    items = compile_schema(schema["items"]) if "items" in schema else None
+
+    def check(value, path):
+        if not isinstance(value, types) or (reject_bool and isinstance(value, bool)):
+            return [f"{path}: expected {type_names}, got {type(value).__name__}"]
+        if enum is not None and value not in enum:
+            return [f"{path}: {value!r} is not one of {', '.join(map(str, enum))}"]
+        errors = []
+        if isinstance(value, dict):
+            errors += [f"{path}: missing required key {key!r}" for key in required if key not in value]
+            for key, item in value.items():
+                if key in properties:
+                    errors += properties[key](item, f"{path}.{key}")
+                elif not additional:
+                    errors.append(f"{path}: unknown key {key!r}")
+        elif items and isinstance(value, list):
+            for i, item in enumerate(value):
+                errors += items(item, f"{path}[{i}]")
+        return errors
+    return check
+
+def schema_errors(name, value, path=None):
+    checker = COMPILED_SCHEMAS.get(name)
+    if checker is None:
+        checker = COMPILED_SCHEMAS[name] = compile_schema(CONFIG_SCHEMAS[name])
+    return checker(value, path or name)
+
+def grub_split_commands(text):
+    """Split GRUB script into (line, words) commands the way GRUB's lexer does.
+
+    Quotes and backslashes are honoured, and an unquoted ';' or newline ends
+    the command, so 'linux ... ds=nocloud;s=...' really is two commands.
+    """
+    commands, words, word = [], [], []
+    quote, in_word, line, start = None, False, 1, 1
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if quote:
+            if c == quote:
+                quote = None
+            elif c == "\\" and quote == '"' and text[i + 1:i + 2] in ('"', "\\", "$"):
+                i += 1
+                word.append(text[i])
+            else:
+                word.append(c)
+        elif c == "\\" and i + 1 < len(text):
+            i += 1
+            if text[i] != "\n":
+                word.append(text[i])
+            else:
+                line += 1
+            in_word = True
+        elif c in "'\"":
+            quote, in_word = c, True
+        elif c == "#" and not in_word:
+            while i + 1 < len(text) and text[i + 1] != "\n":
+                i += 1
+        elif c in " \t\r;\n":
+            if in_word:
+                words.append("".join(word))
+                word, in_word = [], False
+            if c in ";\n" and words:
+                commands.append((start, words))
+                words = []
+        else:
+            if not words and not in_word:
+                start = line
+            word.append(c)
+            in_word = True
+        if c == "\n":
+            line += 1
+        i += 1
+    if in_word:
+        words.append("".join(word))
+    if words:
+        commands.append((start, words))
+    return commands
+
+def parse_grub_menu(text):
+    """Return (settings, entries, errors): top-level 'set' values and each menuentry's commands"""
+    settings, entries, stack, errors = {}, [], [], []
+    for line, words in grub_split_commands(text):
+        if words[0] in ("menuentry", "submenu"):
+            if words[-1] != "{" or len(words) < 3:
+                errors.append(f"grub.cfg line {line}: {words[0]} needs a title and an opening '{{' on the same line")
+                continue
+            block = {"kind": words[0], "title": words[1], "line": line, "commands": []}
+            if words[0] == "menuentry":
+                entries.append(block)
+            stack.append(block)
+        elif words == ["}"]:
+            if not stack:
+                errors.append(f"grub.cfg line {line}: unmatched '}}'")
+            else:
+                stack.pop()
+        elif stack:
+            stack[-1]["commands"].append((line, words))
+        elif words[0] == "set" and len(words) > 1 and "=" in words[1]:
+            name, value = words[1].split("=", 1)
+            settings[name] = value
+    errors += [f"grub.cfg line {block['line']}: {block['kind']} {block['title']!r} is never closed" for block in stack]
+    return settings, entries, errors
+
+def check_grub_menu(grub_cfg, seed_files):
+    """Check menu entries and that every autoinstall entry's ds= seed is actually injected"""
+    settings, entries, errors = parse_grub_menu(grub_cfg)
+    warnings = []
+    if not entries:
+        errors.append("grub.cfg: no menuentry found")
+    timeout = settings.get("timeout")
+    if timeout is not None and not timeout.lstrip("-").isdigit():
+        errors.append(f"grub.cfg: timeout {timeout!r} is not a number")
+    default = settings.get("default")
+    titles = [entry["title"] for entry in entries]
+    if default is not None and default not in titles and not (default.isdigit() and int(default) < len(entries)):
+        errors.append(f"grub.cfg: default {default!r} does not name one of the {len(entries)} menu entries")
+    for title in sorted({t for t in titles if titles.count(t) > 1}):
+        warnings.append(f"grub.cfg: menu entry {title!r} appears {titles.count(title)} times")
+
+    for entry in entries:
+        where = f"grub.cfg line {entry['line']} ({entry['title']})"
+        commands = entry["commands"]
+        kernels = [(i, words) for i, (_, words) in enumerate(commands) if words[0] in ("linux", "linuxefi")]
+        if not kernels:
+            # chainloader, fwsetup, memtest and the like
+            continue
+        if len(kernels) != 1 or len(kernels[0][1]) < 2:
+            errors.append(f"{where}: expected exactly one 'linux KERNEL ...' command, found {len(kernels)}")
+            continue
+        if not any(words[0] in ("initrd", "initrdefi") and len(words) > 1 for _, words in commands):
+            errors.append(f"{where}: no initrd command")
+        index, words = kernels[0]
+        args = words[2:]
+        if "autoinstall" not in args:
+            continue
+        ds = next((arg[3:] for arg in args if arg.startswith("ds=")), None)
+        if ds is None:
+            errors.append(f"{where}: autoinstall entry has no ds= argument, so subiquity finds no seed")
+            continue
+        name, _, rest = ds.partition(";")
+        options = dict(part.split("=", 1) for part in rest.split(";") if "=" in part)
+        seed = options.get("s") or options.get("seedfrom")
+        if seed is None:
+            following = commands[index + 1][1] if index + 1 < len(commands) else []
+            if following and following[0].startswith(("s=", "seedfrom=")):
+                errors.append(f"{where}: the unquoted ';' in ds={ds};{following[0]} ends the linux command in GRUB, "
+                              f"so the kernel never sees the seed; quote the argument or write \\;")
+            else:
+                errors.append(f"{where}: ds={ds} has no s= seed location")
+            continue
+        if name not in ("nocloud", "nocloud-net"):
+            errors.append(f"{where}: unsupported datasource {name!r} (expected nocloud)")
+        if seed.startswith(("http://", "https://")):
+            # Served over the network, nothing on the image to cross-check
+            continue
+        path = seed[len("file://"):] if seed.startswith("file://") else seed
+        if name == "nocloud-net":
+            warnings.append(f"{where}: ds=nocloud-net is meant for network seeds; use ds=nocloud for {path}")
+        if not path.startswith(SEED_DIR_PREFIX):
+            errors.append(f"{where}: seed {seed} is not on the install medium ({SEED_DIR_PREFIX})")
+            continue
+        if not path.endswith("/"):
+            errors.append(f"{where}: seed {seed} must end with '/'; cloud-init appends file names to it directly")
+            continue
+        seed_dir = path[len(SEED_DIR_PREFIX):]
+        missing = [doc for doc in ("user-data", "meta-data") if seed_dir + doc not in seed_files]
+        if missing:
+            errors.append(f"{where}: seed {seed} points at /{seed_dir}, but {', '.join(missing)} is not injected there")
+    return errors, warnings
+
+GRUB_SAFE_WORD_RE = re.compile(r"^[A-Za-z0-9_./:,=+@%-]+$")
+GRUB_DIRECTIVES = ("serial", "terminal_input", "terminal_output")
+# Boot profiles applied on top of GRUB_AUTOINSTALL_CFG's entries
+GRUB_PROFILES = {
+    # Menu on screen and serial (the smoke test drives it over the serial port)
+    "interactive": {"timeout": 30, "timeout_style": "menu", "serial": "--unit=0 --speed=115200"},
+    # No menu: boot the autoinstall entry at once with the serial port as the primary console
+    "fleet-unattended": {"timeout": 0, "timeout_style": "hidden", "serial": "--unit=0 --speed=115200",
+                         "console": ["console=tty0", "console=ttyS0,115200n8"]},
+}
+DEFAULT_GRUB_PROFILE = "interactive"
+# Serial console output only the running installer prints: its first TUI screen, the
+# autoinstall confirmation, or its event log. A bare "subiquity" also matches
+# /snap/subiquity mounts long before the installer starts. Strip SERIAL_ANSI_ESCAPE first.
+SUBIQUITY_STARTED_RE = re.compile(r"Use UP, DOWN and ENTER keys|^\s*Welcome!|Continue with autoinstall\?|start: subiquity/",
+                                  re.MULTILINE)
+SERIAL_ANSI_ESCAPE = re.compile(rb"\x1b\[[0-9;?]*[A-Za-z]|\x1b[()][A-Z0-9]")
+
+def grub_quote(word):
+    return word if GRUB_SAFE_WORD_RE.match(word) else "'" + word.replace("'", "'\\''") + "'"
+
+class GrubMenu:
+    """grub.cfg as an ordered list of items: verbatim text, top-level directives and menu entries.
+
+    Only what the editor changes is rewritten; comments, conditionals, fonts
+    and unknown commands go back out exactly as they came in.
+    """
+    def __init__(self, text):
+        lines = text.splitlines(keepends=True)
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        commands = grub_split_commands(text)
+        per_line = {}
+        for line, words in commands:
+            per_line[line] = per_line.get(line, 0) + 1
+        blocks, directives, stack, depth = {}, {}, [], 0
+        for line, words in commands:
+            if words[0] in ("menuentry", "submenu") and words[-1] == "{" and len(words) >= 3:
+                stack.append({"kind": words[0], "title": words[1], "start": line, "commands": [], "conditional": depth > 0})
+            elif words == ["}"] and stack:
+                block = stack.pop()
+                if not stack:
+                    blocks[block["start"]] = dict(block, end=line)
+            elif stack:
+                stack[-1]["commands"].append(words)
+            elif words[0] == "if":
+                depth += 1
+            elif words[0] == "fi":
+                depth -= 1
+            elif depth == 0 and per_line[line] == 1 and self.directive_key(words):
+                directives[line] = self.directive_key(words)
+        if stack:
+            raise ValueError(f"grub.cfg: {stack[0]['kind']} {stack[0]['title']!r} at line {stack[0]['start']} is never closed")
+
+        self.items = []
+        number = 1
+        while number <= len(lines):
+            if number in blocks:
+                block = blocks[number]
+                self.items.append(dict(block, kind="entry" if block["kind"] == "menuentry" else "submenu",
+                                       text="".join(lines[number - 1:block["end"]])))
+                number = block["end"] + 1
+                continue
+            if number in directives:
+                self.items.append({"kind": "directive", "key": directives[number], "text": lines[number - 1]})
+            elif self.items and self.items[-1]["kind"] == "text":
+                self.items[-1]["text"] += lines[number - 1]
+            else:
+                self.items.append({"kind": "text", "text": lines[number - 1]})
+            number += 1
+
+    @staticmethod
+    def directive_key(words):
+        if words[0] == "set" and len(words) == 2 and "=" in words[1]:
+            return "set " + words[1].split("=", 1)[0]
+        return words[0] if words[0] in GRUB_DIRECTIVES else None
+
+    @staticmethod
+    def boot_key(entry):
+        """What an entry actually boots; two entries with the same key are the same choice"""
+        return tuple(tuple(w for w in words if w != "---") for words in entry["commands"] if words[0] != "set")
+
+    @property
+    def entries(self):
+        return [item for item in self.items if item["kind"] == "entry"]
+
+    def directive(self, key):
+        item = next((item for item in self.items if item["kind"] == "directive" and item["key"] == key), None)
+        return None if item is None else grub_split_commands(item["text"])[0][1]
+
+    def set_directives(self, commands):
+        """Replace every top-level occurrence of each command with one copy, placed where the first one was"""
+        new_items = [{"kind": "directive", "key": self.directive_key(words), "text": " ".join(grub_quote(w) for w in words) + "\n"}
+                     for words in commands]
+        keys = {item["key"] for item in new_items}
+        positions = [i for i, item in enumerate(self.items) if item["kind"] == "directive" and item["key"] in keys]
+        at = positions[0] if positions else 0
+        self.items = [item for i, item in enumerate(self.items) if i not in positions]
+        self.items[at:at] = new_items
+
+    def remove_entry(self, title):
+        before = len(self.items)
+        self.items = [item for item in self.items if not (item["kind"] == "entry" and item["title"] == title)]
+        return before - len(self.items)
+
+    def merge_entries(self, other):
+        """Put other's entries first, replacing entries with the same titles"""
+        for entry in other.entries:
+            self.remove_entry(entry["title"])
+        first = next((i for i, item in enumerate(self.items) if item["kind"] in ("entry", "submenu")), len(self.items))
+        self.items[first:first] = [dict(entry) for entry in other.entries]
+
+    def dedupe(self, keep=()):
+        """Drop entries repeating an earlier title or boot choice; titles in keep always stay"""
+        seen_titles, seen_boots, removed = set(), set(), []
+        for item in list(self.items):
+            if item["kind"] != "entry" or item["conditional"]:
+                continue
+            key = self.boot_key(item)
+            if item["title"] not in keep and (item["title"] in seen_titles or key in seen_boots):
+                self.items.remove(item)
+                removed.append(item["title"])
+                continue
+            seen_titles.add(item["title"])
+            seen_boots.add(key)
+        return removed
+
+    def set_kernel_args(self, title, drop_prefixes=(), add=()):
+        """Rewrite one entry's linux line, removing arguments by prefix and appending new ones"""
+        entry = next(entry for entry in self.entries if entry["title"] == title)
+        commands = []
+        for words in entry["commands"]:
+            if words[0] in ("linux", "linuxefi"):
+                words = words[:2] + [w for w in words[2:] if not w.startswith(tuple(drop_prefixes))] + list(add)
+            commands.append(words)
+        entry["commands"] = commands
+        entry["text"] = (f"menuentry {grub_quote(title)} {{\n"
+                         + "".join("    " + " ".join(grub_quote(w) for w in words) + "\n" for words in commands) + "}\n")
+
+    def render(self):
+        return "".join(item["text"] for item in self.items)
+
+def autoinstall_grub_menu(stock, profile=DEFAULT_GRUB_PROFILE):
+    """Merge GRUB_AUTOINSTALL_CFG's entries into the stock grub.cfg and apply a boot profile"""
+    settings = GRUB_PROFILES[profile]
+    menu = GrubMenu(stock)
+    ours = GrubMenu(GRUB_AUTOINSTALL_CFG)
+    menu.merge_entries(ours)
+    removed = menu.dedupe(keep=[entry["title"] for entry in ours.entries])
+
+    auto = next(entry["title"] for entry in ours.entries if any(
+        words[0] in ("linux", "linuxefi") and "autoinstall" in words for words in entry["commands"]))
+    if settings.get("console"):
+        menu.set_kernel_args(auto, drop_prefixes=("console=",), add=settings["console"])
+    directives = [words for words in (ours.directive(key) for key in GRUB_DIRECTIVES) if words]
+    directives = [["set", f"timeout={settings['timeout']}"], ["set", f"timeout_style={settings['timeout_style']}"],
+                  ["set", f"default={[entry['title'] for entry in menu.entries].index(auto)}"]] + directives
+    if settings.get("serial"):
+        directives = [w for w in directives if w[0] not in GRUB_DIRECTIVES]
+        directives += [["serial"] + settings["serial"].split(), ["terminal_input", "console", "serial"],
+                       ["terminal_output", "console", "serial"]]
+    menu.set_directives(directives)
+    if removed:
+        print(f"grub.cfg: dropped duplicate entr{'y' if len(removed) == 1 else 'ies'}: {', '.join(removed)}")
+    return menu.render()
+
+def validate_autoinstall_config(user_data=None, meta_data=None, grub_cfg=None, seed_files=None):
+    """Validate the seed documents, the GRUB menu and the seed layout in process.
+
+    Defaults to the inline configuration as it is at call time. Returns
+    (errors, warnings); nothing touches the ISO, so this runs before download.
+    """
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    user_data = AUTOINSTALL_USER_DATA if user_data is None else user_data
+    meta_data = AUTOINSTALL_META_DATA if meta_data is None else meta_data
+    grub_cfg = GRUB_AUTOINSTALL_CFG if grub_cfg is None else grub_cfg
+    seed_files = set(injected_paths(autoinstall_injector()) if seed_files is None else seed_files)
+    errors, warnings = [], []
+
+    if not user_data.startswith("#cloud-config"):
+        errors.append("user-data: first line must be #cloud-config or cloud-init ignores the document")
+    try:
+        document = yaml.load(user_data, Loader=loader)
+    except yaml.YAMLError as e:
+        document = None
+        errors.append(f"user-data: YAML error: {e}")
+    if document is not None:
+        if not isinstance(document, dict) or not isinstance(document.get("autoinstall"), dict):
+            errors.append("user-data: no autoinstall mapping at the top level")
+        else:
+            autoinstall = document["autoinstall"]
+            errors += schema_errors("autoinstall", autoinstall)
+            interactive = autoinstall.get("interactive-sections") or []
+            if not any(key in autoinstall for key in ("identity", "user-data")) and not {"identity", "*"} & set(interactive):
+                errors.append("autoinstall: no identity or user-data and identity is not interactive, so no user is created")
+            ssh = autoinstall.get("ssh") if isinstance(autoinstall.get("ssh"), dict) else {}
+            if ssh.get("authorized-keys") and ssh.get("install-server") is False:
+                warnings.append("autoinstall.ssh: authorized-keys are set but install-server is false")
+
+    try:
+        errors += schema_errors("meta-data", yaml.load(meta_data, Loader=loader))
+    except yaml.YAMLError as e:
+        errors.append(f"meta-data: YAML error: {e}")
+
+    grub_errors, grub_warnings = check_grub_menu(grub_cfg, seed_files)
+    return errors + grub_errors, warnings + grub_warnings
+
+def preflight_validate(**config):
+    """Print the validator's findings; False when the build would ship a broken seed or menu"""
+    start = time.perf_counter()
+    errors, warnings = validate_autoinstall_config(**config)
+    elapsed = (time.perf_counter() - start) * 1000
+    for warning in warnings:
+        print(f"Warning: {warning}")
+    if errors:
+        print(f"✗ Autoinstall configuration has {len(errors)} error(s):")
+        for error in errors:
+            print(f"  {error}")
+        return False
+    print(f"✓ Autoinstall configuration valid ({elapsed:.1f} ms)")
+    return True
+
+CLEANUP_MINIMAL_SCRIPT = """#!/bin/bash
 # NosanaAOS Post-Install Cleanup Script
 # Run this after first boot to minimize the installation
 
@@ -263,127 +1722,203 @@ systemctl status ssh 2>/dev/null || echo "  Not installed (good!)"
 echo "NosanaAOS minimization complete!"
 echo "Total packages installed: $(dpkg -l | grep '^ii' | wc -l)"
 """
-    with open(cleanup_script, 'w') as f:
-        f.write(cleanup_content)
-    os.chmod(cleanup_script, 0o755)
-    print(f"Created: {cleanup_script}")
-    
-    # Debug: show file contents
-    print("\n--- DEBUG: Autoinstall file verification ---")
-    print(f"user-data size: {os.path.getsize(user_data_dst)} bytes")
-    print(f"meta-data size: {os.path.getsize(meta_data_dst)} bytes")
-    with open(user_data_dst, 'r') as f:
-        lines = f.readlines()
-        print(f"user-data first few lines:")
-        for i, line in enumerate(lines[:5]):
-            print(f"  {i+1}: {line.rstrip()}")
-    print("--- END DEBUG ---\n")
-    
-    # Modify GRUB configuration for autoinstall
-    grub_cfg_path = os.path.join(work_dir, "boot", "grub", "grub.cfg")
-    if os.path.exists(grub_cfg_path):
-        # Ensure we can modify the file
-        subprocess.run(f"chmod 644 {grub_cfg_path}", shell=True, capture_output=True)
+
+# Where an op can land: the extracted ISO tree, the ESP image, or the MBR template
+INJECT_TARGETS = ("tree", "esp", "mbr")
+GRUB_CFG_PATH = "boot/grub/grub.cfg"
+
+# Injectors return a list of ops, each a dict:
+#   {"op": "write", "path": P, "data": str|bytes, "mode": 0o644, "target": "tree"}
+#   {"op": "template", "path": P, "template": "... $name ...", "values": {...}}
+#   {"op": "remove", "path": P}
+#   {"op": "grub", "key": ID, "edit": fn(text) -> text, "backup": False}
+# The mbr target takes "offset" instead of "path". A grub op's key identifies
+# the edit for caching, since the edit itself is code.
+
+def autoinstall_injector(grub_profile=DEFAULT_GRUB_PROFILE):
+    """Seed documents on the medium, the cleanup script and the autoinstall boot menu"""
+    documents = {"user-data": AUTOINSTALL_USER_DATA, "meta-data": AUTOINSTALL_META_DATA,
+                 "vendor-data": "{}\n", "network-data": "version: 2\n"}
+    ops = []
+    # server/ is the seed GRUB points at; the root copies are for installers that look there
+    for prefix in ("server/", ""):
+        ops += [{"op": "write", "path": prefix + name, "data": text} for name, text in documents.items()]
+    bare = AUTOINSTALL_USER_DATA.replace("#cloud-config\n", "")
+    ops += [{"op": "write", "path": name, "data": bare} for name in ("autoinstall.yaml", "autoinstall.yml")]
+    ops.append({"op": "write", "path": "cleanup-minimal.sh", "data": CLEANUP_MINIMAL_SCRIPT, "mode": 0o755})
+    menu_digest = hashlib.sha256(GRUB_AUTOINSTALL_CFG.encode()).hexdigest()[:16]
+    ops.append({"op": "grub", "key": f"autoinstall-menu:{menu_digest}:{grub_profile}", "backup": True,
+                "edit": lambda stock: autoinstall_grub_menu(stock, grub_profile)})
+    return ops
+
+def hello_injector():
+    return [
+        {"op": "write", "target": "esp", "path": "/HelloNOS.ESP",
+         "data": b"Hello from HelloNOS.ESP! This is a test file in the EFI System Partition.\n"},
+        {"op": "write", "target": "mbr", "offset": 512,
+         "data": b"Hello from HelloNOS.BOOT! This is a test file in the MBR/boot area.\n"},
+        {"op": "write", "path": "opt/HelloNOS.OPT",
+         "data": "Hello from HelloNOS.OPT! This is a test file in the /opt directory.\n"},
+    ]
+
+def esp_files_injector(esp_files):
+    """Copy (local_path, esp_path) pairs into the EFI System Partition image"""
+    ops = []
+    for local_path, esp_path in esp_files:
+        with open(local_path, 'rb') as f:
+            ops.append({"op": "write", "target": "esp", "path": esp_path, "data": f.read()})
+    return ops
+
+def injected_paths(ops, target="tree"):
+    return {op["path"].strip("/") for op in ops if op["op"] in ("write", "template") and op.get("target", "tree") == target}
+
+def collect_changes(injections):
+    """Merge (name, ops) pairs into one change set keyed by destination.
+
+    Identical content is stored once however many paths it goes to, and a
+    later op on the same destination replaces an earlier one.
+    """
+    import string
+    changes, owners, blobs, grub_edits = {}, {}, {}, []
+    for name, ops in injections:
+        for op in ops:
+            kind = op["op"]
+            if kind == "grub":
+                grub_edits.append(dict(op, injector=name))
+                continue
+            target = op.get("target", "tree")
+            if target not in INJECT_TARGETS:
+                raise ValueError(f"{name}: unknown injection target {target!r}")
+            if target == "mbr":
+                where = op["offset"]
+            elif target == "esp":
+                where = "/" + op["path"].strip("/")
+            else:
+                where = op["path"].strip("/")
+            if kind == "template":
+                op = dict(op, op="write", data=string.Template(op["template"]).substitute(op.get("values", {})))
+            if kind in ("write", "template"):
+                data = op["data"].encode() if isinstance(op["data"], str) else bytes(op["data"])
+                digest = hashlib.sha256(data).hexdigest()
+                blobs.setdefault(digest, data)
+                entry = {"op": "write", "sha256": digest, "size": len(data), "mode": op.get("mode", 0o644)}
+            elif kind == "remove":
+                entry = {"op": "remove"}
+            else:
+                raise ValueError(f"{name}: unknown injector op {kind!r}")
+            if (target, where) in changes and changes[target, where] != entry:
+                print(f"Warning: {owners[target, where]} and {name} both change {target}:{where}; keeping {name}'s")
+            changes[target, where] = entry
+            owners[target, where] = name
+    return {"changes": changes, "owners": owners, "blobs": blobs, "grub": grub_edits}
+
+def change_set_manifest(change_set):
+    """Describe a change set without its content; 'key' changes whenever the injected result would"""
+    files = [dict(entry, target=target, path=where, injector=change_set["owners"][target, where])
+             for (target, where), entry in sorted(change_set["changes"].items(), key=lambda item: (item[0][0], str(item[0][1])))]
+    grub = [edit["key"] for edit in change_set["grub"]]
+    keyed = [{k: v for k, v in f.items() if k != "injector"} for f in files]
+    key = hashlib.sha256(json.dumps({"files": keyed, "grub": grub}, sort_keys=True).encode()).hexdigest()
+    return {"key": key, "files": files, "grub": grub}
+
+def apply_changes(change_set, work_dir, efi_img, mbr_img):
+    """Apply a change set in one pass per target; returns its manifest, or None on failure"""
+    changes, blobs = change_set["changes"], change_set["blobs"]
+    by_target = {target: sorted((where, entry) for (t, where), entry in changes.items() if t == target)
+                 for target in INJECT_TARGETS}
+    manifest = change_set_manifest(change_set)
+    try:
+        tree = by_target["tree"]
+        for directory in sorted({os.path.dirname(path) for path, entry in tree if entry["op"] == "write"} - {""}):
+            os.makedirs(os.path.join(work_dir, directory), exist_ok=True)
+        for path, entry in tree:
+            full_path = os.path.join(work_dir, path)
+            if entry["op"] == "remove":
+                if os.path.isdir(full_path) and not os.path.islink(full_path):
+                    shutil.rmtree(full_path)
+                elif os.path.lexists(full_path):
+                    os.remove(full_path)
+                continue
+            if os.path.exists(full_path) and not os.access(full_path, os.W_OK):
+                os.chmod(full_path, 0o644)
+            with open(full_path, 'wb') as f:
+                f.write(blobs[entry["sha256"]])
+            os.chmod(full_path, entry["mode"])
         
-        # Backup original grub.cfg
-        try:
-            import shutil
-            shutil.copy2(grub_cfg_path, grub_cfg_path + ".backup")
-        except PermissionError:
-            # If we can't backup, just proceed
-            print("Warning: Could not backup grub.cfg (permission denied)")
+        if by_target["esp"]:
+            with FatImage(efi_img) as esp:
+                for path, entry in by_target["esp"]:
+                    if entry["op"] == "write":
+                        esp.write(path, blobs[entry["sha256"]])
+                    elif esp.exists(path):
+                        esp.remove(path)
         
-        # Read original GRUB config
-        try:
-            with open(grub_cfg_path, 'r') as f:
-                original_grub = f.read()
-            
-            # Write new GRUB config with autoinstall menu
-            with open(grub_cfg_path, 'w') as f:
-                f.write(GRUB_AUTOINSTALL_CFG + "\n\n# Original GRUB configuration below:\n" + original_grub)
-            
-            print(f"Modified: {grub_cfg_path}")
-            
-            # Debug: show the kernel command line we added
-            print("\n--- DEBUG: GRUB kernel command ---")
-            lines = GRUB_AUTOINSTALL_CFG.split('\n')
-            for line in lines:
-                if 'linux /casper/vmlinuz' in line:
-                    print(f"Kernel command: {line.strip()}")
-            print("--- END DEBUG ---\n")
-            
-            print("--- DEBUG: Files created for autoinstall detection ---")
-            autoinstall_files = [
-                "/server/user-data", "/server/meta-data", "/server/vendor-data", "/server/network-data",
-                "/user-data", "/meta-data", "/vendor-data", "/network-data", 
-                "/autoinstall.yaml", "/autoinstall.yml", "/cleanup-minimal.sh"
-            ]
-            for af in autoinstall_files:
-                full_path = os.path.join(work_dir, af.lstrip('/'))
-                if os.path.exists(full_path):
-                    print(f"  ✓ {af} ({os.path.getsize(full_path)} bytes)")
-                else:
-                    print(f"  ✗ {af} (missing)")
-            print("--- END DEBUG ---\n")
-            print("NOTE: After installation, run '/cleanup-minimal.sh' as root to minimize the system")
-            
-        except PermissionError:
-            print(f"Warning: Could not modify {grub_cfg_path} (permission denied)")
-    else:
-        print(f"Warning: {grub_cfg_path} not found")
-    
-    print("✓ Autoinstall configuration injected")
-    print("✅ INTERACTIVE SCREENS: All orange menu screens will be shown")
-    print("✅ PROXY MIRROR TEST: Should work in proxy configuration screen")
+        if by_target["mbr"]:
+            with open(mbr_img, 'r+b') as f:
+                for offset, entry in by_target["mbr"]:
+                    if entry["op"] == "write":
+                        f.seek(offset)
+                        f.write(blobs[entry["sha256"]])
 
-def inject_hello_files(work_dir, efi_img, mbr_img):
-    print("Injected HelloNOS.ESP, HelloNOS.BOOT, HelloNOS.OPT test files.")
-    
-    # Inject into EFI partition
-    with open(efi_img, "r+b") as f:
-        f.seek(1024)
-        f.write(b"Hello from HelloNOS.ESP! This is a test file in the EFI System Partition.\n")
-    
-    # Inject into MBR/boot area
-    with open(mbr_img, "r+b") as f:
-        f.seek(512)
-        f.write(b"Hello from HelloNOS.BOOT! This is a test file in the MBR/boot area.\n")
+        if change_set["grub"]:
+            grub_cfg_path = os.path.join(work_dir, GRUB_CFG_PATH)
+            if not os.path.exists(grub_cfg_path):
+                print(f"Warning: {grub_cfg_path} not found, boot menu left unchanged")
+            else:
+                with open(grub_cfg_path, 'r') as f:
+                    stock = f.read()
+                text = stock
+                for edit in change_set["grub"]:
+                    text = edit["edit"](text)
+                if any(edit.get("backup") for edit in change_set["grub"]):
+                    with open(grub_cfg_path + ".backup", 'w') as f:
+                        f.write(stock)
+                os.chmod(grub_cfg_path, 0o644)
+                with open(grub_cfg_path, 'w') as f:
+                    f.write(text)
+                manifest["grub_sha256"] = hashlib.sha256(text.encode()).hexdigest()
+    except (OSError, FatError, ValueError) as e:
+        print(f"✗ Injection failed: {e}")
+        return None
     
-    # Inject into opt directory
-    opt_dir = os.path.join(work_dir, "opt")
-    os.makedirs(opt_dir, exist_ok=True)
-    with open(os.path.join(opt_dir, "HelloNOS.OPT"), "w") as f:
-        f.write("Hello from HelloNOS.OPT! This is a test file in the /opt directory.\n")
+    counts = {target: len(entries) for target, entries in by_target.items()}
+    unique = len({entry["sha256"] for entry in changes.values() if entry["op"] == "write"})
+    print(f"✓ Injected {sum(counts.values())} change(s) ({counts['tree']} tree, {counts['esp']} ESP, {counts['mbr']} MBR) "
+          f"from {unique} unique blob(s)" + (f", grub.cfg patched by {len(change_set['grub'])} edit(s)" if change_set["grub"] else ""))
+    return manifest
 
-def verify_hello_files(new_iso):
+def run_injectors(injections, work_dir, efi_img, mbr_img):
+    """Collect (name, ops) pairs into one change set and apply it"""
+    try:
+        change_set = collect_changes(injections)
+    except (KeyError, ValueError) as e:
+        print(f"✗ Invalid injector op: {e}")
+        return None
+    return apply_changes(change_set, work_dir, efi_img, mbr_img)
+
+def verify_hello_files(new_iso, efi_img="efi.img", mbr_img="boot_hybrid.img"):
     print("Verifying HelloNOS test files...")
     
     # Check HelloNOS.OPT
     try:
-        subprocess.run(f"mkdir -p _iso_mount", shell=True)
-        subprocess.run(f"sudo mount -o loop {new_iso} _iso_mount", shell=True)
-        
-        opt_file = "_iso_mount/opt/HelloNOS.OPT"
-        if os.path.exists(opt_file):
-            with open(opt_file, 'r') as f:
-                content = f.read()
-            if "HelloNOS.OPT" in content:
-                print("✓ PASS: HelloNOS.OPT found and verified")
-            else:
-                print("✗ FAIL: HelloNOS.OPT content incorrect")
-        else:
+        try:
+            with BaseImage(new_iso) as image:
+                content = image.read("/opt/HelloNOS.OPT") if image.exists("/opt/HelloNOS.OPT") else None
+        except IsoError:
+            content = read_files_from_image(new_iso, ["/opt/HelloNOS.OPT"]).get("/opt/HelloNOS.OPT")
+        if content is None:
             print("✗ FAIL: HelloNOS.OPT not found")
-        
-        subprocess.run(f"sudo umount _iso_mount", shell=True)
-        subprocess.run(f"rm -rf _iso_mount", shell=True)
+        elif b"HelloNOS.OPT" in content:
+            print("✓ PASS: HelloNOS.OPT found and verified")
+        else:
+            print("✗ FAIL: HelloNOS.OPT content incorrect")
     except Exception as e:
         print(f"✗ FAIL: Error checking HelloNOS.OPT: {e}")
     
     # Check HelloNOS.ESP
     try:
-        with open("efi.img", "rb") as f:
-            f.seek(1024)
-            content = f.read(100)
+        with FatImage(efi_img) as esp:
+            content = esp.read("/HelloNOS.ESP") if esp.exists("/HelloNOS.ESP") else b""
         if b"HelloNOS.ESP" in content:
             print("✓ PASS: HelloNOS.ESP found and verified")
         else:
@@ -393,7 +1928,7 @@ def verify_hello_files(new_iso):
     
     # Check HelloNOS.BOOT
     try:
-        with open("boot_hybrid.img", "rb") as f:
+        with open(mbr_img, "rb") as f:
             f.seek(512)
             content = f.read(100)
         if b"HelloNOS.BOOT" in content:
@@ -403,12 +1938,681 @@ def verify_hello_files(new_iso):
     except Exception as e:
         print(f"FAIL: Error checking HelloNOS.BOOT: {e}")
 
-def remaster_ubuntu_2204(dc_disable_cleanup, inject_hello, inject_autoinstall):
-    iso_url = "https://mirror.pilotfiber.com/ubuntu-iso/24.04.2/ubuntu-24.04.2-live-server-amd64.iso"
-    iso_filename = "ubuntu-24.04.2-live-server-amd64.iso"
+MD5SUM_CACHE_FILE = "md5sum-cache.json"
+# Never listed in md5sum.txt: the list itself, and files xorriso rewrites at build time
+MD5SUM_EXCLUDE = {"md5sum.txt", "boot.catalog", "boot/grub/i386-pc/eltorito.img"}
+
+def snapshot_tree_stats(work_dir):
+    """Record (inode, size, mtime) of every file right after extraction"""
+    stats = {}
+    for root, dirs, files in os.walk(work_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            stats[os.path.relpath(path, work_dir)] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    return stats
+
+def read_md5sum_list(md5sum_path):
+    digests = {}
+    if not os.path.exists(md5sum_path):
+        return digests
+    with open(md5sum_path, 'r') as f:
+        for line in f:
+            parts = line.rstrip("\n").split(None, 1)
+            if len(parts) == 2:
+                digests[os.path.normpath(parts[1].strip())] = parts[0]
+    return digests
+
+def md5_file(path, chunk_size=4*1024*1024):
+    # hashlib drops the GIL for large updates, so a thread pool scales across cores
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def md5_cache_key(rel, stat_key):
+    # The path is part of the key, so a recycled inode elsewhere can never match
+    return "%s:%d:%d:%d" % ((rel,) + tuple(stat_key))
+
+def md5_cache_path(work_dir):
+    # Keys carry inode numbers, so entries only ever match the workspace that wrote them;
+    # one cache per workspace lets concurrent builds prune without touching each other
+    return f"{os.path.abspath(work_dir)}.{MD5SUM_CACHE_FILE}"
+
+def load_md5_cache(work_dir):
+    try:
+        with open(md5_cache_path(work_dir), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_md5_cache(cache, work_dir):
+    path = md5_cache_path(work_dir)
+    partial = f"{path}.{os.getpid()}.partial"
+    with open(partial, 'w') as f:
+        json.dump(cache, f)
+    os.replace(partial, path)
+
+def prime_md5_cache(work_dir, path, digest):
+    """Record a digest we already know so update_md5sum_list doesn't rehash path"""
+    cache = load_md5_cache(work_dir)
+    st = os.stat(path)
+    cache[md5_cache_key(os.path.relpath(path, work_dir), (st.st_ino, st.st_size, st.st_mtime_ns))] = digest
+    save_md5_cache(cache, work_dir)
+
+def update_md5sum_list(work_dir, extracted_stats, max_workers=None):
+    """Rewrite md5sum.txt, hashing only files that changed since extraction"""
+    md5sum_path = os.path.join(work_dir, "md5sum.txt")
+    if not os.path.exists(md5sum_path):
+        print("No md5sum.txt in ISO tree, skipping integrity list update")
+        return True
+    print("Updating md5sum.txt...")
+
+    stock_digests = read_md5sum_list(md5sum_path)
+    cache = load_md5_cache(work_dir)
+
+    current_stats = snapshot_tree_stats(work_dir)
+    digests = {}
+    to_hash = []
+    live = {}
+    for rel, key in current_stats.items():
+        if rel in MD5SUM_EXCLUDE or os.path.islink(os.path.join(work_dir, rel)):
+            continue
+        cache_key = md5_cache_key(rel, key)
+        if extracted_stats.get(rel) == key and rel in stock_digests:
+            # Untouched since extraction, the stock list is still correct
+            digests[rel] = stock_digests[rel]
+        elif cache_key in cache:
+            digests[rel] = live[cache_key] = cache[cache_key]
+        else:
+            to_hash.append((rel, cache_key))
+
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            results = pool.map(lambda item: md5_file(os.path.join(work_dir, item[0])), to_hash)
+            for (rel, cache_key), digest in zip(to_hash, results):
+                digests[rel] = live[cache_key] = digest
+
+    try:
+        with open(md5sum_path, 'w') as f:
+            for rel in sorted(digests):
+                f.write(f"{digests[rel]}  ./{rel}\n")
+    except PermissionError:
+        print(f"Warning: Could not write {md5sum_path} (permission denied)")
+        return False
+
+    # Keep only entries for files in this tree; anything else is stale
+    try:
+        save_md5_cache(live, work_dir)
+    except OSError as e:
+        print(f"Warning: Could not save md5 cache: {e}")
+
+    print(f"✓ md5sum.txt updated ({len(to_hash)} hashed, {len(digests) - len(to_hash)} reused)")
+    return True
+
+MANIFEST_DIGESTS = ("sha256", "blake2b")
+
+def digest_file(path, algorithms=MANIFEST_DIGESTS, chunk_size=16*1024*1024, pool=None):
+    """Compute several digests in one mmap pass over the file"""
+    hashers = [hashlib.new(name) for name in algorithms]
+    size = os.path.getsize(path)
+    if size:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for offset in range(0, size, chunk_size):
+                    chunk = view[offset:offset + chunk_size]
+                    if pool is None or len(hashers) == 1:
+                        for h in hashers:
+                            h.update(chunk)
+                    else:
+                        # Each update releases the GIL, so all digests run on the chunk at once
+                        list(pool.map(lambda h: h.update(chunk), hashers))
+                    chunk.release()
+            finally:
+                view.release()
+    return {name: h.hexdigest() for name, h in zip(algorithms, hashers)}
+
+def write_build_manifest(new_iso, work_dir, artifacts=None, sign=False, efi_img="efi.img", mbr_img="boot_hybrid.img", injected=None):
+    """Hash every build artifact and write <iso>.manifest.json next to the ISO"""
+    if artifacts is None:
+        artifacts = [new_iso, efi_img, mbr_img]
+        if injected:
+            artifacts += [os.path.join(work_dir, f["path"]) for f in injected["files"] if f["target"] == "tree" and f["op"] == "write"]
+    artifacts = [a for a in artifacts if os.path.isfile(a)]
+    print(f"Computing {', '.join(MANIFEST_DIGESTS)} digests for {len(artifacts)} artifacts...")
     
-    temp_paths = ["working_dir", "work_2204", "boot_hybrid.img", "efi.img", "_iso_mount"]
+    start = time.time()
+    entries = []
+    with ThreadPoolExecutor(max_workers=len(MANIFEST_DIGESTS)) as pool:
+        for path in artifacts:
+            entry = {"path": path, "size": os.path.getsize(path)}
+            entry.update(digest_file(path, pool=pool))
+            entries.append(entry)
     
+    manifest_path = new_iso + ".manifest.json"
+    epoch = source_date_epoch()
+    manifest = {
+        "iso": os.path.basename(new_iso),
+        # SOURCE_DATE_EPOCH=0 is a valid reproducible date, not "unset"
+        "created": epoch if epoch is not None else int(time.time()),
+        "artifacts": entries,
+    }
+    if injected:
+        manifest["inject"] = injected
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    print(f"✓ Build manifest written: {manifest_path} ({time.time() - start:.1f}s)")
+
+    if sign:
+        if run_command(f"gpg --batch --yes --armor --detach-sign {manifest_path}", "Signing build manifest", check=False):
+            print(f"✓ Signature written: {manifest_path}.asc")
+        else:
+            print("Warning: Could not sign build manifest (is a gpg key configured?)")
+    return manifest_path
+
+DELTA_MAGIC = b"NOSDELTA1\n"
+DELTA_OP_COPY = b"C"
+DELTA_OP_DATA = b"D"
+
+def write_iso_delta(old_iso, new_iso, delta_path=None, block_size=2048):
+    """Write a block delta that turns old_iso into new_iso.
+
+    ISO 9660 places every file on a 2048-byte sector boundary, so content that
+    moved between builds still lines up with some sector of the old image.
+    Each new block is matched first at the same offset, then anywhere in the
+    old image, and is stored literally only when it occurs nowhere. The op
+    stream is lzma-compressed; the header carries both SHA256s for apply.
+    """
+    import lzma
+    import struct
+    delta_path = delta_path or new_iso + ".delta"
+    print(f"Computing delta {os.path.basename(old_iso)} -> {os.path.basename(new_iso)}...")
+    start = time.time()
+    with open(old_iso, 'rb') as fo, open(new_iso, 'rb') as fn, \
+            mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as old, \
+            mmap.mmap(fn.fileno(), 0, access=mmap.ACCESS_READ) as new:
+        # hash() of a block is only a hint; matches are confirmed byte for byte
+        blocks = {}
+        for offset in range(0, len(old) - block_size + 1, block_size):
+            blocks.setdefault(hash(old[offset:offset + block_size]), offset)
+
+        header = {"source": {"name": os.path.basename(old_iso), "size": len(old)},
+                  "target": {"name": os.path.basename(new_iso), "size": len(new)},
+                  "block_size": block_size}
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            digests = [pool.submit(digest_file, path, ("sha256",)) for path in (old_iso, new_iso)]
+            header["source"]["sha256"], header["target"]["sha256"] = [d.result()["sha256"] for d in digests]
+
+        literal = 0
+        with open(delta_path, 'wb') as out:
+            meta = json.dumps(header).encode()
+            out.write(DELTA_MAGIC + struct.pack("<I", len(meta)) + meta)
+            compressor = lzma.LZMACompressor(preset=6)
+            run_src, run_len, data = None, 0, bytearray()
+
+            def flush():
+                nonlocal run_src, run_len, data
+                if run_len:
+                    out.write(compressor.compress(DELTA_OP_COPY + struct.pack("<QQ", run_src, run_len)))
+                    run_src, run_len = None, 0
+                if data:
+                    out.write(compressor.compress(DELTA_OP_DATA + struct.pack("<Q", len(data)) + bytes(data)))
+                    data = bytearray()
+
+            for offset in range(0, len(new), block_size):
+                block = new[offset:offset + block_size]
+                source = None
+                if old[offset:offset + len(block)] == block:
+                    source = offset
+                elif len(block) == block_size:
+                    candidate = blocks.get(hash(block))
+                    if candidate is not None and old[candidate:candidate + block_size] == block:
+                        source = candidate
+                if source is None:
+                    if run_len:
+                        flush()
+                    data += block
+                    literal += len(block)
+                elif run_len and source == run_src + run_len:
+                    run_len += len(block)
+                else:
+                    flush()
+                    run_src, run_len = source, len(block)
+            flush()
+            out.write(compressor.flush())
+    size = os.path.getsize(delta_path)
+    print(f"✓ Delta written: {delta_path} ({size / 1024:.1f} KB, {literal / 1024:.1f} KB literal, "
+          f"{size / max(1, os.path.getsize(new_iso)):.4%} of the ISO, {time.time() - start:.1f}s)")
+    return delta_path
+
+def apply_iso_delta(delta_path, old_iso, output=None):
+    """Rebuild the target ISO from old_iso and a delta, verifying both SHA256s.
+
+    The op stream is decompressed as it is read, so memory use does not grow with
+    the delta; the ISO is written to a .partial file that is removed on any failure.
+    """
+    import lzma
+    import struct
+    with open(delta_path, 'rb') as f:
+        if f.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+            print(f"✗ {delta_path} is not a NosanaAOS delta")
+            return False
+        header = json.loads(f.read(struct.unpack("<I", f.read(4))[0]))
+        ops_offset = f.tell()
+    output = output or header["target"]["name"]
+
+    print(f"Verifying base {old_iso}...")
+    if os.path.getsize(old_iso) != header["source"]["size"] or \
+            digest_file(old_iso, ("sha256",))["sha256"] != header["source"]["sha256"]:
+        print(f"✗ {old_iso} is not {header['source']['name']} (SHA256 mismatch)")
+        return False
+
+    def read_exact(stream, size):
+        data = stream.read(size)
+        if len(data) != size:
+            raise EOFError("delta ends in the middle of an op")
+        return data
+
+    print(f"Rebuilding {output}...")
+    sha256 = hashlib.sha256()
+    partial = f"{output}.{os.getpid()}.partial"
+    try:
+        with open(delta_path, 'rb') as f, open(old_iso, 'rb') as fo, \
+                mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as old, open(partial, 'wb') as out:
+            f.seek(ops_offset)
+            with lzma.LZMAFile(f) as ops:
+                while True:
+                    op = ops.read(1)
+                    if not op:
+                        break
+                    if op == DELTA_OP_COPY:
+                        src, length = struct.unpack("<QQ", read_exact(ops, 16))
+                        if src + length > len(old):
+                            raise ValueError(f"copy past the end of {os.path.basename(old_iso)}")
+                        for offset in range(src, src + length, 16*1024*1024):
+                            chunk = old[offset:min(src + length, offset + 16*1024*1024)]
+                            sha256.update(chunk)
+                            out.write(chunk)
+                    elif op == DELTA_OP_DATA:
+                        length, = struct.unpack("<Q", read_exact(ops, 8))
+                        while length:
+                            chunk = read_exact(ops, min(length, 16*1024*1024))
+                            length -= len(chunk)
+                            sha256.update(chunk)
+                            out.write(chunk)
+                    else:
+                        raise ValueError(f"unknown op {op!r}")
+        if sha256.hexdigest() != header["target"]["sha256"]:
+            print(f"✗ Rebuilt ISO does not match {header['target']['name']} (SHA256 mismatch), discarded")
+            return False
+        os.replace(partial, output)
+    except (OSError, EOFError, ValueError, lzma.LZMAError) as e:
+        print(f"✗ Could not rebuild {output} from {delta_path}: {e}")
+        return False
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    print(f"✓ {output} rebuilt and verified (sha256 {header['target']['sha256'][:16]}...)")
+    return True
+
+# zstd seekable format: independent frames plus a seek table in a trailing skippable frame.
+# Plain `zstd -d` still decompresses the whole file; the table gives random access.
+SEEKABLE_FRAME_SIZE = 4 * 1024*1024
+SEEKABLE_LEVEL = 9
+SEEK_TABLE_FRAME_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEKABLE_CACHE_FRAMES = 8
+
+def write_seekable(path, output=None, level=SEEKABLE_LEVEL, frame_size=SEEKABLE_FRAME_SIZE):
+    """Compress path into a seekable zstd container (path.zst) using all cores"""
+    import struct
+    import zstandard
+    output = output or path + ".zst"
+    print(f"Writing seekable container {output} ({frame_size // 1024} KB frames, zstd level {level})...")
+    start = time.time()
+    size = os.path.getsize(path)
+    local = threading.local()
+
+    def compress(view):
+        # ZstdCompressor objects are not thread-safe; one per worker thread
+        if not hasattr(local, "compressor"):
+            local.compressor = zstandard.ZstdCompressor(level=level, write_checksum=True, write_content_size=True)
+        return local.compressor.compress(view)
+
+    entries = []
+    with open(path, 'rb') as f, open(output + ".partial", 'wb') as out, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        offsets = range(0, size, frame_size)
+        # map() keeps frames in order while compressing ahead on every core
+        for offset, frame in zip(offsets, pool.map(lambda o: compress(mm[o:o + frame_size]), offsets)):
+            out.write(frame)
+            entries.append((len(frame), min(frame_size, size - offset)))
+        table = b"".join(struct.pack("<II", c, d) for c, d in entries)
+        table += struct.pack("<IBI", len(entries), 0, SEEKABLE_MAGIC)
+        out.write(struct.pack("<II", SEEK_TABLE_FRAME_MAGIC, len(table)) + table)
+    os.replace(output + ".partial", output)
+    compressed = os.path.getsize(output)
+    print(f"✓ Seekable container written: {output} ({compressed / 1024**2:.1f} MB, "
+          f"{compressed / max(1, size):.1%} of {size / 1024**2:.1f} MB, {len(entries)} frames, {time.time() - start:.1f}s)")
+    return output
+
+class SeekableReader(io.RawIOBase):
+    """Random-access file view of a seekable zstd container.
+
+    Only the frames covering a read are decompressed, and the most recent ones
+    are kept, so range requests, QEMU block reads and sequential streaming all
+    stay cheap.
+    """
+    def __init__(self, path, cache_frames=SEEKABLE_CACHE_FRAMES):
+        import bisect
+        import struct
+        import zstandard
+        super().__init__()
+        self.path = path
+        self.file = open(path, 'rb')
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.cache_frames = cache_frames
+        self.position = 0
+        self._bisect = bisect.bisect_right
+
+        self.file.seek(-9, os.SEEK_END)
+        count, descriptor, magic = struct.unpack("<IBI", self.file.read(9))
+        if magic != SEEKABLE_MAGIC:
+            self.file.close()
+            raise ValueError(f"{path}: no zstd seek table")
+        entry_size = 12 if descriptor & 0x80 else 8
+        self.file.seek(-(9 + count * entry_size + 8), os.SEEK_END)
+        frame_magic, table_size = struct.unpack("<II", self.file.read(8))
+        if frame_magic != SEEK_TABLE_FRAME_MAGIC or table_size != count * entry_size + 9:
+            self.file.close()
+            raise ValueError(f"{path}: corrupt zstd seek table")
+        table = self.file.read(count * entry_size)
+        # Cumulative compressed and decompressed start offsets of every frame
+        self.compressed_starts, self.starts = [0], [0]
+        for i in range(count):
+            compressed, decompressed = struct.unpack_from("<II", table, i * entry_size)
+            self.compressed_starts.append(self.compressed_starts[-1] + compressed)
+            self.starts.append(self.starts[-1] + decompressed)
+        self.size = self.starts[-1]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+    def _frame(self, index):
+        with self.lock:
+            frame = self.cache.pop(index, None)
+            if frame is None:
+                self.file.seek(self.compressed_starts[index])
+                data = self.file.read(self.compressed_starts[index + 1] - self.compressed_starts[index])
+                frame = self.decompressor.decompress(data, max_output_size=self.starts[index + 1] - self.starts[index])
+                if len(self.cache) >= self.cache_frames:
+                    del self.cache[next(iter(self.cache))]
+            self.cache[index] = frame  # re-inserted last: least recently used goes first
+            return frame
+
+    def pread(self, offset, length):
+        """Read length bytes at offset without moving the file position"""
+        parts = []
+        end = min(self.size, offset + length)
+        while offset < end:
+            index = self._bisect(self.starts, offset) - 1
+            frame = self._frame(index)
+            chunk = frame[offset - self.starts[index]:end - self.starts[index]]
+            parts.append(chunk)
+            offset += len(chunk)
+        return b"".join(parts)
+
+    def readinto(self, buffer):
+        data = self.pread(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+def unpack_seekable(path, output):
+    """Stream a seekable container to a file or block device"""
+    print(f"Unpacking {path} to {output}...")
+    with SeekableReader(path) as reader, open(output, 'wb') as out:
+        bar = ProgressBar(f"Writing {os.path.basename(output)}", reader.size)
+        while True:
+            chunk = reader.read(SEEKABLE_FRAME_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            bar.update(reader.tell() / max(1, reader.size))
+        bar.finish()
+        out.flush()
+        os.fsync(out.fileno())
+    print(f"✓ {output} written ({reader.size / 1024**2:.1f} MB)")
+    return True
+
+ISO_SECTOR_SIZE = 2048
+TMPFS_CANDIDATES = ["/dev/shm", f"/run/user/{os.getuid()}", "/tmp"]
+TMPFS_HEADROOM = 1.10            # extracted tree plus directory overhead
+TMPFS_RESERVED_RAM = 1024**3     # leave this much RAM for xorriso and the rest of the system
+
+def read_iso_volume_size(iso_filename):
+    """Return the ISO 9660 volume size in bytes from the primary volume descriptor"""
+    try:
+        with open(iso_filename, 'rb') as f:
+            f.seek(16 * ISO_SECTOR_SIZE)
+            descriptor = f.read(ISO_SECTOR_SIZE)
+    except OSError:
+        return 0
+    if len(descriptor) < 132 or descriptor[0] != 1 or descriptor[1:6] != b"CD001":
+        return 0
+    block_count = int.from_bytes(descriptor[80:84], "little")
+    block_size = int.from_bytes(descriptor[128:130], "little")
+    return block_count * block_size
+
+def read_mem_available():
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+def find_mount(path):
+    """Return (mount_point, fstype) of the filesystem holding path"""
+    path = os.path.realpath(path)
+    best = ("/", "")
+    try:
+        with open("/proc/mounts", 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) >= len(best[0]):
+                    best = (mount_point, fields[2])
+    except OSError:
+        pass
+    return best
+
+def free_bytes(path):
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return 0
+    return st.f_bavail * st.f_frsize
+
+def find_tmpfs():
+    candidates = [os.environ["NOSANA_TMPFS"]] if os.environ.get("NOSANA_TMPFS") else TMPFS_CANDIDATES
+    for candidate in candidates:
+        if os.path.isdir(candidate) and os.access(candidate, os.W_OK) and find_mount(candidate)[1] == "tmpfs":
+            return candidate
+    return None
+
+def plan_workspace(tree_bytes, names, use_tmpfs=True, quiet=False):
+    """Place each workspace path on tmpfs when it fits, else in the current directory.
+
+    names maps a workspace name to its expected size in bytes (None means
+    "the extracted tree", tree_bytes). Paths are placed in order, so list the
+    metadata-heavy tree first. Returns (paths, tmpfs_dir); the caller creates tmpfs_dir.
+    """
+    paths = {name: name for name in names}
+    tmpfs = find_tmpfs() if use_tmpfs else None
+    if not tmpfs:
+        if use_tmpfs and not quiet:
+            print("Workspace: no writable tmpfs found, using current directory")
+        return paths, None
+
+    budget = min(free_bytes(tmpfs), max(0, read_mem_available() - TMPFS_RESERVED_RAM))
+    tmpfs_dir = os.path.join(tmpfs, f"nosana-remaster-{os.getpid()}")
+    placed = False
+    for name, size in names.items():
+        needed = int((tree_bytes if size is None else size) * TMPFS_HEADROOM)
+        if (size is None and not tree_bytes) or needed > budget:
+            if not quiet:
+                print(f"Workspace: {name} on disk ({needed / 1024**3:.2f} GB needed, {budget / 1024**3:.2f} GB tmpfs budget)")
+            continue
+        budget -= needed
+        paths[name] = os.path.join(tmpfs_dir, name)
+        placed = True
+        if not quiet:
+            print(f"Workspace: {name} on tmpfs at {paths[name]}")
+    return paths, (tmpfs_dir if placed else None)
+
+THROUGHPUT_HISTORY_FILE = "remaster-throughput.json"
+PLANNED_STAGES = ["download", "extract-boot-images", "extract-tree", "inject", "codec-benchmark", "squashfs-layer", "initrd", "recompress", "md5sum", "build-iso", "verify", "manifest", "delta", "seekable", "cleanup"]
+WORKSPACE_SIZES = {"working_dir": None, "efi.img": 32 * 1024*1024, "boot_hybrid.img": 4096}
+
+def remote_content_length(url):
+    import urllib.request
+    try:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=15) as response:
+            return int(response.headers.get("Content-Length", 0))
+    except Exception as e:
+        print(f"Warning: Could not get size of {url}: {e}")
+        return 0
+
+def load_throughput_history():
+    try:
+        with open(THROUGHPUT_HISTORY_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def record_stage_throughput(iso_bytes, smoothing=0.5):
+    """Fold this run's stage timings into the throughput history.
+
+    Rates are stored as base-ISO bytes per second for every stage, so the next
+    plan can scale them to whatever base image it is about to process.
+    """
+    if not iso_bytes:
+        return
+    history = load_throughput_history()
+    for span in BUILD_SPANS:
+        if span.get("depth") != 0 or not span.get("wall_s"):
+            continue
+        rate = iso_bytes / span["wall_s"]
+        previous = history.get(span["name"])
+        history[span["name"]] = rate if previous is None else previous * (1 - smoothing) + rate * smoothing
+    try:
+        with open(THROUGHPUT_HISTORY_FILE, 'w') as f:
+            json.dump(history, f, indent=2)
+    except OSError as e:
+        print(f"Warning: Could not save throughput history: {e}")
+
+def filesystem_of(path):
+    """Return (st_dev, mount_point, existing_path) for path or its nearest existing parent"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev, find_mount(path)[0], path
+
+def preflight_plan(iso_url, iso_filename, new_iso, use_tmpfs=True, skip_stages=()):
+    """Check disk and memory needs and estimate stage durations before doing any work.
+
+    Returns (ok, iso_bytes, workspace, tmpfs_dir).
+    """
+    print("Pre-flight plan:")
+    if check_file_exists(iso_filename):
+        iso_bytes = os.path.getsize(iso_filename)
+        tree_bytes = read_iso_volume_size(iso_filename) or iso_bytes
+        download_bytes = 0
+    else:
+        iso_bytes = remote_content_length(iso_url)
+        tree_bytes = iso_bytes
+        download_bytes = iso_bytes
+    if not iso_bytes:
+        print("  Base ISO size unknown, skipping space checks")
+        workspace, tmpfs_dir = plan_workspace(0, WORKSPACE_SIZES, use_tmpfs=False, quiet=True)
+        return True, 0, workspace, tmpfs_dir
+    print(f"  Base ISO: {iso_bytes / 1024**3:.2f} GB ({'download' if download_bytes else 'cached'}), tree ~{tree_bytes / 1024**3:.2f} GB")
+
+    workspace, tmpfs_dir = plan_workspace(tree_bytes, WORKSPACE_SIZES, use_tmpfs=use_tmpfs)
+
+    # Peak usage: base ISO + extracted tree + images + rebuilt ISO all exist at once
+    needs = [(iso_filename, download_bytes), (new_iso, tree_bytes + WORKSPACE_SIZES["efi.img"])]
+    for name, size in WORKSPACE_SIZES.items():
+        needs.append((workspace[name], tree_bytes if size is None else size))
+    per_fs = {}
+    for path, size in needs:
+        dev, mount_point, existing = filesystem_of(path)
+        entry = per_fs.setdefault(dev, {"mount": mount_point, "path": existing, "needed": 0})
+        entry["needed"] += size
+
+    ok = True
+    for entry in per_fs.values():
+        available = free_bytes(entry["path"])
+        status = "✓" if entry["needed"] <= available else "✗"
+        print(f"  {status} {entry['mount']}: needs {entry['needed'] / 1024**3:.2f} GB, {available / 1024**3:.2f} GB free")
+        if entry["needed"] > available:
+            ok = False
+
+    history = load_throughput_history()
+    if history:
+        total = 0
+        print("  Estimated stage durations (from earlier runs):")
+        for name in PLANNED_STAGES:
+            if name in skip_stages or not history.get(name):
+                continue
+            if name == "download" and not download_bytes:
+                continue
+            seconds = iso_bytes / history[name]
+            total += seconds
+            print(f"    {name:<22} {format_duration(seconds)}")
+        print(f"    {'total':<22} {format_duration(total)}")
+    else:
+        print("  No throughput history yet, durations will be estimated after the first run")
+
+    if not ok:
+        print("✗ Not enough free space for this build, aborting before any work")
+    return ok, iso_bytes, workspace, tmpfs_dir
+
+def download_iso(iso_url, iso_filename, position=None):
     if not check_file_exists(iso_filename):
         print(f"Downloading {iso_filename}...")
         try:
@@ -423,6 +2627,7 @@ def remaster_ubuntu_2204(dc_disable_cleanup, inject_hello, inject_autoinstall):
                 unit='B',
                 unit_scale=True,
                 unit_divisor=1024,
+                position=position,
             ) as bar:
                 for chunk in response.iter_content(chunk_size=8192):
                     f.write(chunk)
@@ -433,10 +2638,14 @@ def remaster_ubuntu_2204(dc_disable_cleanup, inject_hello, inject_autoinstall):
     else:
         print(f"Using existing ISO: {iso_filename}")
     
-    print("Extracting MBR template (boot_hybrid.img)...")
-    run_command(f"dd if={iso_filename} of=boot_hybrid.img bs=1 count=432", "Extracting MBR template")
-    
-    print("Extracting EFI partition (efi.img)...")
+    return True
+
+def extract_mbr_template(iso_filename, mbr_img="boot_hybrid.img"):
+    print(f"Extracting MBR template ({mbr_img})...")
+    run_command(f"dd if={iso_filename} of={mbr_img} bs=1 count=432", "Extracting MBR template")
+
+def extract_efi_partition(iso_filename, efi_img="efi.img"):
+    print(f"Extracting EFI partition ({efi_img})...")
     # For Ubuntu 22.04+, we need to find the EFI partition location using fdisk
     try:
         fdisk_result = subprocess.run(f"fdisk -l {iso_filename}", shell=True, capture_output=True, text=True)
@@ -450,40 +2659,65 @@ def remaster_ubuntu_2204(dc_disable_cleanup, inject_hello, inject_autoinstall):
                     efi_start, efi_end = int(parts[1]), int(parts[2])
                     efi_count = efi_end - efi_start + 1
                     print(f"Found EFI partition: sectors {efi_start}-{efi_end} (count: {efi_count})")
-                    run_command(f"dd if={iso_filename} of=efi.img bs=512 skip={efi_start} count={efi_count}", "Extracting EFI partition")
+                    run_command(f"dd if={iso_filename} of={efi_img} bs=512 skip={efi_start} count={efi_count}", "Extracting EFI partition")
                 else:
                     print("Could not parse EFI partition info, using fallback method")
-                    run_command(f"dd if={iso_filename} of=efi.img bs=512 skip=6608 count=11264", "Extracting EFI partition (fallback)")
+                    run_command(f"dd if={iso_filename} of={efi_img} bs=512 skip=6608 count=11264", "Extracting EFI partition (fallback)")
             else:
                 print("No EFI System partition found, using fallback method")
-                run_command(f"dd if={iso_filename} of=efi.img bs=512 skip=6608 count=11264", "Extracting EFI partition (fallback)")
+                run_command(f"dd if={iso_filename} of={efi_img} bs=512 skip=6608 count=11264", "Extracting EFI partition (fallback)")
         else:
             print("fdisk failed, using fallback method")
-            run_command(f"dd if={iso_filename} of=efi.img bs=512 skip=6608 count=11264", "Extracting EFI partition (fallback)")
+            run_command(f"dd if={iso_filename} of={efi_img} bs=512 skip=6608 count=11264", "Extracting EFI partition (fallback)")
     except Exception as e:
         print(f"Error extracting EFI partition: {e}, using fallback method")
-        run_command(f"dd if={iso_filename} of=efi.img bs=512 skip=6608 count=11264", "Extracting EFI partition (fallback)")
-    
-    work_dir = "working_dir"
+        run_command(f"dd if={iso_filename} of={efi_img} bs=512 skip=6608 count=11264", "Extracting EFI partition (fallback)")
+
+def extract_iso_tree(iso_filename, work_dir):
     ensure_clean_dir(work_dir)
     print(f"Extracting ISO file tree to {os.path.abspath(work_dir)}...")
-    result = run_command(f"xorriso -osirrox on -indev {iso_filename} -extract / {work_dir}", "Extracting ISO contents", check=False)
+    result = run_command(["xorriso", "-osirrox", "on", "-indev", iso_filename, "-extract", "/", work_dir],
+                         "Extracting ISO contents", check=False, total_bytes=os.path.getsize(iso_filename))
     
     # Fix permissions after extraction
     print("Fixing file permissions after extraction...")
     subprocess.run(f"sudo chmod -R 755 {work_dir}", shell=True, capture_output=True)
     subprocess.run(f"sudo chown -R {os.getuid()}:{os.getgid()} {work_dir}", shell=True, capture_output=True)
-    
-    print(f"You can now customize the extracted ISO in: {os.path.abspath(work_dir)}")
-    
-    if inject_hello:
-        inject_hello_files(work_dir, "efi.img", "boot_hybrid.img")
-    
-    if inject_autoinstall:
-        inject_autoinstall_files(work_dir)
-    
-    new_iso = "NosanaAOS-0.24.04.2.iso"
+    return result
+
+def clamp_tree_mtimes(work_dir, epoch):
+    """Clamp every mtime in the tree to epoch, so files written during the build match across runs"""
+    clamped = 0
+    for root, dirs, files in os.walk(work_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            try:
+                if os.lstat(path).st_mtime > epoch:
+                    os.utime(path, (epoch, epoch), follow_symlinks=False)
+                    clamped += 1
+            except OSError:
+                continue
+    if os.stat(work_dir).st_mtime > epoch:
+        os.utime(work_dir, (epoch, epoch))
+    return clamped
+
+def reproducible_iso_args(epoch, seed):
+    """xorriso options that pin every date, identity string and GUID the ISO would otherwise vary"""
+    import uuid
+    stamp = time.strftime("%Y%m%d%H%M%S", time.gmtime(epoch)) + "00"
+    disk_guid = uuid.UUID(bytes=hashlib.sha256(f"{seed}:gpt-disk".encode()).digest()[:16], version=4)
+    return [
+        # GRUB's search --fs-uuid reads the modification date, so it becomes the volume UUID
+        f"--modification-date={stamp}",
+        "--set_all_file_dates", "set_to_mtime",
+        # Partition GUIDs are derived from the disk GUID
+        "--gpt_disk_guid", disk_guid.hex,
+        "-sysid", "LINUX", "-A", "NosanaAOS", "-publisher", "NosanaAOS", "-p", "NosanaAOS",
+    ]
+
+def build_iso(work_dir, new_iso, efi_img="efi.img", mbr_img="boot_hybrid.img", epoch=None, seed=None):
     print(f"Rebuilding ISO as {new_iso}...")
+    reproducible_args = reproducible_iso_args(epoch, seed or os.path.basename(new_iso)) if epoch is not None else []
     
     # Try multiple ISO creation methods to handle different Ubuntu versions
     iso_created = False
@@ -494,22 +2728,23 @@ def remaster_ubuntu_2204(dc_disable_cleanup, inject_hello, inject_autoinstall):
     
     if os.path.exists(eltorito_path) and os.path.exists(efi_boot_path):
         # Ubuntu 22.04+ hybrid boot with proper GPT structure
-        xorriso_cmd = (
-            f"xorriso -as mkisofs -r -V 'NosanaAOS' -o {new_iso} "
-            f"--grub2-mbr boot_hybrid.img "
-            f"-partition_offset 16 "
-            f"--mbr-force-bootable "
-            f"-append_partition 2 28732ac11ff8d211ba4b00a0c93ec93b efi.img "
-            f"-appended_part_as_gpt "
-            f"-iso_mbr_part_type a2a0d0ebe5b9334487c068b6b72699c7 "
-            f"-c '/boot.catalog' "
-            f"-b '/boot/grub/i386-pc/eltorito.img' "
-            f"-no-emul-boot -boot-load-size 4 -boot-info-table --grub2-boot-info "
-            f"-eltorito-alt-boot "
-            f"-e '--interval:appended_partition_2:::' "
-            f"-no-emul-boot "
-            f"{work_dir}"
-        )
+        xorriso_cmd = [
+            "xorriso", "-as", "mkisofs", "-r", "-V", "NosanaAOS", "-o", new_iso,
+        ] + reproducible_args + [
+            "--grub2-mbr", mbr_img,
+            "-partition_offset", "16",
+            "--mbr-force-bootable",
+            "-append_partition", "2", "28732ac11ff8d211ba4b00a0c93ec93b", efi_img,
+            "-appended_part_as_gpt",
+            "-iso_mbr_part_type", "a2a0d0ebe5b9334487c068b6b72699c7",
+            "-c", "/boot.catalog",
+            "-b", "/boot/grub/i386-pc/eltorito.img",
+            "-no-emul-boot", "-boot-load-size", "4", "-boot-info-table", "--grub2-boot-info",
+            "-eltorito-alt-boot",
+            "-e", "--interval:appended_partition_2:::",
+            "-no-emul-boot",
+            work_dir,
+        ]
         iso_created = run_command(xorriso_cmd, "Building hybrid ISO with xorriso", check=False)
     
     # Method 2: Try genisoimage with joliet-long flag (handles long filenames)
@@ -518,17 +2753,17 @@ def remaster_ubuntu_2204(dc_disable_cleanup, inject_hello, inject_autoinstall):
         # Install genisoimage if not available
         run_command("sudo apt-get install -y genisoimage", "Installing genisoimage", check=False)
         
-        genisoimage_cmd = (
-            f"genisoimage -r -V 'NosanaAOS Ubuntu 24.04.2' "
-            f"-cache-inodes -J -l -joliet-long "
-            f"-o {new_iso} {work_dir}"
-        )
+        genisoimage_cmd = [
+            "genisoimage", "-r", "-V", "NosanaAOS Ubuntu 24.04.2",
+            "-cache-inodes", "-J", "-l", "-joliet-long",
+            "-o", new_iso, work_dir,
+        ]
         iso_created = run_command(genisoimage_cmd, "Building ISO with genisoimage", check=False)
     
     # Method 3: Try simple genisoimage without joliet-long (last resort)
     if not iso_created:
         print("Joliet-long failed, trying simple genisoimage...")
-        simple_cmd = f"genisoimage -r -V 'NosanaAOS' -o {new_iso} {work_dir}"
+        simple_cmd = ["genisoimage", "-r", "-V", "NosanaAOS", "-o", new_iso, work_dir]
         iso_created = run_command(simple_cmd, "Building simple ISO", check=False)
     
     # Check if ISO was actually created
@@ -536,17 +2771,1046 @@ def remaster_ubuntu_2204(dc_disable_cleanup, inject_hello, inject_autoinstall):
         print(f"✗ All ISO creation methods failed or file is too small")
         return False
     
-    print(f"ISO remaster complete: {new_iso}")
+    return True
+
+ISO_URL = "https://mirror.pilotfiber.com/ubuntu-iso/24.04.2/ubuntu-24.04.2-live-server-amd64.iso"
+ISO_FILENAME = "ubuntu-24.04.2-live-server-amd64.iso"
+NEW_ISO = "NosanaAOS-0.24.04.2.iso"
+
+# Point releases leave releases.ubuntu.com once superseded, so fall back to old-releases
+RELEASE_MIRRORS = [
+    "https://mirror.pilotfiber.com/ubuntu-iso",
+    "https://releases.ubuntu.com",
+    "https://old-releases.ubuntu.com/releases",
+]
+RELEASE_CACHE_DIR = os.path.join(os.path.dirname(CAPABILITY_CACHE_FILE), "releases")
+RELEASE_VERSION_RE = re.compile(r"^(\d\d\.\d\d)(\.\d+)?$")
+# Partition layout per series; build_iso only knows how to rebuild these
+RELEASE_LAYOUTS = {
+    "22.04": "gpt-appended-esp",
+    "24.04": "gpt-appended-esp",
+}
+MATRIX_DIR = "matrix"
+MATRIX_DOWNLOAD_WORKERS = 3
+
+def default_release():
+    return {"version": "24.04.2", "url": ISO_URL, "filename": ISO_FILENAME, "sha256": None,
+            "layout": RELEASE_LAYOUTS["24.04"], "output": NEW_ISO}
+
+def parse_sha256sums(text):
+    sums = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and len(parts[0]) == 64:
+            sums[parts[1].lstrip("*")] = parts[0]
+    return sums
+
+def fetch_release_index(version):
+    """Return (mirror, {filename: sha256}) for a point release, using the on-disk cache first"""
+    import urllib.request
+    cache_path = os.path.join(RELEASE_CACHE_DIR, f"{version}.json")
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        return cached["mirror"], cached["sums"]
+    except (OSError, ValueError, KeyError):
+        pass
+    for mirror in RELEASE_MIRRORS:
+        try:
+            with urllib.request.urlopen(f"{mirror}/{version}/SHA256SUMS", timeout=15) as response:
+                sums = parse_sha256sums(response.read().decode("utf-8", "replace"))
+        except Exception:
+            continue
+        if not sums:
+            continue
+        # Released SHA256SUMS never change, so the cache needs no expiry
+        try:
+            os.makedirs(RELEASE_CACHE_DIR, exist_ok=True)
+            with open(cache_path, 'w') as f:
+                json.dump({"mirror": mirror, "sums": sums}, f, indent=2)
+        except OSError as e:
+            print(f"Warning: Could not cache SHA256SUMS for {version}: {e}")
+        return mirror, sums
+    return None, {}
+
+def resolve_release(version):
+    """Resolve a version such as 22.04.5 to its live-server URL, SHA256 and layout"""
+    match = RELEASE_VERSION_RE.match(version)
+    if not match:
+        print(f"✗ Invalid release version: {version} (expected e.g. 24.04.2)")
+        return None
+    layout = RELEASE_LAYOUTS.get(match.group(1))
+    if not layout:
+        print(f"✗ Release {version} is not supported (known series: {', '.join(sorted(RELEASE_LAYOUTS))})")
+        return None
+    filename = f"ubuntu-{version}-live-server-amd64.iso"
+    mirror, sums = fetch_release_index(version)
+    if filename not in sums:
+        print(f"✗ Could not find {filename} in any SHA256SUMS ({', '.join(RELEASE_MIRRORS)})")
+        return None
+    return {"version": version, "url": f"{mirror}/{version}/{filename}", "filename": filename,
+            "sha256": sums[filename], "layout": layout, "output": f"NosanaAOS-0.{version}.iso"}
+
+def verify_release_download(release):
+    if not release.get("sha256"):
+        return True
+    print(f"Verifying SHA256 of {release['filename']}...")
+    digest = digest_file(release["filename"], ("sha256",))["sha256"]
+    if digest != release["sha256"]:
+        print(f"✗ SHA256 mismatch for {release['filename']}: expected {release['sha256']}, got {digest}")
+        return False
+    print(f"✓ SHA256 verified: {release['filename']}")
+    return True
+
+def fetch_release(release, position=None):
+    """Download a base ISO if needed; a fresh download is checked against SHA256SUMS"""
+    fresh = not check_file_exists(release["filename"])
+    if not download_iso(release["url"], release["filename"], position):
+        return False
+    if fresh and not verify_release_download(release):
+        os.remove(release["filename"])
+        return False
+    return True
+
+def build_release_isolated(release, build_options, workspace=None):
+    """Forked matrix worker: build one release in its own workspace directory, logging to build.log"""
+    workspace = workspace or os.path.join(MATRIX_DIR, release["version"])
+    os.makedirs(workspace, exist_ok=True)
+    release = dict(release, filename=os.path.abspath(release["filename"]), output=os.path.abspath(release["output"]))
+    # Pool workers are reused, so put the directory and output streams back afterwards
+    saved_cwd = os.getcwd()
+    saved_fds = [os.dup(1), os.dup(2)]
+    os.chdir(workspace)
+    log = open("build.log", 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    BUILD_SPANS.clear()
+    try:
+        return remaster_ubuntu_2204(release=release, **build_options)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return False
+    finally:
+        print_build_summary()
+        write_build_report()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved in zip((1, 2), saved_fds):
+            os.dup2(saved, fd)
+            os.close(saved)
+        log.close()
+        os.chdir(saved_cwd)
+
+def build_release_matrix(releases, build_options, jobs):
+    """Fetch every base ISO through one download pool, then build the releases in parallel processes"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    print(f"Matrix build: {', '.join(r['version'] for r in releases)} ({jobs} parallel)")
+
+    with stage("download"):
+        with ThreadPoolExecutor(max_workers=min(MATRIX_DOWNLOAD_WORKERS, len(releases))) as pool:
+            fetched = list(pool.map(fetch_release, releases, range(len(releases))))
+    if not all(fetched):
+        return False
+
+    results = {}
+    start = time.time()
+    # fork keeps this working when the script itself was piped in through curl
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as pool:
+        futures = [(r, pool.submit(build_release_isolated, r, build_options)) for r in releases]
+        for release, future in futures:
+            version = release["version"]
+            try:
+                results[version] = future.result()
+            except Exception as e:
+                print(f"✗ {version}: worker failed: {e}")
+                results[version] = False
+            if results[version]:
+                print(f"✓ {version}: {release['output']} ({format_duration(time.time() - start)})")
+            else:
+                print(f"✗ {version}: build failed, see {os.path.join(MATRIX_DIR, version, 'build.log')}")
+    return all(results.values())
+
+SQUASHFS_CACHE_DIR = "squashfs-cache"
+SQUASHFS_COMPRESSORS = {1: "gzip", 2: "lzma", 3: "lzo", 4: "xz", 5: "lz4", 6: "zstd"}
+
+def read_squashfs_superblock(path):
+    """Return {"compressor", "block_size", "bytes_used"} from a squashfs 4.0 superblock"""
+    with open(path, 'rb') as f:
+        sb = f.read(96)
+    if sb[0:4] != b"hsqs":
+        return None
+    return {
+        "compressor": SQUASHFS_COMPRESSORS.get(int.from_bytes(sb[20:22], "little"), "gzip"),
+        "block_size": int.from_bytes(sb[12:16], "little"),
+        "bytes_used": int.from_bytes(sb[40:48], "little"),
+    }
+
+def hash_tree(path):
+    """Content hash of a directory tree: relative paths, modes and file bytes"""
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, path)
+            st = os.lstat(full)
+            h.update(f"{rel}\0{st.st_mode:o}\0".encode())
+            if os.path.islink(full):
+                h.update(os.readlink(full).encode())
+            else:
+                with open(full, 'rb') as f:
+                    for chunk in iter(lambda: f.read(4*1024*1024), b""):
+                        h.update(chunk)
+    return h.hexdigest()
+
+def layer_digest(work_dir, layer_path, extracted_stats=None):
+    """md5 of the layer as it is now, without rereading it when that is already known"""
+    rel = os.path.relpath(layer_path, work_dir)
+    st = os.lstat(layer_path)
+    stat_key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    stock = read_md5sum_list(os.path.join(work_dir, "md5sum.txt"))
+    # md5sum.txt only describes the layer until an earlier stage replaces it
+    if extracted_stats and extracted_stats.get(rel) == stat_key and rel in stock:
+        return stock[rel]
+    # A layer installed by customize_squashfs_layer has its digest primed in the md5 cache
+    primed = load_md5_cache(work_dir).get(md5_cache_key(rel, stat_key))
+    return primed or md5_file(layer_path)
+
+def layer_cache_key(work_dir, layer_path, overlay_dir, packages, mksquashfs_args, extracted_stats=None):
+    """Cache key for a repacked layer: base layer digest + overlay content + build options"""
+    rel = os.path.relpath(layer_path, work_dir)
+    base_digest = layer_digest(work_dir, layer_path, extracted_stats)
+    h = hashlib.sha256()
+    h.update(f"{rel}\0{base_digest}\0{os.path.getsize(layer_path)}\0".encode())
+    h.update((hash_tree(overlay_dir) if overlay_dir else "").encode())
+    h.update(("\0".join(sorted(packages)) + "\0" + " ".join(mksquashfs_args)).encode())
+    # mksquashfs stamps SOURCE_DATE_EPOCH into the image when it is set
+    h.update(f"\0epoch\0{source_date_epoch()}".encode())
+    return h.hexdigest()[:32]
+
+# Runs inside a private mount namespace: the bind mounts vanish with the shell.
+# The layer's own resolv.conf (usually the systemd-resolved stub symlink) is moved
+# aside while apt runs with the host resolver, then put back before mksquashfs.
+LAYER_CHROOT_SCRIPT = (
+    'root="$0"; conf="$root/etc/resolv.conf"; saved="$root/etc/.resolv.conf.remaster"; '
+    'mount --bind /dev "$root/dev" && mount -t proc proc "$root/proc" && mount -t sysfs sysfs "$root/sys" || exit 1; '
+    'if [ -e "$conf" ] || [ -L "$conf" ]; then mv "$conf" "$saved" || exit 1; fi; '
+    'cp -L /etc/resolv.conf "$conf"; '
+    # Package names reach apt as separate arguments, never as shell code
+    "DEBIAN_FRONTEND=noninteractive chroot \"$root\" "
+    "sh -c 'apt-get update && apt-get install -y --no-install-recommends \"$@\" && apt-get clean' sh \"$@\"; "
+    'status=$?; rm -f "$conf"; '
+    'if [ -e "$saved" ] || [ -L "$saved" ]; then mv "$saved" "$conf"; fi; '
+    'exit $status'
+)
+# name, optionally pinned to a version: foo, libfoo2.1, foo=1.2-3ubuntu1
+DEBIAN_PACKAGE_RE = re.compile(r"^[a-z0-9][a-z0-9+.-]*(=[^\s;&|]+)?$")
+
+def invalid_packages(packages):
+    return [p for p in packages if not isinstance(p, str) or not DEBIAN_PACKAGE_RE.match(p)]
+
+def customize_squashfs_layer(work_dir, layer, overlay_dir=None, packages=(), mksquashfs_args=None, cache_dir=".",
+                             extracted_stats=None):
+    """Unpack casper/<layer>.squashfs, apply an overlay and packages, repack it with every core.
+
+    Repacked layers are kept in SQUASHFS_CACHE_DIR under a key of base layer plus
+    overlay, so an unchanged customization is never recompressed.
+    """
+    layer_path = os.path.join(work_dir, "casper", layer if layer.endswith(".squashfs") else layer + ".squashfs")
+    if not os.path.exists(layer_path):
+        print(f"✗ Squashfs layer not found: {layer_path}")
+        return False
+    superblock = read_squashfs_superblock(layer_path)
+    if superblock is None:
+        print(f"✗ Not a squashfs image: {layer_path}")
+        return False
+    if mksquashfs_args is None:
+        # Keep the stock codec and block size unless told otherwise
+        mksquashfs_args = ["-comp", superblock["compressor"], "-b", str(superblock["block_size"])]
+    packages = list(packages)
+    rejected = invalid_packages(packages)
+    if rejected:
+        print(f"✗ Not a Debian package name: {', '.join(map(repr, rejected))}")
+        return False
+
+    key = layer_cache_key(work_dir, layer_path, overlay_dir, packages, mksquashfs_args, extracted_stats)
+    layer_cache_dir = os.path.join(cache_dir, SQUASHFS_CACHE_DIR)
+    cached = os.path.join(layer_cache_dir, f"{os.path.basename(layer_path)}.{key}")
+    if os.path.exists(cached):
+        print(f"Using cached layer: {cached}")
+    else:
+        unpack_dir = os.path.abspath(f"{work_dir}-layer")
+        ensure_clean_dir(unpack_dir)
+        try:
+            if not run_command(["sudo", "unsquashfs", "-f", "-d", unpack_dir, layer_path], f"Unpacking {os.path.basename(layer_path)}"):
+                return False
+            if overlay_dir and not run_command(["sudo", "cp", "-a", os.path.join(overlay_dir, "."), unpack_dir], "Applying overlay"):
+                return False
+            if packages:
+                prefix = ["unshare", "--mount", "--propagation", "private"]
+                if os.geteuid() != 0:
+                    prefix = ["sudo"] + prefix
+                if not run_command(prefix + ["sh", "-c", LAYER_CHROOT_SCRIPT, unpack_dir] + packages,
+                                   f"Installing {', '.join(packages)} into layer"):
+                    return False
+            os.makedirs(layer_cache_dir, exist_ok=True)
+            partial = f"{cached}.{os.getpid()}.partial"
+            if not run_command(["sudo", "mksquashfs", unpack_dir, partial, "-noappend",
+                                "-processors", str(os.cpu_count() or 1)] + mksquashfs_args,
+                               f"Repacking {os.path.basename(layer_path)}"):
+                return False
+            subprocess.run(["sudo", "chown", f"{os.getuid()}:{os.getgid()}", partial], capture_output=True)
+            with open(partial + ".md5", 'w') as f:
+                f.write(md5_file(partial) + "\n")
+            os.replace(partial + ".md5", cached + ".md5")
+            os.replace(partial, cached)
+
+            # casper and subiquity read the uncompressed size from <layer>.size
+            size_file = layer_path[:-len(".squashfs")] + ".size"
+            if os.path.exists(size_file):
+                du = subprocess.run(["sudo", "du", "-sx", "--block-size=1", unpack_dir], capture_output=True, text=True)
+                if du.returncode == 0:
+                    with open(cached + ".size", 'w') as f:
+                        f.write(du.stdout.split()[0] + "\n")
+        finally:
+            subprocess.run(["sudo", "rm", "-rf", unpack_dir], capture_output=True)
+
+    os.remove(layer_path)
+    shutil.copyfile(cached, layer_path)
+    if os.path.exists(cached + ".md5"):
+        with open(cached + ".md5", 'r') as f:
+            prime_md5_cache(work_dir, layer_path, f.read().strip())
+    size_file = layer_path[:-len(".squashfs")] + ".size"
+    if os.path.exists(cached + ".size") and os.path.exists(size_file):
+        shutil.copyfile(cached + ".size", size_file)
+    print(f"✓ Layer {os.path.basename(layer_path)} customized")
+    return True
+
+# codec -> (compress argv, decompress argv, default level); {level} is filled in.
+# lz4 must be the legacy frame format and xz must use crc32 for the kernel's initramfs decoders.
+CODECS = {
+    "zstd": (["zstd", "-q", "-c", "-T0", "-{level}"], ["zstd", "-q", "-d", "-c"], 19),
+    "xz": (["xz", "-c", "-T0", "-{level}", "--check=crc32"], ["xz", "-d", "-c"], 6),
+    "lz4": (["lz4", "-q", "-c", "-l", "-{level}"], ["lz4", "-q", "-d", "-c"], 9),
+    "gzip": (["gzip", "-c", "-n", "-{level}"], ["gzip", "-d", "-c"], 9),
+}
+COMPRESSED_MAGIC = [
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x02\x21\x4c\x18", "lz4"),
+    (b"\x1f\x8b", "gzip"),
+]
+# Read bandwidths (MB/s) used to project boot-time load cost: USB 2, USB 3 stick, SATA SSD, NVMe
+EMULATED_BANDWIDTHS = [30, 150, 500, 2000]
+CODEC_BENCHMARK_FILE = "codec-benchmark.json"
+
+def parse_codec(spec):
+    """Parse "zstd" or "zstd:19" into (codec, level)"""
+    name, _, level = spec.partition(":")
+    if name not in CODECS:
+        raise ValueError(f"unknown codec {name} (choose from {', '.join(CODECS)})")
+    return name, int(level) if level else CODECS[name][2]
+
+def codec_command(name, level, decompress=False):
+    compress_argv, decompress_argv, _ = CODECS[name]
+    return list(decompress_argv) if decompress else [arg.format(level=level) for arg in compress_argv]
+
+def pipe_through(argv, data):
+    result = subprocess.run(argv, input=data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{argv[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+def mksquashfs_codec_args(name, level):
+    args = ["-comp", name]
+    if name in ("zstd", "gzip"):
+        args += ["-Xcompression-level", str(level)]
+    elif name == "lz4" and level >= 9:
+        args.append("-Xhc")
+    return args
+
+def detect_compression(data):
+    for magic, name in COMPRESSED_MAGIC:
+        if data.startswith(magic):
+            return name
+    return None
+
+def parse_cpio(data, offset=0):
+    """Parse one newc cpio archive starting at offset; return (entries, end_offset)"""
+    entries = []
+    while True:
+        header = data[offset:offset + 110]
+        if len(header) < 110 or header[0:6] not in (b"070701", b"070702"):
+            raise ValueError(f"bad cpio header at offset {offset}")
+        fields = [int(header[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+        (ino, mode, uid, gid, nlink, mtime, filesize,
+         devmajor, devminor, rdevmajor, rdevminor, namesize, _) = fields
+        name_start = offset + 110
+        name = data[name_start:name_start + namesize - 1].decode("utf-8", "surrogateescape")
+        data_start = (name_start + namesize + 3) & ~3
+        offset = (data_start + filesize + 3) & ~3
+        if name == "TRAILER!!!":
+            return entries, offset
+        entries.append({
+            "name": name, "ino": ino, "mode": mode, "uid": uid, "gid": gid, "nlink": nlink,
+            "mtime": mtime, "devmajor": devmajor, "devminor": devminor,
+            "rdevmajor": rdevmajor, "rdevminor": rdevminor,
+            "data": bytes(data[data_start:data_start + filesize]),
+        })
+
+def split_initrd(data):
+    """Split an initrd into its uncompressed early cpio archives and the compressed main archive.
+
+    Returns (early_archives, early_bytes, payload, codec) where early_archives is a list
+    of entry lists (microcode etc.) and payload is the still-compressed main image.
+    """
+    early_archives = []
+    offset = 0
+    while data[offset:offset + 6] in (b"070701", b"070702"):
+        entries, offset = parse_cpio(data, offset)
+        early_archives.append(entries)
+        # Archives are padded with zeros, typically to a 512-byte boundary
+        while offset < len(data) and data[offset] == 0:
+            offset += 1
+    payload = data[offset:]
+    return early_archives, data[:offset], payload, detect_compression(payload)
+
+INITRD_CACHE_DIR = "initrd-cache"
+
+def write_cpio(entries, pad_to=4):
+    """Serialize entries (as returned by parse_cpio) into a newc cpio archive"""
+    out = bytearray()
+    for entry in entries + [{"name": "TRAILER!!!", "ino": 0, "mode": 0, "uid": 0, "gid": 0, "nlink": 1,
+                             "mtime": 0, "devmajor": 0, "devminor": 0, "rdevmajor": 0, "rdevminor": 0, "data": b""}]:
+        name = entry["name"].encode("utf-8", "surrogateescape") + b"\0"
+        fields = (entry["ino"], entry["mode"], entry["uid"], entry["gid"], entry["nlink"], entry["mtime"],
+                  len(entry["data"]), entry["devmajor"], entry["devminor"], entry["rdevmajor"], entry["rdevminor"],
+                  len(name), 0)
+        out += b"070701" + "".join("%08X" % value for value in fields).encode("ascii") + name
+        out += bytes(-len(out) % 4)
+        out += entry["data"]
+        out += bytes(-len(out) % 4)
+    out += bytes(-len(out) % pad_to)
+    return bytes(out)
+
+def parse_cpio_stream(data):
+    """Parse every cpio archive concatenated in data (zero padding between them is skipped)"""
+    entries = []
+    offset = 0
+    while offset < len(data):
+        if data[offset] == 0:
+            offset += 1
+            continue
+        archive, offset = parse_cpio(data, offset)
+        entries.extend(archive)
+    return entries
+
+def apply_initrd_changes(entries, additions=(), removals=()):
+    """Remove entries matching any removal glob, then add or replace (local_path, dest) files"""
+    import fnmatch
+    kept = [e for e in entries if not any(fnmatch.fnmatchcase(e["name"], pattern.lstrip("/")) for pattern in removals)]
+    removed = len(entries) - len(kept)
+    by_name = {e["name"]: e for e in kept}
+    next_ino = max([e["ino"] for e in kept] + [0]) + 1
+    for local_path, dest in additions:
+        dest = dest.strip("/")
+        # Create missing parent directories first
+        parts = dest.split("/")
+        for depth in range(1, len(parts)):
+            parent = "/".join(parts[:depth])
+            if parent not in by_name:
+                by_name[parent] = {"name": parent, "ino": next_ino, "mode": 0o40755, "uid": 0, "gid": 0, "nlink": 2,
+                                   "mtime": 0, "devmajor": 0, "devminor": 0, "rdevmajor": 0, "rdevminor": 0, "data": b""}
+                kept.append(by_name[parent])
+                next_ino += 1
+        st = os.stat(local_path)
+        with open(local_path, 'rb') as f:
+            content = f.read()
+        epoch = source_date_epoch()
+        entry = {"name": dest, "ino": next_ino, "mode": 0o100000 | (st.st_mode & 0o7777), "uid": 0, "gid": 0, "nlink": 1,
+                 "mtime": int(st.st_mtime) if epoch is None else min(int(st.st_mtime), epoch), "devmajor": 0, "devminor": 0, "rdevmajor": 0, "rdevminor": 0, "data": content}
+        next_ino += 1
+        if dest in by_name:
+            kept[kept.index(by_name[dest])] = entry
+        else:
+            kept.append(entry)
+        by_name[dest] = entry
+    return kept, removed
+
+def initrd_cache_key(data, additions, removals, codec_spec):
+    h = hashlib.sha256(data)
+    for local_path, dest in additions:
+        with open(local_path, 'rb') as f:
+            h.update(f"\0add\0{dest}\0{os.stat(local_path).st_mode & 0o7777:o}\0".encode() + hashlib.sha256(f.read()).digest())
+    for pattern in removals:
+        h.update(f"\0rm\0{pattern}".encode())
+    h.update(f"\0codec\0{codec_spec or ''}".encode())
+    h.update(f"\0epoch\0{source_date_epoch()}".encode())
+    return h.hexdigest()[:32]
+
+def modify_initrd(initrd_path, additions=(), removals=(), codec_spec=None, cache_dir="."):
+    """Apply file additions/removals and/or a new codec to an initrd, caching the result.
+
+    Early (uncompressed) cpio segments such as CPU microcode are kept byte for byte;
+    only the main archive is unpacked, edited and recompressed. Results are cached in
+    INITRD_CACHE_DIR by the hash of the input initrd and the requested changes.
+    """
+    with open(initrd_path, 'rb') as f:
+        data = f.read()
+    key = initrd_cache_key(data, additions, removals, codec_spec)
+    cached = os.path.join(cache_dir, INITRD_CACHE_DIR, key)
+    if os.path.exists(cached):
+        shutil.copyfile(cached, initrd_path)
+        print(f"Using cached initrd: {cached}")
+        return True
+
+    _, early_bytes, payload, current = split_initrd(data)
+    if not payload:
+        print(f"✗ {initrd_path} has no compressed main archive")
+        return False
+    if current is None:
+        print(f"✗ {initrd_path}: unrecognized compression of main archive")
+        return False
+    name, level = parse_codec(codec_spec) if codec_spec else (current, CODECS[current][2])
+    raw = pipe_through(codec_command(current, 0, decompress=True), payload)
+
+    if additions or removals:
+        entries, removed = apply_initrd_changes(parse_cpio_stream(raw), additions, removals)
+        print(f"initrd: removed {removed} entries, added {len(additions)} files")
+        raw = write_cpio(entries)
+    if name != current or additions or removals or codec_spec:
+        print(f"Compressing initrd with {name} level {level}...")
+        payload = pipe_through(codec_command(name, level), raw)
+
+    result = early_bytes + payload
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    partial = f"{cached}.{os.getpid()}.partial"
+    with open(partial, 'wb') as f:
+        f.write(result)
+    os.replace(partial, cached)
+    with open(initrd_path, 'wb') as f:
+        f.write(result)
+    print(f"✓ initrd {len(data) / (1024*1024):.1f} MB -> {len(result) / (1024*1024):.1f} MB")
+    return True
+
+def recompress_squashfs_layers(work_dir, codec_spec, cache_dir=".", extracted_stats=None):
+    """Repack every casper/*.squashfs with the selected codec (through the layer cache)"""
+    name, level = parse_codec(codec_spec)
+    casper_dir = os.path.join(work_dir, "casper")
+    layers = sorted(f for f in os.listdir(casper_dir) if f.endswith(".squashfs")) if os.path.isdir(casper_dir) else []
+    for layer in layers:
+        superblock = read_squashfs_superblock(os.path.join(casper_dir, layer))
+        if superblock is None:
+            continue
+        args = mksquashfs_codec_args(name, level) + ["-b", str(superblock["block_size"])]
+        if not customize_squashfs_layer(work_dir, layer, mksquashfs_args=args, cache_dir=cache_dir,
+                                        extracted_stats=extracted_stats):
+            return False
+    return True
+
+def benchmark_codecs(sample, codec_specs, bandwidths=EMULATED_BANDWIDTHS):
+    """Measure size, compression and decompression throughput of each codec on sample bytes.
+
+    Load time at each emulated read bandwidth is read time of the compressed image plus
+    the time to decompress it, which is how a squashfs or initrd read behaves at boot.
+    """
+    results = []
+    raw_mb = len(sample) / (1024*1024)
+    for spec in codec_specs:
+        name, level = parse_codec(spec)
+        if not shutil.which(CODECS[name][0][0]):
+            print(f"Skipping {name}: {CODECS[name][0][0]} not installed")
+            continue
+        start = time.perf_counter()
+        packed = pipe_through(codec_command(name, level), sample)
+        compress_s = time.perf_counter() - start
+        start = time.perf_counter()
+        pipe_through(codec_command(name, level, decompress=True), packed)
+        decompress_s = time.perf_counter() - start
+        packed_mb = len(packed) / (1024*1024)
+        results.append({
+            "codec": name, "level": level,
+            "size_bytes": len(packed), "ratio": round(len(sample) / max(1, len(packed)), 3),
+            "compress_mb_s": round(raw_mb / compress_s, 1) if compress_s else None,
+            "decompress_mb_s": round(raw_mb / decompress_s, 1) if decompress_s else None,
+            "load_s": {str(bw): round(packed_mb / bw + decompress_s, 3) for bw in bandwidths},
+        })
+    return results
+
+def print_codec_benchmark(results, sample_bytes, bandwidths=EMULATED_BANDWIDTHS):
+    print(f"\nCodec benchmark on {sample_bytes / (1024*1024):.1f} MB sample:")
+    header = f"{'Codec':<10} {'Size MB':>8} {'Ratio':>6} {'Comp MB/s':>10} {'Decomp MB/s':>12}"
+    header += "".join(f" {f'@{bw}MB/s':>10}" for bw in bandwidths)
+    print(header)
+    for r in results:
+        line = f"{r['codec'] + ':' + str(r['level']):<10} {r['size_bytes'] / (1024*1024):>8.1f} {r['ratio']:>6.2f} "
+        line += f"{r['compress_mb_s'] or 0:>10.1f} {r['decompress_mb_s'] or 0:>12.1f}"
+        line += "".join(f" {r['load_s'][str(bw)]:>9.2f}s" for bw in bandwidths)
+        print(line)
+
+def codec_benchmark_sample(work_dir, sample_path=None, limit=256*1024*1024):
+    """Bytes to benchmark on: sample_path (file or tarred directory), else the unpacked initrd"""
+    if sample_path and os.path.isdir(sample_path):
+        return subprocess.run(["tar", "-C", sample_path, "-cf", "-", "."], capture_output=True).stdout[:limit]
+    if sample_path:
+        with open(sample_path, 'rb') as f:
+            return f.read(limit)
+    initrd = os.path.join(work_dir, "casper", "initrd")
+    with open(initrd, 'rb') as f:
+        data = f.read()
+    _, _, payload, current = split_initrd(data)
+    if current is None:
+        return data[:limit]
+    return pipe_through(codec_command(current, 0, decompress=True), payload)[:limit]
+
+def run_codec_benchmark(work_dir, codec_specs, sample_path=None):
+    sample = codec_benchmark_sample(work_dir, sample_path)
+    results = benchmark_codecs(sample, codec_specs)
+    print_codec_benchmark(results, len(sample))
+    with open(CODEC_BENCHMARK_FILE, 'w') as f:
+        json.dump({"sample_bytes": len(sample), "bandwidths_mb_s": EMULATED_BANDWIDTHS, "results": results}, f, indent=2)
+    print(f"Codec benchmark written: {CODEC_BENCHMARK_FILE}")
+    return results
+
+class IsoError(Exception):
+    pass
+
+GPT_ESP_TYPE = "28732ac11ff8d211ba4b00a0c93ec93b"  # C12A7328-F81F-11D2-BA4B-00A0C93EC93B, on-disk byte order
+MBR_ESP_TYPE = "ef"
+ELTORITO_PLATFORMS = {0x00: "bios", 0xEF: "efi"}
+BASE_IMAGES = {}
+
+def le_int(data, offset, size):
+    return int.from_bytes(data[offset:offset + size], "little")
+
+def parse_iso_record(data, offset):
+    """Decode one ISO 9660 directory record, or None at sector padding"""
+    length = data[offset]
+    if not length:
+        return None
+    name_len = data[offset + 32]
+    system_use = offset + 33 + name_len + (0 if name_len % 2 else 1)
+    return {
+        "length": length,
+        "extent": le_int(data, offset + 2, 4),
+        "size": le_int(data, offset + 10, 4),
+        "flags": data[offset + 25],
+        "raw_name": bytes(data[offset + 33:offset + 33 + name_len]),
+        "system_use": bytes(data[system_use:offset + length]),
+    }
+
+def iso_date_epoch(field):
+    """Convert a 17-byte volume descriptor date (digits plus a 15-minute UTC offset) to epoch seconds"""
+    import calendar
+    try:
+        t = time.strptime(field[:14].decode("ascii"), "%Y%m%d%H%M%S")
+    except (UnicodeDecodeError, ValueError):
+        return 0
+    offset = int.from_bytes(field[16:17], "little", signed=True) * 15 * 60
+    return calendar.timegm(t) - offset
+
+class BaseImage:
+    """Parsed, read-only view of a base ISO that can be reused for many builds.
+
+    Holds the volume descriptors, the partition table (MBR and GPT), the El
+    Torito boot catalog and a lazily built directory index with Rock Ridge
+    names, so boot images and files can be read without mounting or shelling out.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.file = open(path, 'rb')
+        st = os.fstat(self.file.fileno())
+        self.identity = (st.st_size, st.st_mtime_ns)
+        if st.st_size < 17 * ISO_SECTOR_SIZE:
+            self.file.close()
+            raise IsoError(f"{path}: too small for an ISO 9660 image")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index = None
+        self.susp_skip = 0
+        self._parse_volume_descriptors()
+        self._parse_partition_table()
+        self._parse_boot_catalog()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+
+    def _parse_volume_descriptors(self):
+        self.volume_id = None
+        self.boot_catalog_lba = None
+        self.joliet = False
+        sector = 16
+        while True:
+            d = self.mm[sector * ISO_SECTOR_SIZE:(sector + 1) * ISO_SECTOR_SIZE]
+            if len(d) < ISO_SECTOR_SIZE or d[1:6] != b"CD001":
+                raise IsoError(f"{self.path}: no ISO 9660 volume descriptor set")
+            kind = d[0]
+            if kind == 255:
+                break
+            if kind == 0 and d[7:30] == b"EL TORITO SPECIFICATION":
+                self.boot_catalog_lba = le_int(d, 71, 4)
+            elif kind == 1:
+                self.volume_id = d[40:72].decode("ascii", "replace").rstrip()
+                self.block_size = le_int(d, 128, 2)
+                self.volume_bytes = le_int(d, 80, 4) * self.block_size
+                self.root = parse_iso_record(d, 156)
+                self.created_epoch = iso_date_epoch(d[813:830])
+            elif kind == 2 and d[88:91] in (b"%/@", b"%/C", b"%/E"):
+                self.joliet = True
+            sector += 1
+        if self.volume_id is None:
+            raise IsoError(f"{self.path}: no primary volume descriptor")
+
+    def _parse_partition_table(self):
+        self.mbr_template = bytes(self.mm[:432])
+        self.partitions = []
+        if self.mm[510:512] == b"\x55\xaa":
+            for number in range(1, 5):
+                entry = 446 + 16 * (number - 1)
+                kind, start, count = self.mm[entry + 4], le_int(self.mm, entry + 8, 4), le_int(self.mm, entry + 12, 4)
+                if kind and count:
+                    self.partitions.append({"scheme": "mbr", "number": number, "type": f"{kind:02x}",
+                                            "start": start, "sectors": count, "name": ""})
+        if self.mm[512:520] == b"EFI PART":
+            table = le_int(self.mm, 512 + 72, 8) * 512
+            count, size = le_int(self.mm, 512 + 80, 4), le_int(self.mm, 512 + 84, 4)
+            for number in range(1, count + 1):
+                entry = table + (number - 1) * size
+                kind = bytes(self.mm[entry:entry + 16])
+                if not any(kind):
+                    continue
+                first, last = le_int(self.mm, entry + 32, 8), le_int(self.mm, entry + 40, 8)
+                name = bytes(self.mm[entry + 56:entry + 128]).decode("utf-16-le", "replace").rstrip("\0")
+                self.partitions.append({"scheme": "gpt", "number": number, "type": kind.hex(),
+                                        "start": first, "sectors": last - first + 1, "name": name})
+
+    def _parse_boot_catalog(self):
+        self.boot_entries = []
+        if self.boot_catalog_lba is None:
+            return
+        catalog = self.mm[self.boot_catalog_lba * ISO_SECTOR_SIZE:(self.boot_catalog_lba + 1) * ISO_SECTOR_SIZE]
+        if catalog[0] != 1 or catalog[30:32] != b"\x55\xaa":
+            raise IsoError(f"{self.path}: invalid El Torito validation entry")
+
+        def entry(offset, platform):
+            return {"platform": ELTORITO_PLATFORMS.get(platform, f"{platform:#x}"), "bootable": catalog[offset] == 0x88,
+                    "media": catalog[offset + 1], "sectors": le_int(catalog, offset + 6, 2),
+                    "load_rba": le_int(catalog, offset + 8, 4)}
+
+        self.boot_entries.append(entry(32, catalog[1]))
+        offset = 64
+        while offset + 32 <= len(catalog) and catalog[offset] in (0x90, 0x91):
+            last, platform, count = catalog[offset] == 0x91, catalog[offset + 1], le_int(catalog, offset + 2, 2)
+            offset += 32
+            for _ in range(count):
+                if catalog[offset] in (0x88, 0x00):
+                    self.boot_entries.append(entry(offset, platform))
+                offset += 32
+                # Selection criteria extensions belong to the entry before them
+                while offset < len(catalog) and catalog[offset] == 0x44:
+                    offset += 32
+            if last:
+                break
+
+    # --- directory index --------------------------------------------------
+
+    def _rock_ridge_name(self, system_use, skip):
+        name, found = b"", False
+        areas = [(system_use, skip)]
+        while areas:
+            area, pos = areas.pop()
+            while pos + 4 <= len(area):
+                signature, length = area[pos:pos + 2], area[pos + 2]
+                if length < 4:
+                    break
+                if signature == b"NM" and not area[pos + 4] & 0x06:
+                    name += area[pos + 5:pos + length]
+                    found = True
+                elif signature == b"CE":
+                    start = le_int(area, pos + 4, 4) * ISO_SECTOR_SIZE + le_int(area, pos + 12, 4)
+                    areas.append((bytes(self.mm[start:start + le_int(area, pos + 20, 4)]), 0))
+                elif signature == b"SP":
+                    self.susp_skip = area[pos + 6]
+                elif signature == b"ST":
+                    break
+                pos += length
+        return name.decode("utf-8", "replace") if found else None
+
+    def _read_directory(self, extent, size):
+        records = []
+        data = self.mm[extent * ISO_SECTOR_SIZE:extent * ISO_SECTOR_SIZE + size]
+        offset = 0
+        while offset < len(data):
+            record = parse_iso_record(data, offset)
+            if record is None:
+                # Records never span sectors; the rest of this one is padding
+                offset = (offset // ISO_SECTOR_SIZE + 1) * ISO_SECTOR_SIZE
+                continue
+            records.append(record)
+            offset += record["length"]
+        return records
+
+    @property
+    def index(self):
+        """{"/path": {"is_dir", "size", "extents": [(lba, bytes)]}} for every file and directory"""
+        if self._index is not None:
+            return self._index
+        index = {"/": {"is_dir": True, "size": self.root["size"], "extents": [(self.root["extent"], self.root["size"])]}}
+        pending = ["/"]
+        while pending:
+            directory = pending.pop()
+            extent, size = index[directory]["extents"][0]
+            previous = None
+            for record in self._read_directory(extent, size):
+                if record["raw_name"] in (b"\x00", b"\x01"):
+                    if record["raw_name"] == b"\x00" and directory == "/":
+                        self._rock_ridge_name(record["system_use"], 0)  # picks up the SP skip length
+                    continue
+                name = self._rock_ridge_name(record["system_use"], self.susp_skip)
+                if name is None:
+                    name = record["raw_name"].decode("ascii", "replace").split(";")[0].rstrip(".")
+                path = directory.rstrip("/") + "/" + name
+                if previous is not None and previous[1] == path:
+                    # Multi-extent file: further records continue the previous one
+                    previous[0]["extents"].append((record["extent"], record["size"]))
+                    previous[0]["size"] += record["size"]
+                else:
+                    entry = {"is_dir": bool(record["flags"] & 0x02), "size": record["size"],
+                             "extents": [(record["extent"], record["size"])]}
+                    index[path] = entry
+                    if entry["is_dir"]:
+                        pending.append(path)
+                previous = (index[path], path) if record["flags"] & 0x80 else None
+        self._index = index
+        return index
+
+    def exists(self, path):
+        return "/" + path.strip("/") in self.index
+
+    def read(self, path):
+        entry = self.index.get("/" + path.strip("/"))
+        if entry is None or entry["is_dir"]:
+            raise IsoError(f"{path}: no such file in {os.path.basename(self.path)}")
+        return b"".join(self.mm[lba * ISO_SECTOR_SIZE:lba * ISO_SECTOR_SIZE + size] for lba, size in entry["extents"])
+
+    # --- boot images ------------------------------------------------------
+
+    def esp_partition(self):
+        for scheme, kind in (("gpt", GPT_ESP_TYPE), ("mbr", MBR_ESP_TYPE)):
+            for partition in self.partitions:
+                if partition["scheme"] == scheme and partition["type"] == kind:
+                    return partition
+        return None
+
+    def write_mbr_template(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.mbr_template)
+
+    def write_esp(self, path, chunk_size=4*1024*1024):
+        partition = self.esp_partition()
+        if partition is None:
+            raise IsoError(f"{self.path}: no EFI System partition in the partition table")
+        start, end = partition["start"] * 512, (partition["start"] + partition["sectors"]) * 512
+        with open(path, 'wb') as f:
+            for offset in range(start, end, chunk_size):
+                f.write(self.mm[offset:min(end, offset + chunk_size)])
+        return partition
+
+    def build(self, new_iso, workspace=None, tmpfs_dir=None, use_tmpfs=True, dc_disable_cleanup=False,
+              inject_hello=False, inject_autoinstall=False, sign_manifest=False, esp_files=(),
+              layer=None, layer_overlay=None, layer_packages=(), squashfs_codec=None, initrd_codec=None,
+              codec_bench=None, codec_sample=None, initrd_add=(), initrd_remove=(), delta_from=None, seekable=False, injectors=(),
+              grub_profile=DEFAULT_GRUB_PROFILE, cache_dir="."):
+        """Remaster this base into new_iso; returns True on success.
+
+        injectors is a list of extra (name, ops) pairs applied with the
+        built-in ones in a single change set (see collect_changes). cache_dir
+        holds the layer and initrd caches; builds may share one. The md5 cache
+        is kept next to the workspace (see md5_cache_path).
+        """
+        if workspace is None:
+            workspace, tmpfs_dir = plan_workspace(self.volume_bytes, WORKSPACE_SIZES, use_tmpfs)
+        work_dir = workspace["working_dir"]
+        efi_img = workspace["efi.img"]
+        mbr_img = workspace["boot_hybrid.img"]
+        temp_paths = [work_dir, "work_2204", mbr_img, efi_img, "_iso_mount"]
+        if tmpfs_dir:
+            os.makedirs(tmpfs_dir, exist_ok=True)
+            temp_paths.append(tmpfs_dir)
+
+        with stage("extract-boot-images"):
+            print(f"Extracting MBR template ({mbr_img}) and EFI partition ({efi_img})...")
+            self.write_mbr_template(mbr_img)
+            try:
+                partition = self.write_esp(efi_img)
+                print(f"Found EFI partition: sectors {partition['start']}-{partition['start'] + partition['sectors'] - 1} (count: {partition['sectors']})")
+            except IsoError as e:
+                print(f"{e}, using fallback method")
+                extract_efi_partition(self.path, efi_img)
+
+        with stage("extract-tree"):
+            extract_iso_tree(self.path, work_dir)
+            extracted_stats = snapshot_tree_stats(work_dir)
+
+        print(f"You can now customize the extracted ISO in: {os.path.abspath(work_dir)}")
+
+        injected = None
+        with stage("inject"):
+            injections = []
+            if inject_hello:
+                injections.append(("hello", hello_injector()))
+            if inject_autoinstall:
+                injections.append(("autoinstall", autoinstall_injector(grub_profile)))
+            if esp_files:
+                try:
+                    injections.append(("esp-add", esp_files_injector(esp_files)))
+                except OSError as e:
+                    print(f"✗ -esp-add: {e}")
+                    return False
+            injections += list(injectors)
+            if injections:
+                injected = run_injectors(injections, work_dir, efi_img, mbr_img)
+                if injected is None:
+                    return False
+            if inject_autoinstall:
+                print("NOTE: After installation, run '/cleanup-minimal.sh' as root to minimize the system")
+
+        if codec_bench:
+            with stage("codec-benchmark"):
+                run_codec_benchmark(work_dir, codec_bench, codec_sample)
+
+        if layer:
+            with stage("squashfs-layer"):
+                if not customize_squashfs_layer(work_dir, layer, layer_overlay, layer_packages, cache_dir=cache_dir,
+                                                extracted_stats=extracted_stats):
+                    return False
+
+        if initrd_add or initrd_remove or initrd_codec:
+            with stage("initrd"):
+                if not modify_initrd(os.path.join(work_dir, "casper", "initrd"), initrd_add, initrd_remove, initrd_codec, cache_dir):
+                    return False
+
+        if squashfs_codec:
+            with stage("recompress"):
+                if not recompress_squashfs_layers(work_dir, squashfs_codec, cache_dir, extracted_stats):
+                    return False
+
+        with stage("md5sum"):
+            update_md5sum_list(work_dir, extracted_stats)
+
+        epoch = source_date_epoch()
+        if epoch is not None:
+            clamped = clamp_tree_mtimes(work_dir, epoch)
+            print(f"Reproducible build: SOURCE_DATE_EPOCH={epoch}, {clamped} mtime(s) clamped")
+
+        with stage("build-iso"):
+            if not build_iso(work_dir, new_iso, efi_img, mbr_img, epoch, os.environ.get("NOSANA_BUILD_SEED")):
+                return False
+
+        print(f"ISO remaster complete: {new_iso}")
+
+        if inject_hello:
+            with stage("verify"):
+                verify_hello_files(new_iso, efi_img, mbr_img)
+
+        with stage("manifest"):
+            write_build_manifest(new_iso, work_dir, sign=sign_manifest, efi_img=efi_img, mbr_img=mbr_img, injected=injected)
+
+        if delta_from:
+            with stage("delta"):
+                write_iso_delta(delta_from, new_iso)
+
+        if seekable:
+            with stage("seekable"):
+                write_seekable(new_iso)
+
+        if not dc_disable_cleanup:
+            print("Cleaning up temp files...")
+            with stage("cleanup"):
+                cleanup(temp_paths)
+        return True
+
+def open_base_image(path):
+    """Return a BaseImage for path, reusing the parsed handle while the file is unchanged"""
+    path = os.path.abspath(path)
+    image = BASE_IMAGES.get(path)
+    if image is not None:
+        st = os.stat(path)
+        if image.mm is not None and image.identity == (st.st_size, st.st_mtime_ns):
+            return image
+        image.close()
+    image = BASE_IMAGES[path] = BaseImage(path)
+    return image
+
+def remaster_ubuntu_2204(release=None, plan_only=False, use_tmpfs=True, reproducible=False, **build_options):
+    """Resolve, plan and download the base release, then build it through BaseImage.build"""
+    release = release or default_release()
+    iso_url = release["url"]
+    iso_filename = release["filename"]
+    new_iso = release["output"]
+
+    skip_stages = [] if build_options.get("inject_hello") else ["verify"]
+    if not build_options.get("layer"):
+        skip_stages.append("squashfs-layer")
+    if not any(build_options.get(name) for name in ("initrd_add", "initrd_remove", "initrd_codec")):
+        skip_stages.append("initrd")
+    if not build_options.get("squashfs_codec"):
+        skip_stages.append("recompress")
+    if not build_options.get("codec_bench"):
+        skip_stages.append("codec-benchmark")
+    if build_options.get("dc_disable_cleanup"):
+        skip_stages.append("cleanup")
+    if not build_options.get("delta_from"):
+        skip_stages.append("delta")
+    if not build_options.get("seekable"):
+        skip_stages.append("seekable")
+    ok, iso_bytes, workspace, tmpfs_dir = preflight_plan(iso_url, iso_filename, new_iso, use_tmpfs, skip_stages)
+    if not ok or plan_only:
+        return ok
     
-    if inject_hello:
-        verify_hello_files(new_iso)
+    with stage("download"):
+        if not fetch_release(release):
+            return False
     
-    if not dc_disable_cleanup:
-        print("Cleaning up temp files...")
-        cleanup(temp_paths)
+    try:
+        base = open_base_image(iso_filename)
+    except (OSError, IsoError) as e:
+        print(f"✗ Could not read base ISO: {e}")
+        return False
     
+    # -reproducible without SOURCE_DATE_EPOCH dates the build from the base image itself
+    derived_epoch = reproducible and source_date_epoch() is None
+    if derived_epoch:
+        os.environ["SOURCE_DATE_EPOCH"] = str(base.created_epoch)
+    try:
+        if not base.build(new_iso, workspace, tmpfs_dir, **build_options):
+            return False
+    finally:
+        if derived_epoch:
+            del os.environ["SOURCE_DATE_EPOCH"]
+
+    record_stage_throughput(iso_bytes or os.path.getsize(iso_filename))
     return True
 
+def get_arg_value(flag, default=None):
+    values = get_arg_values(flag)
+    return values[-1] if values else default
+
+def get_arg_values(flag):
+    """Values following every occurrence of flag on the command line"""
+    return [sys.argv[i + 1] for i, arg in enumerate(sys.argv[:-1]) if arg == flag]
+
 def main():
     print("Ubuntu ISO Remastering Tool - Version 0.04.0-late-commands (remaster4.py)")
     print("================================================================")
@@ -558,15 +3822,125 @@ def main():
     print("Make sure you can run sudo commands when prompted")
     print("================================================================")
     
-    if not check_and_install_dependencies():
-        return 1
+    delta_path = get_arg_value("-apply-delta")
+    if delta_path:
+        base_iso = get_arg_value("-base")
+        if not base_iso:
+            print("✗ -apply-delta needs -base PREVIOUS.iso")
+            return 1
+        return 0 if apply_iso_delta(delta_path, base_iso, get_arg_value("-o")) else 1
+
+    fleet_manifest = get_arg_value("-fleet")
+    if fleet_manifest:
+        out_dir = get_arg_value("-fleet-out", "fleet")
+        if not check_and_install_dependencies(need_download=False, config_only=True):
+            return 1
+        os.makedirs(out_dir, exist_ok=True)
+        return 0 if render_fleet(fleet_manifest, out_dir, get_arg_value("-fleet-template")) else 1
+
+    if "-validate" in sys.argv:
+        if not check_and_install_dependencies(need_download=False, config_only=True):
+            return 1
+        return 0 if preflight_validate() else 1
+
+    container = get_arg_value("-unpack-seekable")
+    if container:
+        if not check_and_install_dependencies(need_download=False, seekable=True):
+            return 1
+        output = get_arg_value("-o")
+        if not output and container.endswith(".zst"):
+            output = container[:-len(".zst")]
+        if not output:
+            print("✗ -unpack-seekable needs -o OUTPUT (a file or a device such as /dev/sdX)")
+            return 1
+        return 0 if unpack_seekable(container, output) else 1
     
     dc_disable_cleanup = "-dc" in sys.argv
     inject_hello = "-hello" in sys.argv
     inject_autoinstall = "-autoinstall" in sys.argv
+    sign_manifest = "-sign" in sys.argv
+    use_tmpfs = "-no-tmpfs" not in sys.argv
+    plan_only = "-plan" in sys.argv
+    reproducible = "-reproducible" in sys.argv
+    seekable = "-seekable" in sys.argv
+    grub_profile = get_arg_value("-grub-profile", DEFAULT_GRUB_PROFILE)
+    if grub_profile not in GRUB_PROFILES:
+        print(f"✗ -grub-profile: unknown profile {grub_profile} (available: {', '.join(GRUB_PROFILES)})")
+        return 1
+    esp_files = [tuple(value.split(":", 1)) for value in get_arg_values("-esp-add")]
+    delta_from = get_arg_value("-delta-from")
+    if delta_from:
+        if not os.path.isfile(delta_from):
+            print(f"✗ -delta-from: {delta_from} not found")
+            return 1
+        delta_from = os.path.abspath(delta_from)
+    layer = get_arg_value("-layer")
+    layer_overlay = get_arg_value("-layer-overlay")
+    layer_packages = [p for value in get_arg_values("-layer-packages") for p in value.split(",") if p]
+    if invalid_packages(layer_packages):
+        print(f"✗ -layer-packages: not a Debian package name: {', '.join(invalid_packages(layer_packages))}")
+        return 1
+    squashfs_codec = get_arg_value("-squashfs-codec")
+    initrd_codec = get_arg_value("-initrd-codec")
+    codec_bench = [c for c in get_arg_value("-codec-bench", "").split(",") if c]
+    codec_sample = get_arg_value("-codec-sample")
+    initrd_add = [tuple(value.split(":", 1)) for value in get_arg_values("-initrd-add")]
+    initrd_remove = get_arg_values("-initrd-remove")
+    if any(len(pair) != 2 for pair in initrd_add):
+        print("✗ -initrd-add expects LOCAL_FILE:/PATH/IN/INITRD")
+        return 1
+    try:
+        for spec in [squashfs_codec, initrd_codec] + codec_bench:
+            if spec:
+                parse_codec(spec)
+    except ValueError as e:
+        print(f"✗ {e}")
+        return 1
+    if any(len(pair) != 2 for pair in esp_files):
+        print("✗ -esp-add expects LOCAL_FILE:/ESP/PATH")
+        return 1
     
-    if not remaster_ubuntu_2204(dc_disable_cleanup, inject_hello, inject_autoinstall):
+    versions = [v for value in get_arg_values("-release") for v in value.split(",") if v]
+    if versions:
+        releases = [resolve_release(v) for v in dict.fromkeys(versions)]
+        if not all(releases):
+            return 1
+    else:
+        releases = [default_release()]
+
+    if not check_and_install_dependencies(need_download=not all(check_file_exists(r["filename"]) for r in releases),
+                                          sign=sign_manifest, squashfs=bool(layer or squashfs_codec), seekable=seekable,
+                                          autoinstall=inject_autoinstall,
+                                          codecs=[parse_codec(initrd_codec)[0]] if initrd_codec else ()):
+        return 1
+    # Catch a broken seed or boot menu before anything is downloaded or extracted
+    if inject_autoinstall and not preflight_validate():
+        return 1
+
+    build_options = dict(dc_disable_cleanup=dc_disable_cleanup, inject_hello=inject_hello, inject_autoinstall=inject_autoinstall,
+                         sign_manifest=sign_manifest, use_tmpfs=use_tmpfs, plan_only=plan_only, reproducible=reproducible, esp_files=esp_files,
+                         layer=layer, layer_overlay=layer_overlay, layer_packages=layer_packages,
+                         squashfs_codec=squashfs_codec, initrd_codec=initrd_codec,
+                         codec_bench=codec_bench, codec_sample=codec_sample, initrd_add=initrd_add, initrd_remove=initrd_remove, delta_from=delta_from, seekable=seekable, grub_profile=grub_profile,
+                         cache_dir=os.getcwd())
+    try:
+        if len(releases) > 1 and not plan_only:
+            jobs = int(get_arg_value("-jobs", min(len(releases), max(1, (os.cpu_count() or 1) // 4))))
+            if jobs > 1 and use_tmpfs:
+                # Each worker would budget the same free RAM for itself
+                print("Workspace: parallel matrix builds keep their workspaces on disk")
+                build_options["use_tmpfs"] = False
+            success = build_release_matrix(releases, build_options, jobs)
+        else:
+            success = all([remaster_ubuntu_2204(release=r, **build_options) for r in releases])
+    finally:
+        if not plan_only:
+            print_build_summary()
+            write_build_report()
+    if not success:
         return 1
+    if plan_only:
+        return 0
     
     print("\n==================================================")
     print("Directory listing:")
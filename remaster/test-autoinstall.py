@@ -9,108 +9,78 @@ import sys
 import yaml
 import subprocess
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import remaster4
+
 def test_autoinstall_files():
     """Test that autoinstall configuration files exist and are valid"""
     print("Testing autoinstall configuration files...")
     
     script_dir = os.path.dirname(os.path.abspath(__file__))
     
-    # Test user-data file
-    user_data_path = os.path.join(script_dir, "autoinstall-user-data")
-    if not os.path.exists(user_data_path):
-        print(f"✗ FAIL: {user_data_path} not found")
-        return False
-    
-    try:
-        with open(user_data_path, 'r') as f:
-            user_data = yaml.safe_load(f)
-        
-        # Check required sections
-        if 'autoinstall' not in user_data:
-            print("✗ FAIL: autoinstall section missing from user-data")
-            return False
-        
-        autoinstall = user_data['autoinstall']
-        
-        # Check version
-        if autoinstall.get('version') != 1:
-            print("✗ FAIL: autoinstall version should be 1")
-            return False
-        
-        # Check interactive sections
-        interactive_sections = autoinstall.get('interactive-sections', [])
-        expected_interactive = ['locale', 'keyboard', 'network', 'proxy', 'storage', 'identity', 'ubuntu-pro', 'drivers']
-        
-        for section in expected_interactive:
-            if section not in interactive_sections:
-                print(f"✗ FAIL: {section} not in interactive-sections")
-                return False
-        
-        # Check forced configurations
-        ssh_config = autoinstall.get('ssh', {})
-        if ssh_config.get('install-server') != False:
-            print("✗ FAIL: SSH server should be disabled")
-            return False
-        
-        packages = autoinstall.get('packages', [])
-        if 'ubuntu-server-minimal' not in packages:
-            print("✗ FAIL: ubuntu-server-minimal not in packages")
+    # The shipped files must match what remaster4.py actually injects
+    documents = {}
+    for name, inline in (("autoinstall-user-data", remaster4.AUTOINSTALL_USER_DATA),
+                         ("autoinstall-meta-data", remaster4.AUTOINSTALL_META_DATA),
+                         ("grub-autoinstall.cfg", remaster4.GRUB_AUTOINSTALL_CFG)):
+        path = os.path.join(script_dir, name)
+        if not os.path.exists(path):
+            print(f"✗ FAIL: {path} not found")
             return False
-        
-        snaps = autoinstall.get('snaps', [])
-        if len(snaps) != 0:
-            print("✗ FAIL: snaps should be empty")
+        with open(path, 'r') as f:
+            documents[name] = f.read()
+        if documents[name] != inline:
+            print(f"✗ FAIL: {name} differs from the inline configuration in remaster4.py")
             return False
-        
-        drivers = autoinstall.get('drivers', {})
-        if drivers.get('install') != True:
-            print("✗ FAIL: drivers install should be True")
-            return False
-        
-        print("✓ PASS: user-data configuration is valid")
-        
-    except yaml.YAMLError as e:
-        print(f"✗ FAIL: user-data YAML parsing error: {e}")
-        return False
     
-    # Test meta-data file
-    meta_data_path = os.path.join(script_dir, "autoinstall-meta-data")
-    if not os.path.exists(meta_data_path):
-        print(f"✗ FAIL: {meta_data_path} not found")
+    # Same schema, GRUB and seed layout checks the build runs before downloading
+    errors, warnings = remaster4.validate_autoinstall_config(
+        user_data=documents["autoinstall-user-data"], meta_data=documents["autoinstall-meta-data"],
+        grub_cfg=documents["grub-autoinstall.cfg"])
+    for warning in warnings:
+        print(f"Warning: {warning}")
+    if errors:
+        for error in errors:
+            print(f"✗ FAIL: {error}")
         return False
+    print("✓ PASS: user-data, meta-data and GRUB configuration are valid")
+
+    autoinstall = yaml.safe_load(documents["autoinstall-user-data"])['autoinstall']
     
-    try:
-        with open(meta_data_path, 'r') as f:
-            meta_data = yaml.safe_load(f)
-        
-        if 'instance-id' not in meta_data:
-            print("✗ FAIL: instance-id missing from meta-data")
+    # Check interactive sections
+    interactive_sections = autoinstall.get('interactive-sections', [])
+    expected_interactive = ['locale', 'keyboard', 'network', 'proxy', 'storage', 'identity', 'ubuntu-pro', 'drivers']
+
+    for section in expected_interactive:
+        if section not in interactive_sections:
+            print(f"✗ FAIL: {section} not in interactive-sections")
             return False
-        
-        print("✓ PASS: meta-data configuration is valid")
-        
-    except yaml.YAMLError as e:
-        print(f"✗ FAIL: meta-data YAML parsing error: {e}")
+
+    # Check forced configurations
+    ssh_config = autoinstall.get('ssh', {})
+    if ssh_config.get('install-server') != False:
+        print("✗ FAIL: SSH server should be disabled")
         return False
     
-    # Test GRUB configuration
-    grub_config_path = os.path.join(script_dir, "grub-autoinstall.cfg")
-    if not os.path.exists(grub_config_path):
-        print(f"✗ FAIL: {grub_config_path} not found")
+    source = autoinstall.get('source', {})
+    if source.get('id') != 'ubuntu-server-minimal':
+        print("✗ FAIL: source id should be ubuntu-server-minimal")
         return False
     
-    with open(grub_config_path, 'r') as f:
-        grub_content = f.read()
+    if source.get('search_drivers') != True:
+        print("✗ FAIL: source search_drivers should be True")
+        return False
     
-    if "autoinstall ds=nocloud-net;s=/cdrom/server/" not in grub_content:
-        print("✗ FAIL: GRUB configuration missing autoinstall boot option")
+    snaps = autoinstall.get('snaps', [])
+    if len(snaps) != 0:
+        print("✗ FAIL: snaps should be empty")
         return False
     
-    if "Install Ubuntu Server (Semi-Automated)" not in grub_content:
+    if "Install Ubuntu Server (Semi-Automated)" not in documents["grub-autoinstall.cfg"]:
         print("✗ FAIL: GRUB configuration missing semi-automated menu entry")
         return False
     
-    print("✓ PASS: GRUB configuration is valid")
+    print("✓ PASS: forced choices are configured")
     
     return True
 
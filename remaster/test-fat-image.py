@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Test script for the in-process FAT engine
+Verifies the mkfs.vfat-style layout of new images and growth past the FAT12 limit
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import remaster4
+
+def test_make_fat_image_layout():
+    """Test that new images use 2 KiB clusters and the smallest FAT type that fits"""
+    print("Testing make_fat_image layout...")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "esp.img")
+        for size_mb, bits in ((2, 12), (64, 16)):
+            remaster4.make_fat_image(path, size_mb * 1024 * 1024)
+            with remaster4.FatImage(path) as fat:
+                if fat.fat_bits != bits or fat.cluster_bytes != 2048:
+                    print(f"✗ FAIL: {size_mb} MB image is FAT{fat.fat_bits} with "
+                          f"{fat.cluster_bytes}-byte clusters, expected FAT{bits} with 2048")
+                    return False
+            print(f"✓ PASS: {size_mb} MB image is FAT{bits} with 2 KiB clusters")
+
+    return True
+
+def test_grow_past_fat12():
+    """Test that a 2 MB FAT12 image takes a 3 MB file, then converts to FAT16 for a 10 MB one"""
+    print("\nTesting growth past the FAT12 cluster limit...")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "esp.img")
+        remaster4.make_fat_image(path, 2 * 1024 * 1024, timestamp=0)
+        small = b"grub config\n" * 100
+        medium = bytes(range(256)) * (3 * 1024 * 1024 // 256)
+        large = bytes(range(255, -1, -1)) * (10 * 1024 * 1024 // 256)
+        with remaster4.FatImage(path, timestamp=0) as fat:
+            fat.write("/EFI/BOOT/grub.cfg", small)
+            fat.write("/EFI/BOOT/medium.bin", medium)
+            if fat.read("/EFI/BOOT/medium.bin") != medium:
+                print("✗ FAIL: 3 MB file reads back differently")
+                return False
+            fat.write("/EFI/BOOT/large.bin", large)
+
+        with remaster4.FatImage(path) as fat:
+            if fat.fat_bits != 16 or bytes(fat.mm[54:62]) != b"FAT16   ":
+                print(f"✗ FAIL: image is FAT{fat.fat_bits} after growth, expected FAT16")
+                return False
+            for name, data in (("grub.cfg", small), ("medium.bin", medium), ("large.bin", large)):
+                if fat.read(f"/EFI/BOOT/{name}") != data:
+                    print(f"✗ FAIL: {name} changed across the FAT12 to FAT16 conversion")
+                    return False
+            # The converted FAT must keep allocating correctly
+            fat.remove("/EFI/BOOT/medium.bin")
+            fat.write("/EFI/BOOT/medium.bin", medium[::-1])
+            if fat.read("/EFI/BOOT/medium.bin") != medium[::-1]:
+                print("✗ FAIL: rewrite after conversion returned different contents")
+                return False
+
+    print("✓ PASS: 2 MB image took a 3 MB file, grew to FAT16 and kept its files")
+    return True
+
+def main():
+    """Main test function"""
+    print("FAT Image Engine Test")
+    print("="*50)
+
+    success = True
+
+    if not test_make_fat_image_layout():
+        success = False
+
+    if not test_grow_past_fat12():
+        success = False
+
+    print("\n" + "="*50)
+    if success:
+        print("✓ ALL TESTS PASSED")
+        return 0
+    else:
+        print("✗ SOME TESTS FAILED - Check the errors above")
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
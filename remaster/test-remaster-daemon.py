@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Test script for the remaster build daemon API
+Verifies that malformed job requests are answered with 400 and an error message
+"""
+
+import os
+import sys
+import json
+import tempfile
+import threading
+import http.client
+import http.server
+import importlib.util
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location("remaster_daemon", os.path.join(script_dir, "remaster-daemon.py"))
+remaster_daemon = importlib.util.module_from_spec(spec)
+# Worker processes unpickle run_job by module name
+sys.modules["remaster_daemon"] = remaster_daemon
+spec.loader.exec_module(remaster_daemon)
+
+BAD_REQUESTS = {
+    "top-level list": [{"release": "24.04.2"}],
+    "top-level string": "24.04.2",
+    "numeric release": {"release": 24.04},
+    "options string": {"options": "x"},
+    "options list": {"options": ["autoinstall"]},
+    "seed list": {"seed": ["user-data"]},
+    "seed string": {"seed": "user-data"},
+    "seed non-string value": {"seed": {"user-data": 1}},
+    "invalid JSON": None,
+}
+
+def post(port, body):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("POST", "/jobs", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+def test_malformed_requests():
+    """Test that every malformed request shape gets a 400 with an error message"""
+    print("Testing malformed job requests...")
+
+    success = True
+    with tempfile.TemporaryDirectory() as tmp:
+        service = remaster_daemon.BuildService(tmp, 1)
+        remaster_daemon.ApiHandler.service = service
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), remaster_daemon.ApiHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for name, request in BAD_REQUESTS.items():
+                body = b"{not json" if request is None else json.dumps(request).encode()
+                try:
+                    status, payload = post(server.server_address[1], body)
+                except (OSError, http.client.HTTPException) as e:
+                    # An unhandled exception in the handler drops the connection
+                    status, payload = None, str(e).encode()
+                try:
+                    error = json.loads(payload).get("error")
+                except (ValueError, AttributeError):
+                    error = None
+                if status != 400 or not error:
+                    print(f"✗ FAIL: {name}: got {status} {payload[:80]!r}, expected 400 with an error")
+                    success = False
+                else:
+                    print(f"✓ PASS: {name}: 400 {error}")
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.pool.shutdown()
+
+    return success
+
+def main():
+    """Main test function"""
+    print("Remaster Daemon API Test")
+    print("="*50)
+
+    success = test_malformed_requests()
+
+    print("\n" + "="*50)
+    if success:
+        print("✓ ALL TESTS PASSED")
+        return 0
+    else:
+        print("✗ SOME TESTS FAILED - Check the errors above")
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())